@@ -0,0 +1,163 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, List
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+import db_utils
+from database_models import Broadcast
+
+logger = logging.getLogger(__name__)
+
+# --- Broadcast Configuration ---
+# Recipients are read from the DB this many at a time
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "200"))
+# Max messages in flight at once
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+# Progress is saved after every this many recipients; a restart re-sends at most this many
+BROADCAST_SAVE_EVERY = max(1, int(os.getenv("BROADCAST_SAVE_EVERY", str(BROADCAST_CONCURRENCY))))
+# Telegram allows about 30 messages per second across all chats; stay below it
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+
+
+class RateLimiter:
+    """
+    Spaces out sends to at most `rate` per second, shared by all senders.
+    A RetryAfter from Telegram pauses every sender, not just the one that hit it.
+    """
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        self._next_slot = max(self._next_slot, time.monotonic() + seconds)
+
+
+class BroadcastEngine:
+    """
+    Sends broadcasts by streaming recipients from the DB in chunks. Every
+    user gets a single message per campaign, which keeps each chat well
+    under Telegram's per-chat limit. Each chunk is sent in windows of
+    BROADCAST_SAVE_EVERY recipients, and the cursor and counters are saved
+    after every window, so a crash or restart resumes where it stopped.
+    Delivery is at least once: users of the window that was in flight when
+    the bot stopped may get the message again.
+    """
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self.limiter = RateLimiter(BROADCAST_RATE)
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def launch(self, broadcast: Broadcast) -> None:
+        if broadcast.id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(broadcast))
+        self._tasks[broadcast.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast.id, None))
+
+    async def resume_all(self) -> None:
+        """Continues every broadcast that was still running when the bot stopped."""
+        async with db_utils.get_async_db() as db:
+            running = await db_utils.get_running_broadcasts_async(db)
+        for broadcast in running:
+            logger.info(f"Resuming broadcast {broadcast.id} after user #{broadcast.last_user_id}")
+            self.launch(broadcast)
+
+    async def stop(self) -> None:
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, broadcast: Broadcast) -> None:
+        cursor = broadcast.last_user_id
+        counts = {"sent": broadcast.sent, "failed": broadcast.failed, "blocked": broadcast.blocked}
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        try:
+            while True:
+                async with db_utils.get_async_db() as db:
+                    chunk = await db_utils.get_recipient_chunk_async(db, cursor, BROADCAST_CHUNK_SIZE)
+                if not chunk:
+                    break
+
+                for start in range(0, len(chunk), BROADCAST_SAVE_EVERY):
+                    window = chunk[start:start + BROADCAST_SAVE_EVERY]
+                    results = await asyncio.gather(*(self._send(semaphore, broadcast, telegram_id) for _, telegram_id in window))
+                    newly_blocked: List[int] = []
+                    for (_, telegram_id), result in zip(window, results):
+                        counts[result] += 1
+                        if result == "blocked":
+                            newly_blocked.append(telegram_id)
+                    cursor = window[-1][0]
+
+                    await db_utils.run_write(lambda db: db_utils.save_broadcast_progress_async(
+                        db, broadcast.id, cursor, counts["sent"], counts["failed"], counts["blocked"], newly_blocked
+                    ))
+                    db_utils.known_users.forget(newly_blocked)
+                # The progress message is edited once per chunk to stay clear of edit limits
+                await self._report(broadcast, counts, finished=False)
+
+            await db_utils.run_write(lambda db: db_utils.save_broadcast_progress_async(
+                db, broadcast.id, cursor, counts["sent"], counts["failed"], counts["blocked"], [], finished=True
+            ))
+            await self._report(broadcast, counts, finished=True)
+        except asyncio.CancelledError:
+            logger.info(f"Broadcast {broadcast.id} paused after user #{cursor}; it will resume on restart.")
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast {broadcast.id} stopped unexpectedly: {e}")
+
+    async def _send(self, semaphore: asyncio.Semaphore, broadcast: Broadcast, chat_id: int) -> str:
+        """Copies the broadcast message to one user. Returns "sent", "failed" or "blocked"."""
+        async with semaphore:
+            for _ in range(BROADCAST_MAX_RETRIES):
+                await self.limiter.wait()
+                try:
+                    await self.bot.copy_message(chat_id=chat_id, from_chat_id=broadcast.from_chat_id, message_id=broadcast.message_id)
+                    return "sent"
+                except RetryAfter as e:
+                    retry_after = e.retry_after
+                    seconds = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+                    logger.warning(f"Broadcast {broadcast.id}: flood limit hit, pausing {seconds}s")
+                    self.limiter.pause(seconds)
+                except Forbidden:
+                    return "blocked"
+                except BadRequest as e:
+                    logger.warning(f"Broadcast {broadcast.id}: could not send to {chat_id}: {e}")
+                    return "failed"
+                except NetworkError as e:
+                    # Includes TimedOut; worth another try
+                    logger.warning(f"Broadcast {broadcast.id}: network error for {chat_id}: {e}")
+                except TelegramError as e:
+                    logger.warning(f"Broadcast {broadcast.id}: could not send to {chat_id}: {e}")
+                    return "failed"
+            return "failed"
+
+    async def _report(self, broadcast: Broadcast, counts: Dict[str, int], finished: bool) -> None:
+        if not broadcast.progress_chat_id or not broadcast.progress_message_id:
+            return
+        title = "✅ *ارسال همگانی به پایان رسید.*" if finished else "⏳ *در حال ارسال همگانی...*"
+        text = (
+            f"{title}\n\n"
+            f"ارسال شده: {counts['sent']}\n"
+            f"ناموفق: {counts['failed']}\n"
+            f"ربات را مسدود کرده‌اند: {counts['blocked']}"
+        )
+        try:
+            await self.bot.edit_message_text(text, chat_id=broadcast.progress_chat_id, message_id=broadcast.progress_message_id, parse_mode="Markdown")
+        except TelegramError as e:
+            # "message is not modified" and friends are not worth failing a broadcast over
+            logger.debug(f"Could not update broadcast {broadcast.id} progress: {e}")
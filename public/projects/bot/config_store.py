@@ -0,0 +1,239 @@
+import os
+import json
+import shutil
+import asyncio
+import logging
+import tempfile
+from pathlib import Path
+from typing import Any, Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# ===============================================================
+#   Config Store
+#   The JSON config files (admins, settings, tickets) are kept in
+#   memory. Saves are written atomically (temp file + fsync + rename) in a
+#   worker thread, and a burst of saves collapses into a single write.
+#   Files edited by hand on disk are picked up again via their mtime.
+# ===============================================================
+
+# Delay (seconds) a save waits so that following saves join the same write
+CONFIG_SAVE_DELAY = float(os.getenv("CONFIG_SAVE_DELAY", "0.2"))
+# How often (seconds) the files are checked for changes made on disk
+CONFIG_RELOAD_INTERVAL = float(os.getenv("CONFIG_RELOAD_INTERVAL", "2"))
+
+
+def _write_atomic(path: Path, payload: str) -> int:
+    """Writes payload next to path, fsyncs it and renames it over path. Returns the new mtime."""
+    fd, tmp_name = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_name, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
+        raise
+    # Make the rename itself durable
+    try:
+        dir_fd = os.open(path.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+    return path.stat().st_mtime_ns
+
+
+def _mtime(path: Path) -> Optional[int]:
+    try:
+        return path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _read_json(path: Path) -> Tuple[Optional[int], Any]:
+    """Returns (mtime, parsed content), or (None, None) if the file is gone."""
+    mtime = _mtime(path)
+    if mtime is None:
+        return None, None
+    with open(path, "r", encoding="utf-8") as f:
+        return mtime, json.load(f)
+
+
+class JsonFile:
+    """One JSON file held in memory, with coalesced atomic saves and mtime-based reloads."""
+
+    def __init__(self, path: Path, default: Callable[[], Any], normalize: Optional[Callable[[Any], Any]] = None,
+                 encode: Optional[Callable[[Any], Any]] = None, on_change: Optional[Callable[[], None]] = None):
+        self.path = Path(path)
+        self._default = default
+        # normalize: JSON -> in-memory form, encode: in-memory form -> JSON
+        self._normalize = normalize or (lambda data: data)
+        self._encode = encode or (lambda data: data)
+        # Called after every save and every reload from disk
+        self._on_change = on_change or (lambda: None)
+        self._data: Any = None
+        self._mtime: Optional[int] = None
+        self._dirty = False
+        self._save_task: Optional[asyncio.Task] = None
+        self._write_lock = asyncio.Lock()
+        self.load()
+
+    @property
+    def data(self) -> Any:
+        return self._data
+
+    def load(self) -> None:
+        """
+        Reads the file. A missing or empty file (install.sh touches them) is
+        written with the defaults; a corrupt one is kept as <name>.corrupt
+        instead of being silently overwritten.
+        """
+        mtime = _mtime(self.path)
+        if mtime is None or self.path.stat().st_size == 0:
+            self._data = self._normalize(self._default())
+            self._mtime = _write_atomic(self.path, self._dump())
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            backup = self.path.with_name(self.path.name + ".corrupt")
+            shutil.copyfile(self.path, backup)
+            logger.error(f"{self.path.name} is corrupt ({e}); a copy was saved as {backup.name}. Using defaults.")
+            data = self._default()
+        self._data = self._normalize(data)
+        self._mtime = mtime
+
+    async def reload_if_changed(self) -> bool:
+        """
+        Re-reads the file if it was changed on disk. Unsaved in-memory changes
+        win. The file is read and parsed in a thread; the data is swapped in
+        on the event loop.
+        """
+        if self._dirty:
+            return False
+        known_mtime = self._mtime
+        try:
+            mtime, data = await asyncio.to_thread(_read_json, self.path)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            # Possibly an editor halfway through saving; keep the current data and try again later
+            logger.warning(f"Ignoring unreadable change to {self.path.name}: {e}")
+            return False
+        # Skip if nothing changed, or if we saved while the thread was reading
+        if mtime is None or mtime == self._mtime or self._dirty or self._mtime != known_mtime:
+            return False
+        self._data = self._normalize(data)
+        self._mtime = mtime
+        logger.info(f"Reloaded {self.path.name} after it changed on disk.")
+        self._on_change()
+        return True
+
+    def set(self, data: Any) -> None:
+        """Replaces the data in memory and schedules a save."""
+        self._data = data
+        self.save()
+
+    def save(self) -> None:
+        """
+        Schedules a write of the current data. Saves made before the write
+        starts are merged into it. Without a running event loop (scripts),
+        the file is written immediately.
+        """
+        self._dirty = True
+        self._on_change()
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self._dirty = False
+            self._mtime = _write_atomic(self.path, self._dump())
+            return
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self._delayed_write())
+
+    async def flush(self) -> None:
+        """Writes pending changes now (e.g. on shutdown)."""
+        task = self._save_task
+        if task is not None and not task.done():
+            # Only cut the delay short; a write that already started must land
+            if not self._write_lock.locked():
+                task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self._write()
+
+    async def _delayed_write(self) -> None:
+        await asyncio.sleep(CONFIG_SAVE_DELAY)
+        try:
+            await self._write()
+        except Exception as e:
+            logger.error(f"Failed to save {self.path.name}: {e}")
+
+    async def _write(self) -> None:
+        async with self._write_lock:
+            if not self._dirty:
+                return
+            # Serialize on the loop so the snapshot is consistent, write in a thread
+            payload = self._dump()
+            self._dirty = False
+            try:
+                self._mtime = await asyncio.to_thread(_write_atomic, self.path, payload)
+            except BaseException:
+                self._dirty = True
+                raise
+
+    def _dump(self) -> str:
+        return json.dumps(self._encode(self._data), ensure_ascii=False, indent=4)
+
+
+class ConfigStore:
+    """Groups the JSON files and runs the background reload check."""
+
+    def __init__(self, reload_interval: float = CONFIG_RELOAD_INTERVAL):
+        self.reload_interval = reload_interval
+        self._files: List[JsonFile] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, path: Path, default: Callable[[], Any], normalize: Optional[Callable[[Any], Any]] = None,
+                 encode: Optional[Callable[[Any], Any]] = None, on_change: Optional[Callable[[], None]] = None) -> JsonFile:
+        json_file = JsonFile(path, default, normalize, encode, on_change)
+        self._files.append(json_file)
+        return json_file
+
+    def start(self) -> None:
+        if self._task is None and self.reload_interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops the reload check and writes out any pending saves."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for json_file in self._files:
+            try:
+                await json_file.flush()
+            except Exception as e:
+                logger.error(f"Failed to save {json_file.path.name} on shutdown: {e}")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            for json_file in self._files:
+                try:
+                    mtime = await asyncio.to_thread(_mtime, json_file.path)
+                    if mtime is not None and mtime != json_file._mtime:
+                        await json_file.reload_if_changed()
+                except Exception as e:
+                    logger.error(f"Failed to check {json_file.path.name} for changes: {e}")
@@ -4,6 +4,7 @@ from datetime import datetime, timezone
 
 from sqlalchemy import (
     create_engine,
+    event,
     Column,
     Integer,
     String,
@@ -11,7 +12,10 @@ from sqlalchemy import (
     ForeignKey,
     DateTime,
     Text,
+    LargeBinary,
+    Index,
 )
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
 from sqlalchemy.sql import func
 
@@ -20,10 +24,55 @@ DB_FILE = "vpn_bot.db"
 # Use an absolute path to ensure the db file is always in the bot's root directory
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), DB_FILE)
 DATABASE_URL = f"sqlite:///{DB_PATH}"
+# Async driver (aiosqlite) used by the bot's handlers so DB I/O never blocks the event loop
+ASYNC_DATABASE_URL = f"sqlite+aiosqlite:///{DB_PATH}"
+
+# --- SQLite Tuning ---
+# "wal" lets readers run concurrently with the single writer. Set DB_JOURNAL_MODE=delete
+# to fall back to the classic rollback journal.
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "wal").upper()
+SQLITE_PRAGMAS = {
+    "journal_mode": DB_JOURNAL_MODE,
+    # NORMAL is safe in WAL mode and avoids an fsync on every commit
+    "synchronous": "NORMAL" if DB_JOURNAL_MODE == "WAL" else "FULL",
+    "cache_size": int(os.getenv("DB_CACHE_SIZE_KB", "20000")) * -1, # negative = KiB
+    "mmap_size": int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024))),
+    "busy_timeout": int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000")),
+    "temp_store": "MEMORY",
+    # Off by default in SQLite; needed for the ON DELETE CASCADE foreign keys
+    "foreign_keys": "ON",
+}
 
 # --- SQLAlchemy Setup ---
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+async_engine = create_async_engine(ASYNC_DATABASE_URL)
+# expire_on_commit=False keeps loaded attributes readable after commit without extra queries
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+
+def _apply_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+event.listen(engine, "connect", _apply_pragmas)
+
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def _on_async_connect(dbapi_connection, connection_record):
+    _apply_pragmas(dbapi_connection, connection_record)
+    # Let SQLAlchemy emit BEGIN itself so SAVEPOINTs work with the sqlite driver
+    # (the batching writer in db_utils relies on them).
+    dbapi_connection.isolation_level = None
+
+
+@event.listens_for(async_engine.sync_engine, "begin")
+def _on_async_begin(conn):
+    conn.exec_driver_sql("BEGIN")
+
 Base = declarative_base()
 
 
@@ -39,6 +88,7 @@ class User(Base):
     telegram_id = Column(Integer, unique=True, nullable=False, index=True)
     first_name = Column(String, nullable=False)
     username = Column(String, nullable=True)
+    is_blocked = Column(Boolean, default=False, nullable=False) # True once the user blocked the bot
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
@@ -67,6 +117,7 @@ class VpnPanel(Base):
     # --- Relationships ---
     # A panel can have many VPN accounts created on it
     accounts = relationship("VpnAccount", back_populates="panel")
+    plans = relationship("Plan", back_populates="panel")
 
     def __repr__(self):
         return f"<VpnPanel(id={self.id}, name='{self.name}', type='{self.panel_type}')>"
@@ -77,43 +128,218 @@ class VpnAccount(Base):
     __tablename__ = "vpn_accounts"
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    panel_id = Column(Integer, ForeignKey("vpn_panels.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    panel_id = Column(Integer, ForeignKey("vpn_panels.id"), nullable=False, index=True)
 
     panel_username = Column(String, nullable=False, index=True) # The username on the VPN panel (e.g., 'user_12345_abcd')
     friendly_name = Column(String, nullable=True) # A user-defined name like "My Phone VPN"
     
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    expires_at = Column(DateTime(timezone=True), nullable=True)
+    expires_at = Column(DateTime(timezone=True), nullable=True, index=True) # None = unlimited
+    data_limit_gb = Column(Integer, nullable=True) # 0 = unlimited, None = unknown (older accounts)
+    expiry_notified_at = Column(DateTime(timezone=True), nullable=True) # Set once the expiry reminder was sent
     
     # --- Relationships ---
     user = relationship("User", back_populates="accounts")
     panel = relationship("VpnPanel", back_populates="accounts")
 
+    __table_args__ = (
+        # Reminder scan: WHERE expiry_notified_at IS NULL AND expires_at BETWEEN ? AND ?
+        Index("ix_vpn_accounts_expiry_reminder", "expiry_notified_at", "expires_at"),
+    )
+
     def __repr__(self):
         return f"<VpnAccount(id={self.id}, user_id={self.user_id}, panel_username='{self.panel_username}')>"
 
 
+class AccountUsage(Base):
+    """
+    Local mirror of an account's status on its panel, refreshed by the usage
+    sync job, so account screens don't need the panel to be reachable.
+    """
+    __tablename__ = "account_usage"
+
+    account_id = Column(Integer, ForeignKey("vpn_accounts.id", ondelete="CASCADE"), primary_key=True)
+    used_traffic = Column(Integer, nullable=False, default=0) # Bytes
+    data_limit = Column(Integer, nullable=False, default=0) # Bytes, 0 = unlimited
+    expire = Column(Integer, nullable=True) # Unix timestamp, None/0 = unlimited
+    subscription_url = Column(String, nullable=True)
+    links = Column(Text, nullable=False, default="[]") # JSON list of connection links
+    synced_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return f"<AccountUsage(account_id={self.account_id}, used_traffic={self.used_traffic})>"
+
+
+class Plan(Base):
+    """
+    A plan offered for sale. Its services are created on one of the panels
+    in its pool (plan_panels), or on panel_id when the pool is empty.
+    """
+    __tablename__ = "plans"
+
+    id = Column(String, primary_key=True) # uuid4 string (the key used in the old plans.json)
+    name = Column(String, nullable=False)
+    panel_id = Column(Integer, ForeignKey("vpn_panels.id"), nullable=False, index=True)
+    price = Column(Integer, nullable=False, default=0) # Thousand Toman
+    data_limit_gb = Column(Integer, nullable=False, default=0)
+    duration_days = Column(Integer, nullable=False, default=0)
+    user_limit = Column(Integer, nullable=False, default=0) # 0 means unlimited
+    is_active = Column(Boolean, nullable=False, default=True) # Inactive plans are hidden from the shop
+    sort_order = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    # --- Relationships ---
+    panel = relationship("VpnPanel", back_populates="plans")
+
+    __table_args__ = (
+        # The shop lists active plans in display order
+        Index("ix_plans_is_active_sort_order", "is_active", "sort_order"),
+    )
+
+    def __repr__(self):
+        return f"<Plan(id='{self.id}', name='{self.name}', panel_id={self.panel_id})>"
+
+
+class PlanPanel(Base):
+    """A panel in a plan's pool; each order is placed on the best one at confirmation time."""
+    __tablename__ = "plan_panels"
+
+    plan_id = Column(String, ForeignKey("plans.id", ondelete="CASCADE"), primary_key=True)
+    panel_id = Column(Integer, ForeignKey("vpn_panels.id", ondelete="CASCADE"), primary_key=True, index=True)
+
+    def __repr__(self):
+        return f"<PlanPanel(plan_id='{self.plan_id}', panel_id={self.panel_id})>"
+
+
 class Order(Base):
     """Stores information about a user's purchase order."""
     __tablename__ = "orders"
 
     id = Column(Integer, primary_key=True)
     tracking_code = Column(String, unique=True, nullable=False, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    plan_id = Column(String, nullable=False) # The ID from the plans.json file
-    status = Column(String, default="pending") # pending, confirmed, rejected, failed
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    plan_id = Column(String, ForeignKey("plans.id"), nullable=False, index=True)
+    status = Column(String, default="pending") # pending, provisioning, confirmed, rejected, failed
     
     # Store message IDs as a JSON string to handle multiple admins
     admin_message_ids = Column(Text, nullable=True, default='{}') 
     
+    price = Column(Integer, nullable=True, default=0) # Plan price (thousand Toman) at order time
     processed_by = Column(String, nullable=True) # Admin's name who processed the order
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
     # --- Relationships ---
     user = relationship("User", back_populates="orders")
+    plan = relationship("Plan")
+
+    __table_args__ = (
+        # Pending-order lookups: WHERE status = ? ORDER BY created_at
+        Index("ix_orders_status_created_at", "status", "created_at"),
+    )
 
     def __repr__(self):
         return f"<Order(id={self.id}, tracking_code='{self.tracking_code}', status='{self.status}')>"
 
+
+class ProvisioningJob(Base):
+    """
+    Creating the panel user for a confirmed order. Jobs are processed by the
+    provisioning workers and survive restarts. The panel username is fixed
+    when the job is created, so a retry never creates a second panel user.
+    """
+    __tablename__ = "provisioning_jobs"
+
+    id = Column(Integer, primary_key=True)
+    tracking_code = Column(String, ForeignKey("orders.tracking_code"), unique=True, nullable=False)
+    panel_username = Column(String, nullable=False)
+    idempotency_key = Column(String, unique=True, nullable=False) # "<tracking_code>:<panel_username>"
+    panel_id = Column(Integer, ForeignKey("vpn_panels.id"), nullable=True) # Target panel; None = the plan's panel
+    tried_panel_ids = Column(Text, nullable=False, default="[]") # JSON list of panels that failed in this round
+    failed_panel_ids = Column(Text, nullable=False, default="[]") # JSON list of panels that failed in any round (cleaned up on success)
+    status = Column(String, nullable=False, default="queued") # queued, running, done, failed
+    attempts = Column(Integer, nullable=False, default=1) # Current round over the plan's pool; fallback hops within a round don't count
+    next_attempt_at = Column(DateTime(timezone=True), nullable=False)
+    last_error = Column(Text, nullable=True)
+
+    # The admin who confirmed, and the receipt caption shown to all admins
+    admin_telegram_id = Column(Integer, nullable=True)
+    admin_name = Column(String, nullable=True)
+    admin_caption = Column(Text, nullable=True)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        # Workers pick the next due job: WHERE status = 'queued' ORDER BY next_attempt_at
+        Index("ix_provisioning_jobs_status_next_attempt_at", "status", "next_attempt_at"),
+    )
+
+    def __repr__(self):
+        return f"<ProvisioningJob(id={self.id}, tracking_code='{self.tracking_code}', status='{self.status}')>"
+
+
+class StatCounter(Base):
+    """
+    Incrementally maintained counters for the admin statistics screen.
+    Keys look like "users", "orders:pending", "revenue:plan:<plan_id>",
+    "revenue:day:<YYYY-MM-DD>" and "accounts:panel:<panel_id>".
+    """
+    __tablename__ = "bot_stats"
+
+    key = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<StatCounter(key='{self.key}', value={self.value})>"
+
+
+class Broadcast(Base):
+    """A broadcast campaign. Progress is saved so it can resume after a restart."""
+    __tablename__ = "broadcasts"
+
+    id = Column(Integer, primary_key=True)
+    # The admin's message that is copied to every user
+    from_chat_id = Column(Integer, nullable=False)
+    message_id = Column(Integer, nullable=False)
+    # Where live progress is shown to the admin
+    progress_chat_id = Column(Integer, nullable=True)
+    progress_message_id = Column(Integer, nullable=True)
+
+    status = Column(String, default="running", index=True) # running, finished
+    last_user_id = Column(Integer, default=0, nullable=False) # users.id cursor of the last finished chunk
+    sent = Column(Integer, default=0, nullable=False)
+    failed = Column(Integer, default=0, nullable=False)
+    blocked = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+    def __repr__(self):
+        return f"<Broadcast(id={self.id}, status='{self.status}', sent={self.sent})>"
+
+
+class ConversationState(Base):
+    """Persisted ConversationHandler state, so in-flight conversations survive a restart."""
+    __tablename__ = "conversation_states"
+
+    name = Column(String, primary_key=True) # ConversationHandler name
+    key = Column(String, primary_key=True) # JSON-encoded conversation key, e.g. "[chat_id, user_id]"
+    state = Column(Text, nullable=False) # JSON-encoded state
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<ConversationState(name='{self.name}', key='{self.key}', state={self.state})>"
+
+
+class PersistedData(Base):
+    """Pickled user_data/chat_data of the bot, one row per user or chat."""
+    __tablename__ = "persisted_data"
+
+    kind = Column(String, primary_key=True) # user, chat
+    key = Column(Integer, primary_key=True) # user/chat id
+    data = Column(LargeBinary, nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<PersistedData(kind='{self.kind}', key={self.key})>"
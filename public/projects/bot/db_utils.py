@@ -1,25 +1,145 @@
+import os
 import json
-from contextlib import contextmanager
-from typing import List, Optional, Dict
+import uuid
+import time
+import asyncio
+import logging
+from contextlib import contextmanager, asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional, Dict, Tuple
 
-from sqlalchemy.orm import Session
+from sqlalchemy import select, update, delete, func, text, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, selectinload
 from database_models import (
     Base,
     engine,
     SessionLocal,
+    async_engine,
+    AsyncSessionLocal,
     User,
     VpnPanel,
     VpnAccount,
+    AccountUsage,
     Order,
+    Plan,
+    PlanPanel,
+    ProvisioningJob,
+    StatCounter,
+    Broadcast,
 )
+from panel_manager import PanelConfig
+
+logger = logging.getLogger(__name__)
+
+# ===============================================================
+#   Schema Migrations
+#   create_all() only creates missing tables, so changes to existing
+#   tables ship as ordered migrations. The applied version is stored in
+#   SQLite's "PRAGMA user_version". Every migration must be idempotent,
+#   because on a fresh database create_all() has already built the
+#   latest schema before the migrations run.
+# ===============================================================
+
+def _table_columns(cursor, table: str) -> set:
+    return {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+
+def _add_column_if_missing(cursor, table: str, column: str, ddl: str) -> None:
+    """Adds a column unless it already exists (ALTER TABLE has no IF NOT EXISTS)."""
+    if column not in _table_columns(cursor, table):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+def _migration_1_indexes(cursor) -> None:
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_vpn_accounts_user_id ON vpn_accounts (user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_vpn_accounts_panel_id ON vpn_accounts (panel_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_vpn_accounts_expires_at ON vpn_accounts (expires_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_orders_user_id ON orders (user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_orders_status_created_at ON orders (status, created_at)")
+
+def _migration_2_stats(cursor) -> None:
+    _add_column_if_missing(cursor, "orders", "price", "INTEGER DEFAULT 0")
+    cursor.execute("CREATE TABLE IF NOT EXISTS bot_stats (key VARCHAR NOT NULL PRIMARY KEY, value INTEGER NOT NULL)")
+    for statement in STATS_REBUILD_SQL:
+        cursor.execute(statement)
+
+def _migration_3_broadcasts(cursor) -> None:
+    _add_column_if_missing(cursor, "users", "is_blocked", "BOOLEAN NOT NULL DEFAULT 0")
+
+def _migration_4_plans(cursor) -> None:
+    # The plans table itself is created by create_all()
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_orders_plan_id ON orders (plan_id)")
+
+def _migration_5_account_expiry(cursor) -> None:
+    _add_column_if_missing(cursor, "vpn_accounts", "data_limit_gb", "INTEGER")
+    _add_column_if_missing(cursor, "vpn_accounts", "expiry_notified_at", "DATETIME")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_vpn_accounts_expiry_reminder ON vpn_accounts (expiry_notified_at, expires_at)")
+
+def _migration_6_panel_pools(cursor) -> None:
+    # The plan_panels table itself is created by create_all()
+    _add_column_if_missing(cursor, "provisioning_jobs", "panel_id", "INTEGER REFERENCES vpn_panels (id)")
+    _add_column_if_missing(cursor, "provisioning_jobs", "tried_panel_ids", "TEXT NOT NULL DEFAULT '[]'")
+
+def _migration_7_provisioning_rounds(cursor) -> None:
+    _add_column_if_missing(cursor, "provisioning_jobs", "failed_panel_ids", "TEXT NOT NULL DEFAULT '[]'")
+    cursor.execute("UPDATE provisioning_jobs SET failed_panel_ids = tried_panel_ids WHERE failed_panel_ids = '[]'")
+    # attempts used to be raised by every claim; it now starts at 1 and counts rounds
+    cursor.execute("UPDATE provisioning_jobs SET attempts = 1 WHERE attempts < 1")
+
+# (version, description, function(cursor)) in ascending order
+MIGRATIONS = [
+    (1, "Indexes for account/order lookups", _migration_1_indexes),
+    (2, "Order price and incremental statistics", _migration_2_stats),
+    (3, "Blocked-user flag for broadcasts", _migration_3_broadcasts),
+    (4, "Plans table", _migration_4_plans),
+    (5, "Account expiry, data limit and reminder marker", _migration_5_account_expiry),
+    (6, "Panel pools for plans", _migration_6_panel_pools),
+    (7, "Provisioning rounds and failed panels", _migration_7_provisioning_rounds),
+]
+
+def get_schema_version() -> int:
+    with engine.connect() as conn:
+        return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+def run_migrations() -> int:
+    """Applies all pending migrations, each in its own transaction. Returns the new version."""
+    raw = engine.raw_connection()
+    dbapi_connection = raw.driver_connection
+    isolation_level = dbapi_connection.isolation_level
+    try:
+        dbapi_connection.isolation_level = None # we issue BEGIN/COMMIT ourselves
+        cursor = dbapi_connection.cursor()
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        for target, description, migrate in MIGRATIONS:
+            if target <= version:
+                continue
+            logger.info(f"Applying DB migration {target}: {description}")
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                migrate(cursor)
+                cursor.execute(f"PRAGMA user_version = {int(target)}")
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            version = target
+        cursor.close()
+        return version
+    finally:
+        # The connection goes back to the pool, so restore the driver's default
+        dbapi_connection.isolation_level = isolation_level
+        raw.close()
 
 # ===============================================================
 #   Database Initialization & Session Management
 # ===============================================================
 
 def init_db():
-    """Creates all database tables if they don't exist."""
+    """Creates missing tables and brings the schema up to the latest version."""
     Base.metadata.create_all(bind=engine)
+    run_migrations()
 
 
 @contextmanager
@@ -35,6 +155,334 @@ def get_db():
         db.close()
 
 
+@asynccontextmanager
+async def get_async_db() -> AsyncIterator[AsyncSession]:
+    """Async counterpart of get_db(), backed by the aiosqlite driver."""
+    db = AsyncSessionLocal()
+    try:
+        yield db
+    except Exception:
+        await db.rollback()
+        raise
+    finally:
+        await db.close()
+
+
+async def dispose_async_engine():
+    """Closes all pooled async connections. Call this on application shutdown."""
+    await async_engine.dispose()
+
+
+# ===============================================================
+#   Batching Writer
+#   All writes from the bot go through one writer task. It groups the
+#   writes that arrive within a short window into a single transaction
+#   (one fsync), each isolated in its own SAVEPOINT so a failing write
+#   does not take the rest of the batch down with it.
+# ===============================================================
+
+WRITE_BATCH_MAX = int(os.getenv("DB_WRITE_BATCH_MAX", "100"))
+# Max time (seconds) a write may wait for others to join its batch
+WRITE_BATCH_WINDOW = float(os.getenv("DB_WRITE_BATCH_WINDOW", "0.01"))
+
+WriteFn = Callable[[AsyncSession], Awaitable[Any]]
+
+
+class DbWriter:
+    """Owns the single write connection and commits queued writes in batches."""
+
+    def __init__(self, batch_max: int = WRITE_BATCH_MAX, batch_window: float = WRITE_BATCH_WINDOW):
+        self.batch_max = batch_max
+        self.batch_window = batch_window
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"writes": 0, "batches": 0, "failed": 0}
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Commits everything still queued, then stops the writer."""
+        if not self.running:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def submit(self, fn: WriteFn) -> Any:
+        """Queues a write and waits until its batch has been committed."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((fn, future))
+        return await future
+
+    async def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.batch_max:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._commit_batch(batch)
+
+    async def _commit_batch(self, batch: List[Tuple[WriteFn, asyncio.Future]]) -> None:
+        results = []
+        try:
+            async with AsyncSessionLocal() as db:
+                for fn, future in batch:
+                    try:
+                        async with db.begin_nested():
+                            results.append((future, await fn(db), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+                await db.commit()
+        except Exception as e:
+            logger.error(f"DB writer failed to commit a batch of {len(batch)} writes: {e}")
+            results = [(future, None, e) for _, future in batch]
+
+        self.stats["batches"] += 1
+        for future, result, error in results:
+            self.stats["writes"] += 1
+            if future.done():
+                continue
+            if error is not None:
+                self.stats["failed"] += 1
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+db_writer = DbWriter()
+
+
+async def run_write(fn: WriteFn) -> Any:
+    """
+    Runs a write (an async function taking a session) through the batching
+    writer. Without a running writer (e.g. in scripts) it is committed directly.
+    """
+    if db_writer.running:
+        return await db_writer.submit(fn)
+    async with get_async_db() as db:
+        result = await fn(db)
+        await db.commit()
+        return result
+
+
+# ===============================================================
+#   Statistics
+#   Counters in the bot_stats table are updated in the same transaction
+#   as the writes that change them, so reading the stats screen never
+#   scans users/orders/vpn_accounts. rebuild_stats() recomputes them.
+# ===============================================================
+
+# Recomputes every counter from scratch (also used by migration 2)
+STATS_REBUILD_SQL = [
+    "DELETE FROM bot_stats",
+    "INSERT INTO bot_stats (key, value) SELECT 'users', COUNT(*) FROM users",
+    "INSERT INTO bot_stats (key, value) SELECT 'orders:' || status, COUNT(*) FROM orders GROUP BY status",
+    "INSERT INTO bot_stats (key, value) SELECT 'revenue:plan:' || plan_id, SUM(COALESCE(price, 0)) "
+    "FROM orders WHERE status = 'confirmed' GROUP BY plan_id",
+    "INSERT INTO bot_stats (key, value) SELECT 'revenue:day:' || date(created_at), SUM(COALESCE(price, 0)) "
+    "FROM orders WHERE status = 'confirmed' GROUP BY date(created_at)",
+    "INSERT INTO bot_stats (key, value) SELECT 'accounts:panel:' || panel_id, COUNT(*) FROM vpn_accounts GROUP BY panel_id",
+]
+
+def _day_key(created_at: Optional[datetime]) -> str:
+    day = (created_at or datetime.now(timezone.utc)).date()
+    return f"revenue:day:{day.isoformat()}"
+
+def _stats_upsert(deltas: Dict[str, int]):
+    stmt = sqlite_insert(StatCounter).values([{"key": k, "value": v} for k, v in deltas.items()])
+    return stmt.on_conflict_do_update(
+        index_elements=[StatCounter.key],
+        set_={"value": StatCounter.value + stmt.excluded.value},
+    )
+
+def _order_status_deltas(order: Order, old_status: Optional[str], new_status: str) -> Dict[str, int]:
+    """Counter changes caused by moving an order from old_status to new_status."""
+    if old_status == new_status:
+        return {}
+    deltas = {f"orders:{new_status}": 1}
+    if old_status is not None:
+        deltas[f"orders:{old_status}"] = -1
+    price = order.price or 0
+    if price and "confirmed" in (old_status, new_status):
+        sign = 1 if new_status == "confirmed" else -1
+        deltas[f"revenue:plan:{order.plan_id}"] = sign * price
+        deltas[_day_key(order.created_at)] = sign * price
+    return deltas
+
+def bump_stats(db: Session, deltas: Dict[str, int]) -> None:
+    """Adds deltas to counters inside the caller's transaction."""
+    if deltas:
+        db.execute(_stats_upsert(deltas))
+
+async def bump_stats_async(db: AsyncSession, deltas: Dict[str, int]) -> None:
+    """Async version of bump_stats()."""
+    if deltas:
+        await db.execute(_stats_upsert(deltas))
+
+def rebuild_stats(db: Session) -> None:
+    """Recomputes all counters from the underlying tables."""
+    for statement in STATS_REBUILD_SQL:
+        db.execute(text(statement))
+    db.commit()
+
+async def rebuild_stats_async(db: AsyncSession) -> None:
+    """Async version of rebuild_stats(); run it through run_write()."""
+    for statement in STATS_REBUILD_SQL:
+        await db.execute(text(statement))
+
+async def get_stats_async(db: AsyncSession, days: int = 7) -> Dict[str, int]:
+    """
+    Reads the counters for the stats screen: every non-daily counter plus
+    the daily revenue of the last `days` days.
+    """
+    today = datetime.now(timezone.utc).date()
+    day_keys = [f"revenue:day:{(today - timedelta(days=i)).isoformat()}" for i in range(days)]
+    result = await db.execute(
+        select(StatCounter.key, StatCounter.value).where(
+            ~StatCounter.key.like("revenue:day:%") | StatCounter.key.in_(day_keys)
+        )
+    )
+    return dict(result.all())
+
+
+# ===============================================================
+#   Known-User Cache (write-behind)
+#   Keeps every known telegram_id (and a fingerprint of its profile) in
+#   memory so /start makes no DB round trip for returning users. New or
+#   changed users are queued and upserted in batches.
+# ===============================================================
+
+USER_FLUSH_INTERVAL = float(os.getenv("DB_USER_FLUSH_INTERVAL", "1"))
+USER_FLUSH_BATCH = int(os.getenv("DB_USER_FLUSH_BATCH", "500"))
+
+
+class KnownUserCache:
+    """In-memory set of known users with a batched upsert queue."""
+
+    def __init__(self, flush_interval: float = USER_FLUSH_INTERVAL, flush_batch: int = USER_FLUSH_BATCH):
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        # telegram_id -> hash of (first_name, username)
+        self._known: Dict[int, int] = {}
+        # telegram_id -> (first_name, username) waiting to be written
+        self._pending: Dict[int, Tuple[str, Optional[str]]] = {}
+        self._task: Optional[asyncio.Task] = None
+        # A flush started early because the batch filled up
+        self._batch_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    async def warm(self) -> None:
+        """
+        Loads all known users from the database. Users who blocked the bot are
+        left out, so their next /start is written again and clears the flag.
+        """
+        async with get_async_db() as db:
+            result = await db.stream(
+                select(User.telegram_id, User.first_name, User.username).where(User.is_blocked == False)
+            )
+            async for telegram_id, first_name, username in result:
+                self._known[telegram_id] = hash((first_name, username))
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops the flush loop and writes out everything still queued."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._batch_task is not None:
+            # Its errors are logged by _batch_flush_done; whatever it put back is written below
+            await asyncio.gather(self._batch_task, return_exceptions=True)
+            self._batch_task = None
+        await self.flush()
+
+    def touch(self, telegram_id: int, first_name: str, username: Optional[str]) -> None:
+        """Records a user; only new or changed users are queued for writing."""
+        fingerprint = hash((first_name, username))
+        if self._known.get(telegram_id) == fingerprint:
+            return
+        self._known[telegram_id] = fingerprint
+        self._pending[telegram_id] = (first_name, username)
+        if len(self._pending) >= self.flush_batch and self._task is not None:
+            if self._batch_task is None or self._batch_task.done():
+                self._batch_task = asyncio.create_task(self.flush())
+                self._batch_task.add_done_callback(self._batch_flush_done)
+
+    @staticmethod
+    def _batch_flush_done(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Failed to flush known users: {task.exception()}")
+
+    def forget(self, telegram_ids: List[int]) -> None:
+        """
+        Drops users from the cache (e.g. after they blocked the bot), so their
+        next /start is written again and clears the blocked flag.
+        """
+        for telegram_id in telegram_ids:
+            self._known.pop(telegram_id, None)
+
+    async def ensure_flushed(self, telegram_id: int) -> None:
+        """Makes sure a queued user has been written, e.g. before creating an order."""
+        if telegram_id in self._pending:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        async with self._flush_lock:
+            rows = [
+                {"telegram_id": tid, "first_name": first_name, "username": username}
+                for tid, (first_name, username) in self._pending.items()
+            ]
+            pending, self._pending = self._pending, {}
+            if rows:
+                try:
+                    await run_write(lambda db: upsert_users_async(db, rows))
+                except BaseException:
+                    # Put the batch back unless a newer profile for the same user arrived meanwhile
+                    for telegram_id, profile in pending.items():
+                        self._pending.setdefault(telegram_id, profile)
+                    raise
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush known users: {e}")
+
+
+known_users = KnownUserCache()
+
+
 # ===============================================================
 #   User Functions
 # ===============================================================
@@ -52,6 +500,7 @@ def get_or_create_user(db: Session, telegram_id: int, first_name: str, username:
             username=username
         )
         db.add(user)
+        bump_stats(db, {"users": 1})
         db.commit()
         db.refresh(user)
     return user
@@ -90,6 +539,8 @@ def delete_panel_by_id(db: Session, panel_id: int) -> bool:
     """Deletes a panel by its ID."""
     panel = db.query(VpnPanel).filter(VpnPanel.id == panel_id).first()
     if panel:
+        # Jobs aimed at this panel fall back to their plan's panel
+        db.execute(update(ProvisioningJob).where(ProvisioningJob.panel_id == panel_id).values(panel_id=None))
         db.delete(panel)
         db.commit()
         return True
@@ -99,7 +550,8 @@ def delete_panel_by_id(db: Session, panel_id: int) -> bool:
 #   VPN Account Functions
 # ===============================================================
 
-def create_vpn_account(db: Session, user_telegram_id: int, panel_id: int, panel_username: str, friendly_name: str) -> VpnAccount:
+def create_vpn_account(db: Session, user_telegram_id: int, panel_id: int, panel_username: str, friendly_name: str,
+                       expires_at: Optional[datetime] = None, data_limit_gb: Optional[int] = None) -> VpnAccount:
     """Creates a new VPN account for a user."""
     user = db.query(User).filter(User.telegram_id == user_telegram_id).first()
     if not user:
@@ -109,9 +561,12 @@ def create_vpn_account(db: Session, user_telegram_id: int, panel_id: int, panel_
         user_id=user.id,
         panel_id=panel_id,
         panel_username=panel_username,
-        friendly_name=friendly_name
+        friendly_name=friendly_name,
+        expires_at=expires_at,
+        data_limit_gb=data_limit_gb,
     )
     db.add(new_account)
+    bump_stats(db, {f"accounts:panel:{panel_id}": 1})
     db.commit()
     db.refresh(new_account)
     return new_account
@@ -129,7 +584,7 @@ def get_account_by_id(db: Session, account_id: int) -> Optional[VpnAccount]:
 #   Order Functions
 # ===============================================================
 
-def create_order(db: Session, tracking_code: str, user_telegram_id: int, plan_id: str, admin_message_ids: Dict[str, int]) -> Order:
+def create_order(db: Session, tracking_code: str, user_telegram_id: int, plan_id: str, admin_message_ids: Dict[str, int], price: int = 0) -> Order:
     """Creates a new order in the database."""
     user = db.query(User).filter(User.telegram_id == user_telegram_id).first()
     if not user:
@@ -140,9 +595,11 @@ def create_order(db: Session, tracking_code: str, user_telegram_id: int, plan_id
         user_id=user.id,
         plan_id=plan_id,
         admin_message_ids=json.dumps(admin_message_ids), # Serialize dict to JSON string
-        status="pending"
+        status="pending",
+        price=price
     )
     db.add(new_order)
+    bump_stats(db, {"orders:pending": 1})
     db.commit()
     db.refresh(new_order)
     return new_order
@@ -151,13 +608,793 @@ def get_order_by_tracking_code(db: Session, tracking_code: str) -> Optional[Orde
     """Finds an order by its unique tracking code."""
     return db.query(Order).filter(Order.tracking_code == tracking_code).first()
 
-def update_order_status(db: Session, tracking_code: str, status: str, admin_name: str) -> Optional[Order]:
-    """Updates the status and processed_by field of an order."""
+def update_order_status(db: Session, tracking_code: str, status: str, admin_name: str, expected_status: str = "pending") -> Optional[Order]:
+    """
+    Updates the status and processed_by field of an order, but only if it is
+    still in expected_status (compare-and-set). Returns None if it was not,
+    e.g. because another admin decided first.
+    """
+    result = db.execute(
+        update(Order)
+        .where(Order.tracking_code == tracking_code, Order.status == expected_status)
+        .values(status=status, processed_by=admin_name)
+    )
+    if result.rowcount == 0:
+        db.rollback()
+        return None
     order = db.query(Order).filter(Order.tracking_code == tracking_code).first()
-    if order:
-        order.status = status
-        order.processed_by = admin_name
-        db.commit()
-        db.refresh(order)
+    bump_stats(db, _order_status_deltas(order, expected_status, status))
+    db.commit()
+    db.refresh(order)
+    return order
+
+
+# ===============================================================
+#   Async API
+#   Same helpers as above for use inside the bot's async handlers.
+#   Related rows that handlers read are loaded eagerly, because lazy
+#   loading is not available on async sessions.
+#   Write helpers only flush; run them through run_write() so they are
+#   committed by the batching writer.
+# ===============================================================
+
+async def _get_user_by_telegram_id_async(db: AsyncSession, telegram_id: int) -> Optional[User]:
+    result = await db.execute(select(User).where(User.telegram_id == telegram_id))
+    return result.scalars().first()
+
+async def get_or_create_user_async(db: AsyncSession, telegram_id: int, first_name: str, username: Optional[str]) -> User:
+    """Async version of get_or_create_user()."""
+    user = await _get_user_by_telegram_id_async(db, telegram_id)
+    if not user:
+        user = User(
+            telegram_id=telegram_id,
+            first_name=first_name,
+            username=username
+        )
+        db.add(user)
+        await bump_stats_async(db, {"users": 1})
+        await db.flush()
+    return user
+
+async def upsert_users_async(db: AsyncSession, rows: List[Dict]) -> None:
+    """
+    Inserts users in one statement; existing users get their first_name and
+    username updated (INSERT ... ON CONFLICT DO UPDATE).
+    """
+    existing = await db.execute(
+        select(func.count()).select_from(User).where(User.telegram_id.in_([r["telegram_id"] for r in rows]))
+    )
+    await bump_stats_async(db, {"users": len(rows) - existing.scalar()})
+
+    stmt = sqlite_insert(User).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.telegram_id],
+        set_={
+            "first_name": stmt.excluded.first_name,
+            "username": stmt.excluded.username,
+            # The user is talking to the bot again, so they are no longer blocked
+            "is_blocked": False,
+            "updated_at": func.now(),
+        },
+    )
+    await db.execute(stmt)
+
+async def get_all_users_async(db: AsyncSession) -> List[User]:
+    """Async version of get_all_users()."""
+    result = await db.execute(select(User))
+    return list(result.scalars().all())
+
+async def create_panel_async(db: AsyncSession, name: str, panel_type: str, api_url: str, api_token: str) -> VpnPanel:
+    """Async version of create_panel()."""
+    new_panel = VpnPanel(
+        name=name,
+        panel_type=panel_type,
+        api_url=api_url,
+        api_token=api_token
+    )
+    db.add(new_panel)
+    await db.flush()
+    return new_panel
+
+async def get_all_panels_async(db: AsyncSession) -> List[VpnPanel]:
+    """Async version of get_all_panels()."""
+    result = await db.execute(select(VpnPanel).where(VpnPanel.is_active == True))
+    return list(result.scalars().all())
+
+async def get_panel_by_id_async(db: AsyncSession, panel_id: int) -> Optional[VpnPanel]:
+    """Async version of get_panel_by_id()."""
+    return await db.get(VpnPanel, panel_id)
+
+async def delete_panel_by_id_async(db: AsyncSession, panel_id: int) -> bool:
+    """Async version of delete_panel_by_id()."""
+    panel = await db.get(VpnPanel, panel_id)
+    if panel:
+        await db.execute(update(ProvisioningJob).where(ProvisioningJob.panel_id == panel_id).values(panel_id=None))
+        await db.delete(panel)
+        await db.flush()
+        return True
+    return False
+
+async def create_vpn_account_async(db: AsyncSession, user_telegram_id: int, panel_id: int, panel_username: str, friendly_name: str,
+                                   expires_at: Optional[datetime] = None, data_limit_gb: Optional[int] = None) -> VpnAccount:
+    """Async version of create_vpn_account()."""
+    user = await _get_user_by_telegram_id_async(db, user_telegram_id)
+    if not user:
+        raise ValueError(f"User with Telegram ID {user_telegram_id} not found.")
+
+    new_account = VpnAccount(
+        user_id=user.id,
+        panel_id=panel_id,
+        panel_username=panel_username,
+        friendly_name=friendly_name,
+        expires_at=expires_at,
+        data_limit_gb=data_limit_gb,
+    )
+    db.add(new_account)
+    await bump_stats_async(db, {f"accounts:panel:{panel_id}": 1})
+    await db.flush()
+    return new_account
+
+async def get_user_accounts_async(db: AsyncSession, user_telegram_id: int) -> List[VpnAccount]:
+    """Async version of get_user_accounts(). Each account's panel is loaded too."""
+    result = await db.execute(
+        select(VpnAccount)
+        .join(User)
+        .where(User.telegram_id == user_telegram_id)
+        .options(selectinload(VpnAccount.panel))
+    )
+    return list(result.scalars().all())
+
+async def get_account_by_id_async(db: AsyncSession, account_id: int) -> Optional[VpnAccount]:
+    """Async version of get_account_by_id(). The account's user and panel are loaded too."""
+    result = await db.execute(
+        select(VpnAccount)
+        .where(VpnAccount.id == account_id)
+        .options(selectinload(VpnAccount.user), selectinload(VpnAccount.panel))
+    )
+    return result.scalars().first()
+
+async def create_order_async(db: AsyncSession, tracking_code: str, user_telegram_id: int, plan_id: str, admin_message_ids: Dict[str, int], price: int = 0) -> Order:
+    """Async version of create_order()."""
+    user = await _get_user_by_telegram_id_async(db, user_telegram_id)
+    if not user:
+        raise ValueError(f"User with Telegram ID {user_telegram_id} not found.")
+
+    new_order = Order(
+        tracking_code=tracking_code,
+        user_id=user.id,
+        plan_id=plan_id,
+        admin_message_ids=json.dumps(admin_message_ids), # Serialize dict to JSON string
+        status="pending",
+        price=price
+    )
+    db.add(new_order)
+    await bump_stats_async(db, {"orders:pending": 1})
+    await db.flush()
+    return new_order
+
+async def get_order_by_tracking_code_async(db: AsyncSession, tracking_code: str) -> Optional[Order]:
+    """Async version of get_order_by_tracking_code(). The order's user is loaded too."""
+    result = await db.execute(
+        select(Order)
+        .where(Order.tracking_code == tracking_code)
+        .options(selectinload(Order.user))
+    )
+    return result.scalars().first()
+
+async def update_order_status_async(db: AsyncSession, tracking_code: str, status: str, admin_name: str, expected_status: str = "pending") -> Optional[Order]:
+    """Async version of update_order_status() (compare-and-set on expected_status)."""
+    result = await db.execute(
+        update(Order)
+        .where(Order.tracking_code == tracking_code, Order.status == expected_status)
+        .values(status=status, processed_by=admin_name)
+    )
+    if result.rowcount == 0:
+        return None
+    order = await db.scalar(select(Order).where(Order.tracking_code == tracking_code))
+    await bump_stats_async(db, _order_status_deltas(order, expected_status, status))
+    await db.flush()
     return order
 
+async def add_order_admin_message_async(db: AsyncSession, tracking_code: str, admin_id: int, message_id: int) -> Optional[str]:
+    """
+    Records the receipt message sent to one admin. Called as soon as that
+    message is sent, so a decision made while other admins are still being
+    notified can already update it. Returns the order's status, so the
+    sender can tell whether it was decided before the id was stored.
+    """
+    await db.execute(
+        update(Order)
+        .where(Order.tracking_code == tracking_code)
+        .values(admin_message_ids=func.json_set(func.coalesce(Order.admin_message_ids, "{}"), f'$."{admin_id}"', message_id))
+    )
+    return await db.scalar(select(Order.status).where(Order.tracking_code == tracking_code))
+
+async def get_order_admin_messages_async(db: AsyncSession, tracking_code: str) -> Dict[str, int]:
+    """The receipt message ids stored so far, by admin id."""
+    value = await db.scalar(select(Order.admin_message_ids).where(Order.tracking_code == tracking_code))
+    return json.loads(value or "{}")
+
+
+# ===============================================================
+#   Screen Queries
+#   Each function loads exactly the rows one screen needs in a single
+#   round trip and returns plain, immutable objects that are safe to
+#   use after the session has been closed.
+# ===============================================================
+
+@dataclass(frozen=True)
+class AccountUsageView:
+    used_traffic: int
+    data_limit: int
+    expire: Optional[int]
+    subscription_url: Optional[str]
+    links: Tuple[str, ...]
+    synced_at: datetime # UTC
+
+
+@dataclass(frozen=True)
+class AccountView:
+    id: int
+    friendly_name: Optional[str]
+    panel_username: str
+    user_telegram_id: int
+    expires_at: Optional[datetime]
+    panel: PanelConfig
+    usage: Optional[AccountUsageView] # None until the first sync
+
+
+@dataclass(frozen=True)
+class OrderView:
+    id: int
+    tracking_code: str
+    plan_id: str
+    status: str
+    user_telegram_id: int
+    admin_message_ids: Dict[str, int]
+    plan: Optional["PlanView"] # None if the plan no longer exists
+
+
+_ACCOUNT_VIEW_COLUMNS = (
+    VpnAccount.id,
+    VpnAccount.friendly_name,
+    VpnAccount.panel_username,
+    User.telegram_id,
+    VpnAccount.expires_at,
+    VpnPanel.id,
+    VpnPanel.name,
+    VpnPanel.panel_type,
+    VpnPanel.api_url,
+    VpnPanel.api_token,
+    AccountUsage.used_traffic,
+    AccountUsage.data_limit,
+    AccountUsage.expire,
+    AccountUsage.subscription_url,
+    AccountUsage.links,
+    AccountUsage.synced_at,
+)
+
+def _account_usage_view(row) -> Optional[AccountUsageView]:
+    if row[15] is None:
+        return None
+    synced_at = row[15] if row[15].tzinfo else row[15].replace(tzinfo=timezone.utc)
+    return AccountUsageView(
+        used_traffic=row[10] or 0,
+        data_limit=row[11] or 0,
+        expire=row[12],
+        subscription_url=row[13],
+        links=tuple(json.loads(row[14] or "[]")),
+        synced_at=synced_at,
+    )
+
+def _account_view(row) -> AccountView:
+    return AccountView(
+        id=row[0],
+        friendly_name=row[1],
+        panel_username=row[2],
+        user_telegram_id=row[3],
+        expires_at=row[4],
+        panel=PanelConfig(id=row[5], name=row[6], panel_type=row[7], api_url=row[8], api_token=row[9]),
+        usage=_account_usage_view(row),
+    )
+
+async def get_account_overviews_async(db: AsyncSession, user_telegram_id: int) -> List[AccountView]:
+    """All accounts of a user with their panels, for the "my accounts" screen."""
+    result = await db.execute(
+        select(*_ACCOUNT_VIEW_COLUMNS)
+        .join(User, VpnAccount.user_id == User.id)
+        .join(VpnPanel, VpnAccount.panel_id == VpnPanel.id)
+        .outerjoin(AccountUsage, AccountUsage.account_id == VpnAccount.id)
+        .where(User.telegram_id == user_telegram_id)
+        .order_by(VpnAccount.id)
+    )
+    return [_account_view(row) for row in result.all()]
+
+async def get_owned_account_async(db: AsyncSession, account_id: int, user_telegram_id: int) -> Optional[AccountView]:
+    """A single account with its panel, only if it belongs to the given user."""
+    result = await db.execute(
+        select(*_ACCOUNT_VIEW_COLUMNS)
+        .join(User, VpnAccount.user_id == User.id)
+        .join(VpnPanel, VpnAccount.panel_id == VpnPanel.id)
+        .outerjoin(AccountUsage, AccountUsage.account_id == VpnAccount.id)
+        .where(VpnAccount.id == account_id, User.telegram_id == user_telegram_id)
+    )
+    row = result.first()
+    return _account_view(row) if row else None
+
+async def get_order_view_async(db: AsyncSession, tracking_code: str) -> Optional[OrderView]:
+    """An order together with its user's Telegram ID and its plan, for the admin decision flow."""
+    result = await db.execute(
+        select(Order.id, Order.tracking_code, Order.plan_id, Order.status, User.telegram_id, Order.admin_message_ids, Plan)
+        .join(User, Order.user_id == User.id)
+        .outerjoin(Plan, Order.plan_id == Plan.id)
+        .where(Order.tracking_code == tracking_code)
+    )
+    row = result.first()
+    if not row:
+        return None
+    plan = None
+    if row[6] is not None:
+        pool = list(await db.scalars(select(PlanPanel.panel_id).where(PlanPanel.plan_id == row[2])))
+        plan = _plan_view(row[6], pool)
+    return OrderView(
+        id=row[0],
+        tracking_code=row[1],
+        plan_id=row[2],
+        status=row[3],
+        user_telegram_id=row[4],
+        admin_message_ids=json.loads(row[5] or "{}"),
+        plan=plan,
+    )
+
+
+# ===============================================================
+#   Plans
+#   Plans are read on almost every user screen but change only when an
+#   admin edits them, so all of them are kept in a read-through cache.
+#   Call plan_cache.invalidate() after a plan write has been committed.
+# ===============================================================
+
+@dataclass(frozen=True)
+class PlanView:
+    id: str
+    name: str
+    panel_id: int
+    price: int
+    data_limit_gb: int
+    duration_days: int
+    user_limit: int
+    is_active: bool
+    sort_order: int
+    pool: Tuple[int, ...] # Panels orders may be placed on; (panel_id,) without a pool
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The plan in the dict form the panel handlers expect."""
+        return {
+            "name": self.name,
+            "panel_id": self.panel_id,
+            "price": self.price,
+            "data_limit_gb": self.data_limit_gb,
+            "duration_days": self.duration_days,
+            "user_limit": self.user_limit,
+        }
+
+
+def _plan_view(plan: Plan, pool: List[int]) -> PlanView:
+    return PlanView(
+        id=plan.id,
+        name=plan.name,
+        panel_id=plan.panel_id,
+        price=plan.price or 0,
+        data_limit_gb=plan.data_limit_gb or 0,
+        duration_days=plan.duration_days or 0,
+        user_limit=plan.user_limit or 0,
+        is_active=bool(plan.is_active),
+        sort_order=plan.sort_order or 0,
+        pool=tuple(sorted(pool)) or (plan.panel_id,),
+    )
+
+
+class PlanCache:
+    """All plans (including inactive ones, which old orders still refer to), in display order."""
+
+    def __init__(self):
+        self._plans: Optional[Dict[str, PlanView]] = None
+        self._generation = 0
+        self._lock = asyncio.Lock()
+
+    async def _load(self) -> Dict[str, PlanView]:
+        plans = self._plans
+        if plans is not None:
+            return plans
+        async with self._lock:
+            if self._plans is None:
+                generation = self._generation
+                async with get_async_db() as db:
+                    pools: Dict[str, List[int]] = {}
+                    for plan_id, panel_id in (await db.execute(select(PlanPanel.plan_id, PlanPanel.panel_id))).all():
+                        pools.setdefault(plan_id, []).append(panel_id)
+                    result = await db.execute(select(Plan).order_by(Plan.sort_order, Plan.created_at))
+                    loaded = {plan.id: _plan_view(plan, pools.get(plan.id, [])) for plan in result.scalars()}
+                # Don't keep a result that an invalidate() during the load has made stale
+                if generation != self._generation:
+                    return loaded
+                self._plans = loaded
+            return self._plans
+
+    async def get(self, plan_id: str) -> Optional[PlanView]:
+        return (await self._load()).get(plan_id)
+
+    async def get_all(self) -> List[PlanView]:
+        return list((await self._load()).values())
+
+    async def get_active(self) -> List[PlanView]:
+        return [plan for plan in (await self._load()).values() if plan.is_active]
+
+    def invalidate(self) -> None:
+        self._generation += 1
+        self._plans = None
+
+
+plan_cache = PlanCache()
+
+
+async def create_plan_async(db: AsyncSession, name: str, panel_id: int, price: int, data_limit_gb: int,
+                            duration_days: int, user_limit: int, plan_id: Optional[str] = None) -> Plan:
+    """Adds a plan at the end of the display order."""
+    last_position = await db.scalar(select(func.max(Plan.sort_order)))
+    plan = Plan(
+        id=plan_id or str(uuid.uuid4()),
+        name=name,
+        panel_id=panel_id,
+        price=price,
+        data_limit_gb=data_limit_gb,
+        duration_days=duration_days,
+        user_limit=user_limit,
+        sort_order=(last_position or 0) + 1,
+    )
+    db.add(plan)
+    await db.flush()
+    return plan
+
+async def set_plan_active_async(db: AsyncSession, plan_id: str, is_active: bool) -> bool:
+    result = await db.execute(update(Plan).where(Plan.id == plan_id).values(is_active=is_active))
+    return result.rowcount > 0
+
+async def is_panel_in_use_async(db: AsyncSession, panel_id: int) -> bool:
+    """Whether any plan (active or not) or account still points at the panel, or a plan has it in its pool."""
+    if await db.scalar(select(Plan.id).where(Plan.panel_id == panel_id).limit(1)) is not None:
+        return True
+    if await db.scalar(select(VpnAccount.id).where(VpnAccount.panel_id == panel_id).limit(1)) is not None:
+        return True
+    return await db.scalar(select(PlanPanel.plan_id).where(PlanPanel.panel_id == panel_id).limit(1)) is not None
+
+async def set_plan_pool_member_async(db: AsyncSession, plan_id: str, panel_id: int, member: bool) -> None:
+    """Adds a panel to (or removes it from) a plan's pool."""
+    if member:
+        await db.execute(sqlite_insert(PlanPanel).values(plan_id=plan_id, panel_id=panel_id).on_conflict_do_nothing())
+    else:
+        await db.execute(delete(PlanPanel).where(PlanPanel.plan_id == plan_id, PlanPanel.panel_id == panel_id))
+
+async def get_placement_candidates_async(db: AsyncSession, panel_ids: List[int]) -> Dict[int, int]:
+    """
+    Active panels among panel_ids with their account counts. The counts
+    come from the incrementally maintained stats, not from vpn_accounts.
+    """
+    active = list(await db.scalars(select(VpnPanel.id).where(VpnPanel.id.in_(panel_ids), VpnPanel.is_active == True)))
+    if not active:
+        return {}
+    keys = {f"accounts:panel:{panel_id}": panel_id for panel_id in active}
+    result = await db.execute(select(StatCounter.key, StatCounter.value).where(StatCounter.key.in_(list(keys))))
+    counts = {panel_id: 0 for panel_id in active}
+    for key, value in result.all():
+        counts[keys[key]] = value
+    return counts
+
+def import_plans_from_json(path: Path) -> int:
+    """
+    One-time import of the old plans.json into the plans table. Plans that
+    already exist are skipped; once every plan is in the table the file is
+    renamed to plans.json.imported so the import does not run again. Plans
+    that cannot be imported (no panel, or a panel that no longer exists)
+    are logged and the file is kept so they are not silently lost.
+    """
+    path = Path(path)
+    # A missing or empty file (older installers touched it) has nothing to import
+    if not path.exists() or path.stat().st_size == 0:
+        return 0
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            legacy_plans = json.load(f)
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        logger.error(f"Could not import {path.name}: {e}")
+        return 0
+
+    imported = 0
+    skipped = 0
+    with get_db() as db:
+        existing = set(db.scalars(select(Plan.id)))
+        panel_ids = set(db.scalars(select(VpnPanel.id)))
+        for position, (plan_id, data) in enumerate(legacy_plans.items(), start=1):
+            if plan_id in existing:
+                continue
+            if not data.get("panel_id"):
+                logger.warning(f"Skipping plan {plan_id} from {path.name}: it is not linked to a panel.")
+                skipped += 1
+                continue
+            if data["panel_id"] not in panel_ids:
+                logger.warning(f"Skipping plan {plan_id} from {path.name}: panel {data['panel_id']} does not exist.")
+                skipped += 1
+                continue
+            db.add(Plan(
+                id=plan_id,
+                name=data.get("name", plan_id),
+                panel_id=data["panel_id"],
+                price=data.get("price", 0) or 0,
+                data_limit_gb=data.get("data_limit_gb", 0) or 0,
+                duration_days=data.get("duration_days", 0) or 0,
+                user_limit=data.get("user_limit", 0) or 0,
+                is_active=data.get("is_active", True),
+                sort_order=position,
+            ))
+            imported += 1
+        db.commit()
+
+    if skipped:
+        logger.warning(f"Imported {imported} plans from {path.name}; {skipped} could not be imported, so the file was kept.")
+        return imported
+    path.rename(path.with_name(path.name + ".imported"))
+    logger.info(f"Imported {imported} plans from {path.name}.")
+    return imported
+
+
+# ===============================================================
+#   Broadcast Functions
+# ===============================================================
+
+async def get_recipient_chunk_async(db: AsyncSession, after_user_id: int, limit: int) -> List[Tuple[int, int]]:
+    """
+    Returns the next (users.id, telegram_id) pairs after a cursor, skipping
+    users who blocked the bot. Keyset pagination keeps memory and query
+    cost constant however many users there are.
+    """
+    result = await db.execute(
+        select(User.id, User.telegram_id)
+        .where(User.id > after_user_id, User.is_blocked == False)
+        .order_by(User.id)
+        .limit(limit)
+    )
+    return [(row[0], row[1]) for row in result.all()]
+
+async def create_broadcast_async(db: AsyncSession, from_chat_id: int, message_id: int, progress_chat_id: int, progress_message_id: int) -> Broadcast:
+    broadcast = Broadcast(
+        from_chat_id=from_chat_id,
+        message_id=message_id,
+        progress_chat_id=progress_chat_id,
+        progress_message_id=progress_message_id,
+        status="running",
+        last_user_id=0,
+        sent=0,
+        failed=0,
+        blocked=0,
+    )
+    db.add(broadcast)
+    await db.flush()
+    return broadcast
+
+async def save_broadcast_progress_async(db: AsyncSession, broadcast_id: int, last_user_id: int, sent: int, failed: int, blocked: int, blocked_telegram_ids: List[int], finished: bool = False) -> None:
+    """Saves a finished chunk and marks the users who blocked the bot, in one transaction."""
+    values = {"last_user_id": last_user_id, "sent": sent, "failed": failed, "blocked": blocked}
+    if finished:
+        values.update(status="finished", finished_at=func.now())
+    await db.execute(update(Broadcast).where(Broadcast.id == broadcast_id).values(**values))
+    if blocked_telegram_ids:
+        await db.execute(update(User).where(User.telegram_id.in_(blocked_telegram_ids)).values(is_blocked=True))
+
+async def get_running_broadcasts_async(db: AsyncSession) -> List[Broadcast]:
+    result = await db.execute(select(Broadcast).where(Broadcast.status == "running").order_by(Broadcast.id))
+    return list(result.scalars().all())
+
+
+# ===============================================================
+#   Provisioning Jobs
+#   Confirming an order only records the decision and queues a job; the
+#   provisioning workers create the panel user afterwards. All of these
+#   run through run_write(), so checking and changing a row inside one
+#   helper cannot interleave with another write.
+# ===============================================================
+
+@dataclass(frozen=True)
+class ProvisioningJobView:
+    id: int
+    tracking_code: str
+    panel_username: str
+    attempts: int
+    admin_telegram_id: Optional[int]
+    admin_name: Optional[str]
+    admin_caption: Optional[str]
+    panel_id: Optional[int]
+    tried_panel_ids: Tuple[int, ...]
+    failed_panel_ids: Tuple[int, ...]
+
+
+async def _set_order_status_async(db: AsyncSession, order: Order, status: str) -> None:
+    await bump_stats_async(db, _order_status_deltas(order, order.status, status))
+    order.status = status
+
+async def enqueue_provisioning_async(db: AsyncSession, tracking_code: str, panel_username: str, admin_telegram_id: int, admin_name: str, admin_caption: Optional[str],
+                                     panel_id: Optional[int] = None) -> bool:
+    """
+    Moves a pending order to "provisioning" and queues its job. Returns
+    False if the order is no longer pending (e.g. another admin was faster).
+    """
+    if not await update_order_status_async(db, tracking_code, "provisioning", admin_name, expected_status="pending"):
+        return False
+    db.add(ProvisioningJob(
+        tracking_code=tracking_code,
+        panel_username=panel_username,
+        idempotency_key=f"{tracking_code}:{panel_username}",
+        panel_id=panel_id,
+        status="queued",
+        attempts=1,
+        next_attempt_at=datetime.now(timezone.utc),
+        admin_telegram_id=admin_telegram_id,
+        admin_name=admin_name,
+        admin_caption=admin_caption,
+    ))
+    await db.flush()
+    return True
+
+async def claim_provisioning_job_async(db: AsyncSession) -> Optional[ProvisioningJobView]:
+    """Marks the next due job as running and returns it, or None if nothing is due."""
+    job = await db.scalar(
+        select(ProvisioningJob)
+        .where(ProvisioningJob.status == "queued", ProvisioningJob.next_attempt_at <= datetime.now(timezone.utc))
+        .order_by(ProvisioningJob.next_attempt_at)
+        .limit(1)
+    )
+    if not job:
+        return None
+    job.status = "running"
+    await db.flush()
+    return ProvisioningJobView(
+        id=job.id,
+        tracking_code=job.tracking_code,
+        panel_username=job.panel_username,
+        attempts=job.attempts,
+        admin_telegram_id=job.admin_telegram_id,
+        admin_name=job.admin_name,
+        admin_caption=job.admin_caption,
+        panel_id=job.panel_id,
+        tried_panel_ids=tuple(json.loads(job.tried_panel_ids or "[]")),
+        failed_panel_ids=tuple(json.loads(job.failed_panel_ids or "[]")),
+    )
+
+async def complete_provisioning_async(db: AsyncSession, job_id: int, tracking_code: str, user_telegram_id: int, panel_id: int, panel_username: str, friendly_name: str,
+                                      expires_at: Optional[datetime] = None, data_limit_gb: Optional[int] = None) -> None:
+    """Saves the account, confirms the order and closes the job in one transaction."""
+    exists = await db.scalar(
+        select(VpnAccount.id).where(VpnAccount.panel_username == panel_username, VpnAccount.panel_id == panel_id)
+    )
+    if not exists:
+        await create_vpn_account_async(db, user_telegram_id, panel_id, panel_username, friendly_name, expires_at, data_limit_gb)
+    order = await db.scalar(select(Order).where(Order.tracking_code == tracking_code))
+    if order and order.status == "provisioning":
+        await _set_order_status_async(db, order, "confirmed")
+    await db.execute(
+        update(ProvisioningJob).where(ProvisioningJob.id == job_id)
+        .values(status="done", last_error=None, finished_at=func.now())
+    )
+
+async def retry_provisioning_async(db: AsyncSession, job_id: int, error: str, next_attempt_at: datetime,
+                                   panel_id: Optional[int] = None, tried_panel_ids: Tuple[int, ...] = (),
+                                   failed_panel_ids: Tuple[int, ...] = (), next_round: bool = False) -> None:
+    """
+    Queues a job again, optionally on another panel of the plan's pool.
+    tried_panel_ids replaces this round's list; failed_panel_ids is the
+    cumulative list. next_round starts a new round over the pool.
+    """
+    values = {
+        "status": "queued",
+        "last_error": error,
+        "next_attempt_at": next_attempt_at,
+        "tried_panel_ids": json.dumps(list(tried_panel_ids)),
+        "failed_panel_ids": json.dumps(list(failed_panel_ids)),
+    }
+    if next_round:
+        values["attempts"] = ProvisioningJob.attempts + 1
+    if panel_id is not None:
+        values["panel_id"] = panel_id
+    await db.execute(update(ProvisioningJob).where(ProvisioningJob.id == job_id).values(**values))
+
+async def fail_provisioning_async(db: AsyncSession, job_id: int, tracking_code: str, error: str) -> None:
+    """Gives up on a job and marks its order as failed."""
+    order = await db.scalar(select(Order).where(Order.tracking_code == tracking_code))
+    if order and order.status == "provisioning":
+        await _set_order_status_async(db, order, "failed")
+    await db.execute(
+        update(ProvisioningJob).where(ProvisioningJob.id == job_id)
+        .values(status="failed", last_error=error, finished_at=func.now())
+    )
+
+async def requeue_interrupted_jobs_async(db: AsyncSession) -> int:
+    """Jobs left "running" by a crash or restart are picked up again (provisioning is idempotent)."""
+    result = await db.execute(
+        update(ProvisioningJob).where(ProvisioningJob.status == "running").values(status="queued")
+    )
+    return result.rowcount
+
+async def count_open_provisioning_jobs_async(db: AsyncSession) -> int:
+    return await db.scalar(
+        select(func.count(ProvisioningJob.id)).where(ProvisioningJob.status.in_(["queued", "running"]))
+    )
+
+# ===============================================================
+#   Expiry Reminders
+#   Accounts that still need a reminder are found with a range scan on
+#   ix_vpn_accounts_expiry_reminder, so a check reads only the accounts
+#   expiring inside the window, however many accounts exist in total.
+# ===============================================================
+
+@dataclass(frozen=True)
+class ExpiringAccountView:
+    id: int
+    friendly_name: Optional[str]
+    panel_username: str
+    expires_at: datetime
+    user_telegram_id: int
+
+
+async def get_expiring_accounts_async(db: AsyncSession, now: datetime, until: datetime, limit: int,
+                                      after: Optional[Tuple[datetime, int]] = None) -> List[ExpiringAccountView]:
+    """
+    Accounts expiring in (now, until] that have not been reminded yet,
+    soonest first. Pass the (expires_at, id) of the last row as `after`
+    to get the next page.
+    """
+    stmt = (
+        select(VpnAccount.id, VpnAccount.friendly_name, VpnAccount.panel_username, VpnAccount.expires_at, User.telegram_id)
+        .join(User, VpnAccount.user_id == User.id)
+        .where(VpnAccount.expiry_notified_at.is_(None), VpnAccount.expires_at > now, VpnAccount.expires_at <= until)
+        .order_by(VpnAccount.expires_at, VpnAccount.id)
+        .limit(limit)
+    )
+    if after is not None:
+        stmt = stmt.where(tuple_(VpnAccount.expires_at, VpnAccount.id) > tuple_(*after))
+    result = await db.execute(stmt)
+    return [ExpiringAccountView(*row) for row in result.all()]
+
+async def mark_expiry_reminders_sent_async(db: AsyncSession, account_ids: List[int]) -> None:
+    if account_ids:
+        await db.execute(
+            update(VpnAccount).where(VpnAccount.id.in_(account_ids)).values(expiry_notified_at=func.now())
+        )
+
+# ===============================================================
+#   Usage Mirror
+#   The sync job copies every account's panel status into account_usage
+#   in batches; account screens read the copy (see AccountView.usage).
+# ===============================================================
+
+async def get_panel_account_chunk_async(db: AsyncSession, panel_id: int, after_account_id: int, limit: int) -> List[Tuple[int, str]]:
+    """(account id, panel username) of a panel's accounts, in id order after the cursor."""
+    result = await db.execute(
+        select(VpnAccount.id, VpnAccount.panel_username)
+        .where(VpnAccount.panel_id == panel_id, VpnAccount.id > after_account_id)
+        .order_by(VpnAccount.id)
+        .limit(limit)
+    )
+    return [tuple(row) for row in result.all()]
+
+async def upsert_account_usage_async(db: AsyncSession, rows: List[Dict[str, Any]]) -> None:
+    """
+    Inserts or replaces mirror rows. Each row has account_id, used_traffic,
+    data_limit, expire, subscription_url, links (a list) and synced_at.
+    """
+    if not rows:
+        return
+    stmt = sqlite_insert(AccountUsage).values([{**row, "links": json.dumps(row["links"])} for row in rows])
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[AccountUsage.account_id],
+        set_={column: stmt.excluded[column] for column in ("used_traffic", "data_limit", "expire", "subscription_url", "links", "synced_at")},
+    ))
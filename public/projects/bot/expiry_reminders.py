@@ -0,0 +1,100 @@
+import os
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+
+from telegram import Bot
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.ext import ContextTypes
+
+import db_utils
+from db_utils import ExpiringAccountView
+from broadcast import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# --- Expiry Reminder Configuration ---
+# Users are reminded once when their service expires within this many days
+EXPIRY_REMINDER_DAYS = float(os.getenv("EXPIRY_REMINDER_DAYS", "3"))
+# How often (seconds) the job looks for accounts to remind
+EXPIRY_CHECK_INTERVAL = float(os.getenv("EXPIRY_CHECK_INTERVAL", "3600"))
+# Accounts read (and marked) per batch
+EXPIRY_REMINDER_BATCH = int(os.getenv("EXPIRY_REMINDER_BATCH", "100"))
+# Messages per second; kept well below Telegram's limit so broadcasts still have room
+EXPIRY_REMINDER_RATE = float(os.getenv("EXPIRY_REMINDER_RATE", "10"))
+
+
+class ExpiryReminder:
+    """
+    Reminds users shortly before a service expires. Runs as a repeating
+    JobQueue job; every account is reminded at most once because the
+    sent-marker is saved after each batch. Sends that fail for a temporary
+    reason stay unmarked and are tried again on the next run.
+    """
+    def __init__(self, bot: Bot, days: float = EXPIRY_REMINDER_DAYS):
+        self.bot = bot
+        self.window = timedelta(days=days)
+        self.limiter = RateLimiter(EXPIRY_REMINDER_RATE)
+
+    async def job(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        try:
+            await self.run()
+        except Exception as e:
+            logger.error(f"Expiry reminder run failed: {e}")
+
+    async def run(self) -> int:
+        """Sends all due reminders. Returns how many were delivered."""
+        now = datetime.now(timezone.utc)
+        until = now + self.window
+        after: Optional[Tuple[datetime, int]] = None
+        delivered = 0
+        while True:
+            async with db_utils.get_async_db() as db:
+                batch = await db_utils.get_expiring_accounts_async(db, now, until, EXPIRY_REMINDER_BATCH, after)
+            if not batch:
+                break
+            done: List[int] = []
+            for account in batch:
+                # Always try: the blocked flag may be stale, only Telegram knows for sure
+                result = await self._send(account, now)
+                if result == "sent":
+                    delivered += 1
+                if result != "failed":
+                    done.append(account.id)
+            await db_utils.run_write(lambda db: db_utils.mark_expiry_reminders_sent_async(db, done))
+            after = (batch[-1].expires_at, batch[-1].id)
+        if delivered:
+            logger.info(f"Sent {delivered} expiry reminders.")
+        return delivered
+
+    async def _send(self, account: ExpiringAccountView, now: datetime) -> str:
+        """Returns "sent", "undeliverable" (not retried) or "failed" (retried next run)."""
+        expires_at = account.expires_at
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        days = max(1, (expires_at - now).days)
+        name = account.friendly_name or account.panel_username
+        text = (
+            f"⏰ سرویس *{name}* شما {days} روز دیگر منقضی می‌شود.\n\n"
+            f"برای تمدید یا خرید سرویس جدید، /start را بزنید."
+        )
+        for _ in range(2):
+            await self.limiter.wait()
+            try:
+                await self.bot.send_message(chat_id=account.user_telegram_id, text=text, parse_mode=ParseMode.MARKDOWN)
+                return "sent"
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                seconds = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+                self.limiter.pause(seconds)
+            except Forbidden:
+                return "undeliverable"
+            except BadRequest as e:
+                # Usually a chat that no longer exists; retrying won't help
+                logger.warning(f"Could not send expiry reminder for account {account.id}: {e}")
+                return "undeliverable"
+            except (NetworkError, TelegramError) as e:
+                logger.warning(f"Could not send expiry reminder for account {account.id}: {e}")
+                return "failed"
+        return "failed"
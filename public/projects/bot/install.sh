@@ -37,7 +37,7 @@ echo "--> [4/8] Activating virtual environment and installing required libraries
 (
   source ${BOT_DIR}/venv/bin/activate
   pip install --upgrade pip
-  pip install python-telegram-bot==21.0.1 requests jdatetime SQLAlchemy
+  pip install "python-telegram-bot[job-queue]==21.0.1" httpx jdatetime "SQLAlchemy[asyncio]==2.0.36" "aiosqlite==0.20.0"
 )
 
 # --- 5. Get Admin ID and Create Data Files ---
@@ -45,7 +45,6 @@ echo "--> [5/8] Setting up data files..."
 read -p "Enter your ROOT_ADMIN_CHAT_ID: " ROOT_ADMIN_CHAT_ID
 
 echo "--> Creating required config files... (users.json and orders.json are now in the database)"
-touch ${BOT_DIR}/plans.json
 touch ${BOT_DIR}/settings.json
 touch ${BOT_DIR}/tickets.json
 
@@ -78,7 +77,7 @@ EOL
 
 # --- 7. Download Bot Scripts from URL ---
 echo "--> [7/8] Downloading bot project files from the server..."
-PROJECT_FILES=("main.py" "database_models.py" "db_utils.py" "panel_manager.py")
+PROJECT_FILES=("main.py" "database_models.py" "db_utils.py" "panel_manager.py" "broadcast.py" "config_store.py" "webhook.py" "persistence.py" "provisioning.py" "update_processor.py" "expiry_reminders.py" "usage_sync.py" "placement.py")
 DOWNLOAD_COUNT=0
 
 for FILE in "${PROJECT_FILES[@]}"; do
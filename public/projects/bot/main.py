@@ -1,27 +1,43 @@
 import logging
-import json
+import copy
 import os
 import uuid
+import time
+from datetime import datetime, timezone
 from pathlib import Path
 import asyncio # For broadcast
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from telegram.ext import (
     Application,
     CommandHandler,
     ContextTypes,
     ConversationHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     MessageHandler,
     filters,
 )
 from telegram.constants import ParseMode
 from telegram.error import BadRequest, Forbidden
+from telegram.helpers import escape_markdown
 
 # --- New Imports for Database and Panel Management ---
 import db_utils
 from database_models import VpnAccount, VpnPanel # We need these for type hinting and queries
-from panel_manager import get_panel_handler, VpnPanelInterface, PANEL_CLASSES
+from broadcast import BroadcastEngine
+from config_store import ConfigStore
+from webhook import make_update_queue, run_webhook_server
+from persistence import SqlitePersistence
+from provisioning import ProvisioningEngine, ProvisioningResult
+from update_processor import KeyedUpdateProcessor
+from expiry_reminders import ExpiryReminder, EXPIRY_CHECK_INTERVAL
+from usage_sync import UsageSync, USAGE_SYNC_INTERVAL, forget_panel_refreshes
+from placement import DEFAULT_PLACEMENT_WEIGHTS, rank_plan_panels
+from panel_manager import PANEL_CLASSES, close_panel_clients, invalidate_panel_handler, get_panel_health
+
+# Used to report how long a (re)start takes until the bot is ready
+PROCESS_STARTED_AT = time.monotonic()
 
 # --- Configuration ---
 logging.basicConfig(
@@ -45,6 +61,19 @@ PLANS_FILE = DATA_DIR / "plans.json"
 SETTINGS_FILE = DATA_DIR / "settings.json"
 TICKETS_FILE = DATA_DIR / "tickets.json"
 
+# --- Serving Mode ---
+# "polling" (default) or "webhook" (see webhook.py for its WEBHOOK_* settings)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+
+# --- Admin Fan-out ---
+ADMIN_FANOUT_CONCURRENCY = int(os.getenv("ADMIN_FANOUT_CONCURRENCY", "5"))
+ADMIN_FANOUT_TIMEOUT = float(os.getenv("ADMIN_FANOUT_TIMEOUT", "10")) # per admin, in seconds
+
+# --- Channel Membership Cache (force_join) ---
+MEMBERSHIP_CACHE_TTL = float(os.getenv("MEMBERSHIP_CACHE_TTL", "600")) # members, in seconds
+MEMBERSHIP_NEGATIVE_TTL = float(os.getenv("MEMBERSHIP_NEGATIVE_TTL", "15")) # non-members, in seconds
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "50000"))
+
 # --- Conversation States (Added new ones) ---
 (
     USER_MAIN_MENU,
@@ -80,48 +109,72 @@ TICKETS_FILE = DATA_DIR / "tickets.json"
 # ===============================================================
 # Helper Functions
 # ===============================================================
-def load_json(file_path: Path, default_data):
-    if not file_path.exists():
-        save_json(file_path, default_data)
-        return default_data
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except (json.JSONDecodeError, FileNotFoundError):
-        logger.warning(f"{file_path.name} corrupt or not found.")
-        return default_data
-
-def save_json(file_path: Path, data) -> None:
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
-
-# --- Specific Data Functions ---
-def load_admins() -> set: return set(load_json(ADMINS_FILE, [ROOT_ADMIN_CHAT_ID]))
-def save_admins(admin_ids: set) -> None: global admin_ids_set; admin_ids_set = admin_ids; save_json(ADMINS_FILE, list(admin_ids))
-def load_settings() -> dict:
-    default_settings = {
-        "bot_name": "ParaDoX",
-        "maintenance": {"enabled": False, "message": "ربات در حال حاضر در دست تعمیر است. لطفا بعدا تلاش کنید."},
-        "force_join": {"enabled": False, "channel_id": None}
-    }
-    loaded = load_json(SETTINGS_FILE, default_settings)
-    for key, value in default_settings.items():
+# --- Render Cache ---
+class RenderCache:
+    """
+    Finished (text, keyboard) pairs for the hottest screens. Anything a
+    screen depends on (plans, settings, the admin set) calls bump(), which
+    drops every entry; screens are rebuilt on their next view.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._screens = {}
+
+    def bump(self) -> None:
+        self.version += 1
+        self._screens.clear()
+
+    async def get(self, key, build):
+        """Returns the cached screen for key, building it with `await build()` on a miss."""
+        screen = self._screens.get(key)
+        if screen is None:
+            version = self.version
+            screen = await build()
+            # A bump() while building means the result may already be stale
+            if version == self.version:
+                self._screens[key] = screen
+        return screen
+
+render_cache = RenderCache()
+
+def plans_changed() -> None:
+    """Call after a plan write has been committed."""
+    db_utils.plan_cache.invalidate()
+    render_cache.bump()
+
+# --- Config Files (kept in memory, saved atomically in the background) ---
+DEFAULT_SETTINGS = {
+    "bot_name": "ParaDoX",
+    "maintenance": {"enabled": False, "message": "ربات در حال حاضر در دست تعمیر است. لطفا بعدا تلاش کنید."},
+    "force_join": {"enabled": False, "channel_id": None},
+    # Importance of each signal when choosing a panel from a plan's pool (see placement.py)
+    "placement_weights": DEFAULT_PLACEMENT_WEIGHTS,
+}
+
+def _with_default_settings(loaded: dict) -> dict:
+    for key, value in DEFAULT_SETTINGS.items():
         if key not in loaded:
-            loaded[key] = value
+            loaded[key] = copy.deepcopy(value)
     return loaded
-def save_settings(s: dict) -> None: global settings; settings = s; save_json(SETTINGS_FILE, s)
-def load_plans() -> dict: return load_json(PLANS_FILE, {})
-def save_plans(p: dict) -> None: global plans; plans = p; save_json(PLANS_FILE, p)
-def load_tickets() -> dict: return load_json(TICKETS_FILE, {})
-def save_tickets(t: dict) -> None: save_json(TICKETS_FILE, t)
 
-# Load data at startup
-admin_ids_set = load_admins()
-settings = load_settings()
-plans = load_plans()
+config = ConfigStore()
+# The admin set is stored as a JSON list
+admins_file = config.register(ADMINS_FILE, lambda: [ROOT_ADMIN_CHAT_ID], normalize=set, encode=sorted, on_change=render_cache.bump)
+settings_file = config.register(SETTINGS_FILE, lambda: copy.deepcopy(DEFAULT_SETTINGS), normalize=_with_default_settings, on_change=render_cache.bump)
+tickets_file = config.register(TICKETS_FILE, dict)
+
+# --- Specific Data Functions ---
+# Always go through these accessors: a reload from disk replaces the objects.
+def get_admin_ids() -> set: return admins_file.data
+def save_admins(admin_ids: set) -> None: admins_file.set(set(admin_ids))
+def get_settings() -> dict: return settings_file.data
+def save_settings(s: dict) -> None: settings_file.set(s)
+def get_tickets() -> dict: return tickets_file.data
+def save_tickets(t: dict) -> None: tickets_file.set(t)
 
 def is_admin(user_id: int) -> bool:
-    return user_id in admin_ids_set
+    return user_id in get_admin_ids()
 
 def is_root_admin(user_id: int) -> bool:
     return user_id == ROOT_ADMIN_CHAT_ID
@@ -147,6 +200,30 @@ def to_shamsi(timestamp):
     except (TypeError, ValueError):
         return "نامشخص"
 
+def format_remaining_days(expire_ts):
+    if not expire_ts or expire_ts <= 0:
+        return "نامحدود"
+    remaining_seconds = expire_ts - datetime.now().timestamp()
+    if remaining_seconds <= 0:
+        return "منقضی شده"
+    return f"{int(remaining_seconds / (24 * 60 * 60))} روز"
+
+def format_age(moment: datetime) -> str:
+    """How long ago a (UTC) moment was, e.g. "5 دقیقه پیش"."""
+    seconds = max(0, (datetime.now(timezone.utc) - moment).total_seconds())
+    if seconds < 60:
+        return "لحظاتی پیش"
+    if seconds < 3600:
+        return f"{int(seconds // 60)} دقیقه پیش"
+    if seconds < 86400:
+        return f"{int(seconds // 3600)} ساعت پیش"
+    return f"{int(seconds // 86400)} روز پیش"
+
+def format_remaining_traffic(used, total):
+    if not total or total <= 0:
+        return "نامحدود"
+    return format_bytes(max(total - (used or 0), 0))
+
 def format_price_human_readable(price_in_thousands):
     try:
         price_k = int(price_in_thousands)
@@ -161,6 +238,31 @@ def format_price_human_readable(price_in_thousands):
     except (ValueError, TypeError):
         return "قیمت نامشخص"
 
+async def fan_out_to_admins(admin_ids, send, description: str) -> tuple:
+    """
+    Calls `send(admin_id)` for every admin concurrently (bounded, with a
+    per-admin timeout). Returns ({admin_id: result}, {admin_id: error}).
+    """
+    semaphore = asyncio.Semaphore(ADMIN_FANOUT_CONCURRENCY)
+
+    async def send_one(admin_id):
+        async with semaphore:
+            return await asyncio.wait_for(send(admin_id), ADMIN_FANOUT_TIMEOUT)
+
+    admin_ids = list(admin_ids)
+    outcomes = await asyncio.gather(*(send_one(admin_id) for admin_id in admin_ids), return_exceptions=True)
+
+    results, failures = {}, {}
+    for admin_id, outcome in zip(admin_ids, outcomes):
+        if isinstance(outcome, BaseException):
+            failures[admin_id] = outcome
+        else:
+            results[admin_id] = outcome
+    if failures:
+        details = ", ".join(f"{admin_id}: {error!r}" for admin_id, error in failures.items())
+        logger.error(f"{description}: failed for {len(failures)}/{len(admin_ids)} admins ({details})")
+    return results, failures
+
 # ===============================================================
 # Pre-Handler Checks (Maintenance, Force Join)
 # ===============================================================
@@ -168,7 +270,7 @@ async def check_maintenance(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.effective_user.id
     if is_admin(user_id): return False
     
-    maintenance_settings = settings.get("maintenance", {})
+    maintenance_settings = get_settings().get("maintenance", {})
     if maintenance_settings.get("enabled", False):
         message_text = maintenance_settings.get("message", "ربات در حال حاضر در دست تعمیر است. لطفا بعدا تلاش کنید.")
         if update.callback_query:
@@ -178,11 +280,43 @@ async def check_maintenance(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return True
     return False
 
+# (channel_id, user_id) -> (is_member, expires_at monotonic time)
+membership_cache = {}
+
+def cache_membership(channel_id, user_id: int, is_member: bool) -> None:
+    if len(membership_cache) >= MEMBERSHIP_CACHE_SIZE:
+        now = time.monotonic()
+        for key in [k for k, (_, expires_at) in membership_cache.items() if expires_at <= now]:
+            del membership_cache[key]
+        if len(membership_cache) >= MEMBERSHIP_CACHE_SIZE:
+            membership_cache.clear()
+    ttl = MEMBERSHIP_CACHE_TTL if is_member else MEMBERSHIP_NEGATIVE_TTL
+    membership_cache[(str(channel_id), user_id)] = (is_member, time.monotonic() + ttl)
+
+def get_cached_membership(channel_id, user_id: int):
+    """Returns True/False from the cache, or None when unknown or expired."""
+    entry = membership_cache.get((str(channel_id), user_id))
+    if entry and entry[1] > time.monotonic():
+        return entry[0]
+    return None
+
+async def handle_chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Keeps the membership cache in sync with joins/leaves in the force_join channel."""
+    chat_member = update.chat_member
+    channel_id = get_settings().get("force_join", {}).get("channel_id")
+    if not chat_member or not channel_id:
+        return
+    chat = chat_member.chat
+    if str(channel_id) not in (str(chat.id), f"@{chat.username}" if chat.username else None):
+        return
+    is_member = chat_member.new_chat_member.status not in ['left', 'kicked']
+    cache_membership(channel_id, chat_member.new_chat_member.user.id, is_member)
+
 async def check_channel_membership(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     user = update.effective_user
     if is_admin(user.id): return False
 
-    force_join_settings = settings.get("force_join", {})
+    force_join_settings = get_settings().get("force_join", {})
     if not force_join_settings.get("enabled", False): return False
 
     channel_id = force_join_settings.get("channel_id")
@@ -191,8 +325,12 @@ async def check_channel_membership(update: Update, context: ContextTypes.DEFAULT
         return False
 
     try:
-        member = await context.bot.get_chat_member(chat_id=channel_id, user_id=user.id)
-        if member.status in ['left', 'kicked']:
+        is_member = get_cached_membership(channel_id, user.id)
+        if is_member is None:
+            member = await context.bot.get_chat_member(chat_id=channel_id, user_id=user.id)
+            is_member = member.status not in ['left', 'kicked']
+            cache_membership(channel_id, user.id, is_member)
+        if not is_member:
             raise BadRequest("User is not a member") 
     except BadRequest:
         link = ""
@@ -224,33 +362,42 @@ async def check_channel_membership(update: Update, context: ContextTypes.DEFAULT
 async def handle_check_join_again(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer("در حال بررسی عضویت شما...")
+    # The user says they just joined, so don't trust the cached answer
+    channel_id = get_settings().get("force_join", {}).get("channel_id")
+    membership_cache.pop((str(channel_id), query.from_user.id), None)
     return await start(update, context)
 
 # ===============================================================
 # Main Entry Point & User Flow
 # ===============================================================
 
-async def send_start_menu(user_id: int, context: ContextTypes.DEFAULT_TYPE, custom_text: str = None):
-    """Sends the main menu to a specific user."""
-    bot_name = settings.get("bot_name", "ParaDoX")
-    keyboard = [
-        [InlineKeyboardButton("🛒 خرید سرویس", callback_data="buy_service")],
-        [InlineKeyboardButton("📊 سرویس‌های من", callback_data="my_accounts")],
-        [InlineKeyboardButton("💲 لیست قیمت ها", callback_data="price_list")],
-        [InlineKeyboardButton("🗂️ فایل ها و آموزش", callback_data="files_tutorials_menu")],
-        [InlineKeyboardButton("📞 پشتیبانی", callback_data="support")],
-    ]
-    
-    if is_admin(user_id):
-        keyboard.append([InlineKeyboardButton("🤖 ورود به پنل مدیریت", callback_data="admin_panel_show")])
+async def render_main_menu(for_admin: bool) -> tuple:
+    """The main menu (text, keyboard); admins get an extra button."""
+    async def build():
+        bot_name = get_settings().get("bot_name", "ParaDoX")
+        keyboard = [
+            [InlineKeyboardButton("🛒 خرید سرویس", callback_data="buy_service")],
+            [InlineKeyboardButton("📊 سرویس‌های من", callback_data="my_accounts")],
+            [InlineKeyboardButton("💲 لیست قیمت ها", callback_data="price_list")],
+            [InlineKeyboardButton("🗂️ فایل ها و آموزش", callback_data="files_tutorials_menu")],
+            [InlineKeyboardButton("📞 پشتیبانی", callback_data="support")],
+        ]
+        if for_admin:
+            keyboard.append([InlineKeyboardButton("🤖 ورود به پنل مدیریت", callback_data="admin_panel_show")])
+        text = f"سلام! به ربات فروش سرویس {bot_name} خوش آمدید. برای شروع، یک گزینه را انتخاب کنید."
+        return text, InlineKeyboardMarkup(keyboard)
 
-    text = custom_text or f"سلام! به ربات فروش سرویس {bot_name} خوش آمدید. برای شروع، یک گزینه را انتخاب کنید."
+    return await render_cache.get(("main_menu", for_admin), build)
+
+async def send_start_menu(user_id: int, bot: Bot, custom_text: str = None):
+    """Sends the main menu to a specific user."""
+    text, reply_markup = await render_main_menu(is_admin(user_id))
     
     try:
-        await context.bot.send_message(
+        await bot.send_message(
             chat_id=user_id, 
-            text=text, 
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            text=custom_text or text, 
+            reply_markup=reply_markup
         )
     except Forbidden:
         logger.warning(f"Failed to send message to user {user_id}: Bot was blocked or kicked.")
@@ -263,34 +410,22 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     user = update.effective_user
     
-    with db_utils.get_db() as db:
-        db_utils.get_or_create_user(db,
-            telegram_id=user.id, 
-            first_name=user.full_name, # Use full_name as first_name
-            username=user.username
-        )
-
-    bot_name = settings.get("bot_name", "ParaDoX")
-    keyboard = [
-        [InlineKeyboardButton("🛒 خرید سرویس", callback_data="buy_service")],
-        [InlineKeyboardButton("📊 سرویس‌های من", callback_data="my_accounts")],
-        [InlineKeyboardButton("💲 لیست قیمت ها", callback_data="price_list")],
-        [InlineKeyboardButton("🗂️ فایل ها و آموزش", callback_data="files_tutorials_menu")],
-        [InlineKeyboardButton("📞 پشتیبانی", callback_data="support")],
-    ]
-    
-    if is_admin(user.id):
-        keyboard.append([InlineKeyboardButton("🤖 ورود به پنل مدیریت", callback_data="admin_panel_show")])
+    # Returning users are answered from memory; new or renamed users are written in batches
+    db_utils.known_users.touch(
+        telegram_id=user.id,
+        first_name=user.full_name, # Use full_name as first_name
+        username=user.username
+    )
 
-    text = f"سلام! به ربات فروش سرویس {bot_name} خوش آمدید. برای شروع، یک گزینه را انتخاب کنید."
+    text, reply_markup = await render_main_menu(is_admin(user.id))
     
     if update.callback_query:
         await update.callback_query.answer()
         try:
-            await update.callback_query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+            await update.callback_query.message.edit_text(text, reply_markup=reply_markup)
         except BadRequest: pass
     else:
-        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+        await update.message.reply_text(text, reply_markup=reply_markup)
         
     return USER_MAIN_MENU
 
@@ -299,88 +434,108 @@ async def my_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     await query.answer()
     user_id = query.from_user.id
     
-    with db_utils.get_db() as db:
-        accounts = db_utils.get_user_accounts(db, user_id)
+    # Statuses come from the local usage mirror, so this screen never waits for a panel
+    async with db_utils.get_async_db() as db:
+        accounts = await db_utils.get_account_overviews_async(db, user_id)
     
     if not accounts:
         await query.message.edit_text("شما هنوز سرویس فعالی خریداری نکرده‌اید.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data="back_to_start")]]))
         return USER_MAIN_MENU
 
-    text = "📊 **سرویس‌های شما:**\n\nلطفا سرویسی که می‌خواهید مدیریتش کنید را انتخاب نمایید:"
+    account_lines = []
     keyboard = []
     for acc in accounts:
+        usage = acc.usage
+        if usage:
+            remaining = format_remaining_traffic(usage.used_traffic, usage.data_limit)
+            days = format_remaining_days(usage.expire)
+            account_lines.append(f"▫️ *{acc.friendly_name}* ({acc.panel.name})\n  حجم باقیمانده: {remaining} | روزهای باقیمانده: {days}")
+        else:
+            account_lines.append(f"▫️ *{acc.friendly_name}* ({acc.panel.name})\n  اطلاعات هنوز دریافت نشده است")
         # Each account gets its own row with a button
         keyboard.append([InlineKeyboardButton(f"سرویس {acc.friendly_name} ({acc.panel.name})", callback_data=f"manage_account_{acc.id}")])
     
     keyboard.append([InlineKeyboardButton("🔙 بازگشت به منوی اصلی", callback_data="back_to_start")])
+
+    text = "📊 **سرویس‌های شما:**\n\n" + "\n\n".join(account_lines) + "\n\nلطفا سرویسی که می‌خواهید مدیریتش کنید را انتخاب نمایید:"
     
     await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
     return MANAGING_ACCOUNTS
 
+async def load_account_usage(account_id: int, user_id: int, refresh: bool = False):
+    """
+    Returns (account, usage) for an account owned by user_id. The usage comes
+    from the local mirror; the panel is only asked when refresh is True or
+    the account has not been synced yet. account is None if not owned.
+    """
+    async with db_utils.get_async_db() as db:
+        account = await db_utils.get_owned_account_async(db, account_id, user_id)
+    if not account:
+        return None, None
+    usage = account.usage
+    if refresh or usage is None:
+        try:
+            usage = await UsageSync.refresh_account(account) or usage
+        except Exception as e:
+            logger.error(f"Live refresh of account {account_id} failed: {e}")
+    return account, usage
+
 async def manage_single_account(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     account_id = int(query.data.split("_")[-1])
+    refresh = query.data.startswith("refresh_account_")
 
-    with db_utils.get_db() as db:
-        account = db_utils.get_account_by_id(db, account_id)
-        if not account or account.user.telegram_id != query.from_user.id:
-            await query.message.edit_text("خطا: این سرویس یافت نشد یا متعلق به شما نیست.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data="my_accounts")]]))
-            return MANAGING_ACCOUNTS
-        
-        try:
-            panel_handler = get_panel_handler(account.panel)
-            user_info = await panel_handler.get_user(account.panel_username)
-
-            if not user_info:
-                raise ValueError("User not found on panel")
-
-            used = user_info.get("used_traffic", 0)
-            total = user_info.get("data_limit", 0)
-            expire_ts = user_info.get("expire")
-            
-            # Convert timestamp to timezone-aware datetime string for to_shamsi
-            expire_iso = datetime.fromtimestamp(expire_ts, tz=timezone.utc).isoformat() if expire_ts else None
-            expire_str = to_shamsi(expire_iso)
-            
-            remaining_days_str = "نامحدود"
-            if expire_ts and expire_ts > 0:
-                remaining_seconds = expire_ts - datetime.now().timestamp()
-                if remaining_seconds > 0:
-                    remaining_days = remaining_seconds / (24 * 60 * 60)
-                    remaining_days_str = f"{int(remaining_days)} روز"
-                else:
-                    remaining_days_str = "منقضی شده"
-
-            status_text = (
-                f"📊 **وضعیت سرویس: {account.friendly_name}**\n\n"
-                f"👤 نام کاربری: `{user_info.get('username', 'N/A')}`\n"
-                f"📈 حجم مصرفی: *{format_bytes(used)}*\n"
-                f"📦 حجم کل: *{format_bytes(total) if total > 0 else 'نامحدود'}*\n"
-                f"⏳ تاریخ انقضا: *{expire_str}*\n"
-                f"🗓️ روزهای باقیمانده: *{remaining_days_str}*"
-            )
+    account, usage = await load_account_usage(account_id, query.from_user.id, refresh=refresh)
 
-            keyboard = [
-                # TODO: Add Renew/Recharge buttons later
-                # [InlineKeyboardButton("🔄 تمدید / شارژ", callback_data=f"renew_{account.id}")],
-                [InlineKeyboardButton("🔙 بازگشت به لیست سرویس‌ها", callback_data="my_accounts")]
-            ]
-            
-            # Add subscription link if available
-            subscription_url = user_info.get("subscription_url")
-            if subscription_url:
-                 keyboard.insert(0, [InlineKeyboardButton("🔗 دریافت لینک‌های اتصال", callback_data=f"get_links_{account.id}")])
-
-            await query.message.edit_text(
-                status_text, 
-                parse_mode=ParseMode.MARKDOWN, 
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+    if not account:
+        await query.message.edit_text("خطا: این سرویس یافت نشد یا متعلق به شما نیست.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data="my_accounts")]]))
+        return MANAGING_ACCOUNTS
+    
+    if not usage:
+        await query.message.edit_text("خطایی در دریافت اطلاعات سرویس شما از سرور رخ داد. لطفا با پشتیبانی تماس بگیرید.", reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔄 تلاش مجدد", callback_data=f"refresh_account_{account.id}")],
+            [InlineKeyboardButton("🔙 بازگشت", callback_data="my_accounts")],
+        ]))
+        return MANAGING_ACCOUNTS
+
+    expire_ts = usage.expire
+    # Convert timestamp to timezone-aware datetime string for to_shamsi
+    expire_iso = datetime.fromtimestamp(expire_ts, tz=timezone.utc).isoformat() if expire_ts else None
+    expire_str = to_shamsi(expire_iso)
+    remaining_days_str = format_remaining_days(expire_ts)
+
+    status_text = (
+        f"📊 **وضعیت سرویس: {account.friendly_name}**\n\n"
+        f"👤 نام کاربری: `{account.panel_username}`\n"
+        f"📈 حجم مصرفی: *{format_bytes(usage.used_traffic)}*\n"
+        f"📦 حجم کل: *{format_bytes(usage.data_limit) if usage.data_limit > 0 else 'نامحدود'}*\n"
+        f"⏳ تاریخ انقضا: *{expire_str}*\n"
+        f"🗓️ روزهای باقیمانده: *{remaining_days_str}*\n\n"
+        f"🕒 آخرین به‌روزرسانی: {format_age(usage.synced_at)}"
+    )
 
-        except Exception as e:
-            logger.error(f"Error getting service status for account {account_id}: {e}")
-            await query.message.edit_text("خطایی در دریافت اطلاعات سرویس شما از سرور رخ داد. لطفا با پشتیبانی تماس بگیرید.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data="my_accounts")]]))
+    keyboard = [
+        # TODO: Add Renew/Recharge buttons later
+        # [InlineKeyboardButton("🔄 تمدید / شارژ", callback_data=f"renew_{account.id}")],
+        [InlineKeyboardButton("🔄 به‌روزرسانی اطلاعات", callback_data=f"refresh_account_{account.id}")],
+        [InlineKeyboardButton("🔙 بازگشت به لیست سرویس‌ها", callback_data="my_accounts")]
+    ]
+    
+    # Add subscription link if available
+    if usage.subscription_url or usage.links:
+        keyboard.insert(0, [InlineKeyboardButton("🔗 دریافت لینک‌های اتصال", callback_data=f"get_links_{account.id}")])
+
+    try:
+        await query.message.edit_text(
+            status_text, 
+            parse_mode=ParseMode.MARKDOWN, 
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    except BadRequest as e:
+        # A refresh that changed nothing
+        if "not modified" not in str(e).lower():
+            raise
 
     return MANAGING_ACCOUNTS
 
@@ -389,97 +544,93 @@ async def get_account_links(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.answer()
     account_id = int(query.data.split("_")[-1])
 
-    with db_utils.get_db() as db:
-        account = db_utils.get_account_by_id(db, account_id)
-        if not account or account.user.telegram_id != query.from_user.id:
-            await query.message.edit_text("خطا: این سرویس یافت نشد.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data="my_accounts")]]))
-            return MANAGING_ACCOUNTS
-            
-        try:
-            panel_handler = get_panel_handler(account.panel)
-            user_info = await panel_handler.get_user(account.panel_username)
-
-            if not user_info: raise ValueError("User info not found")
-
-            subscription_url = user_info.get("subscription_url")
-            all_links = user_info.get("links", [])
-            
-            message_text = "🔗 **لینک‌های اتصال شما:**\n\n"
-            if subscription_url:
-                message_text += f"لینک کلی (Subscription):\n`{subscription_url}`\n\n"
-            
-            if all_links:
-                message_text += "لینک‌های اتصال جداگانه:\n"
-                links_text = "\n\n".join([f"`{link}`" for link in all_links])
-                message_text += links_text
-            
-            if not subscription_url and not all_links:
-                message_text = "خطا: لینکی برای این سرویس یافت نشد."
-
-            await query.message.edit_text(
-                message_text,
-                parse_mode=ParseMode.MARKDOWN,
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data=f"manage_account_{account.id}")]]))
+    account, usage = await load_account_usage(account_id, query.from_user.id)
 
-        except Exception as e:
-            logger.error(f"Failed to get links for account {account_id}: {e}")
-            await query.message.edit_text("خطا در دریافت لینک‌ها.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data=f"manage_account_{account.id}")]]))
+    if not account:
+        await query.message.edit_text("خطا: این سرویس یافت نشد.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data="my_accounts")]]))
+        return MANAGING_ACCOUNTS
+
+    back_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data=f"manage_account_{account.id}")]])
+    if not usage:
+        await query.message.edit_text("خطا در دریافت لینک‌ها.", reply_markup=back_markup)
+        return MANAGING_ACCOUNTS
 
+    subscription_url = usage.subscription_url
+    all_links = usage.links
+    
+    message_text = "🔗 **لینک‌های اتصال شما:**\n\n"
+    if subscription_url:
+        message_text += f"لینک کلی (Subscription):\n`{subscription_url}`\n\n"
+    
+    if all_links:
+        message_text += "لینک‌های اتصال جداگانه:\n"
+        links_text = "\n\n".join([f"`{link}`" for link in all_links])
+        message_text += links_text
+    
+    if not subscription_url and not all_links:
+        message_text = "خطا: لینکی برای این سرویس یافت نشد."
+
+    await query.message.edit_text(message_text, parse_mode=ParseMode.MARKDOWN, reply_markup=back_markup)
     return MANAGING_ACCOUNTS
 
 async def show_price_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    
-    if not plans:
-        await query.answer(text="هیچ طرحی تعریف نشده است.", show_alert=True)
-        return
 
-    price_list_lines = ["📜 لیست قیمت ها:"]
-    for plan_data in plans.values():
-        name = plan_data.get('name', 'N/A')
-        price = format_price_human_readable(plan_data.get('price', 0))
-        price_list_lines.append(f"- {name}: {price}")
-        
-    price_list_text = "\n".join(price_list_lines)
-    if len(price_list_lines) > 10: # Limit lines to avoid huge alert
-        price_list_text = "تعداد طرح ها زیاد است. لطفا وارد بخش خرید شوید تا همه را ببینید."
+    async def build():
+        plans = await db_utils.plan_cache.get_active()
+        if not plans:
+            return "هیچ طرحی تعریف نشده است."
+        price_list_lines = ["📜 لیست قیمت ها:"]
+        for plan in plans:
+            price = format_price_human_readable(plan.price)
+            price_list_lines.append(f"- {plan.name}: {price}")
+        if len(price_list_lines) > 10: # Limit lines to avoid huge alert
+            return "تعداد طرح ها زیاد است. لطفا وارد بخش خرید شوید تا همه را ببینید."
+        return "\n".join(price_list_lines)
+
+    price_list_text = await render_cache.get("price_list", build)
     await query.answer(text=price_list_text, show_alert=True)
     
 async def show_plans_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    if not plans:
+
+    async def build():
+        plans = await db_utils.plan_cache.get_active()
+        if not plans:
+            return None, None
+        plan_details_list = []
+        for plan in plans:
+            price = format_price_human_readable(plan.price)
+            gb = plan.data_limit_gb or 'نامحدود'
+            days = plan.duration_days or 'نامحدود'
+            user_str = f"{plan.user_limit} کاربره" if plan.user_limit else "نامحدود کاربر"
+            plan_details_list.append(f"▫️ *{plan.name}*\n  حجم: {gb} گیگ | زمان: {days} روز | {user_str}\n  قیمت: *{price}*")
+
+        text = "📜 **لیست سرویس‌ها:**\n\n" + "\n\n".join(plan_details_list) + "\n\nلطفا یکی از طرح‌های زیر را برای خرید انتخاب کنید:"
+        keyboard = [[InlineKeyboardButton(plan.name, callback_data=f"plan_{plan.id}")] for plan in plans]
+        keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="back_to_start")])
+        return text, InlineKeyboardMarkup(keyboard)
+
+    text, reply_markup = await render_cache.get("plans", build)
+    if not text:
         await query.message.edit_text("متاسفانه در حال حاضر هیچ طرح فعالی برای فروش وجود ندارد.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data="back_to_start")]]))
         return USER_MAIN_MENU
-    
-    plan_details_list = []
-    for pid, p_data in plans.items():
-        name = p_data.get('name', 'N/A')
-        price = format_price_human_readable(p_data.get('price', 0))
-        gb = p_data.get('data_limit_gb', 'نامحدود')
-        days = p_data.get('duration_days', 'نامحدود')
-        users_limit = p_data.get('user_limit')
-        user_str = f"{users_limit} کاربره" if users_limit else "نامحدود کاربر"
-        plan_details_list.append(f"▫️ *{name}*\n  حجم: {gb} گیگ | زمان: {days} روز | {user_str}\n  قیمت: *{price}*")
-
-    text = "📜 **لیست سرویس‌ها:**\n\n" + "\n\n".join(plan_details_list) + "\n\nلطفا یکی از طرح‌های زیر را برای خرید انتخاب کنید:"
-
-    keyboard = [[InlineKeyboardButton(f"{p['name']}", callback_data=f"plan_{pid}")] for pid, p in plans.items()]
-    keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="back_to_start")])
-    await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+    await query.message.edit_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
     return CHOOSING_PLAN
 
 async def handle_plan_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     plan_id = query.data.split("_")[1]
+    plan = await db_utils.plan_cache.get(plan_id)
     
-    if plan_id not in plans:
+    if not plan or not plan.is_active:
         await query.message.edit_text("این طرح دیگر موجود نیست.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data="back_to_start")]]))
         return USER_MAIN_MENU
 
     context.user_data['selected_plan_id'] = plan_id
-    payment_settings = settings.get("payment", {})
+    payment_settings = get_settings().get("payment", {})
     card_enabled = payment_settings.get("card_to_card_enabled", False)
     
     if not card_enabled:
@@ -489,10 +640,9 @@ async def handle_plan_selection(update: Update, context: ContextTypes.DEFAULT_TY
     card_details = payment_settings.get("card_details", {})
     number = card_details.get("number", "N/A")
     holder = card_details.get("holder", "N/A")
-    plan = plans[plan_id]
     
-    plan_price = format_price_human_readable(plan.get('price', 0))
-    text = (f"شما طرح **{plan['name']}** را انتخاب کردید.\nمبلغ قابل پرداخت: **{plan_price}**\n\n"
+    plan_price = format_price_human_readable(plan.price)
+    text = (f"شما طرح **{plan.name}** را انتخاب کردید.\nمبلغ قابل پرداخت: **{plan_price}**\n\n"
             f"لطفا مبلغ را به کارت زیر واریز کرده و سپس **اسکرین‌شات رسید** را ارسال نمایید.\n\n"
             f"شماره کارت:\n`{number}`\nبه نام: `{holder}`")
     await query.message.edit_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 انصراف و بازگشت", callback_data="back_to_start")]]))
@@ -505,41 +655,51 @@ async def handle_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     user = update.effective_user
     plan_id = context.user_data.get('selected_plan_id')
-    if not plan_id or plan_id not in plans:
+    plan = await db_utils.plan_cache.get(plan_id) if plan_id else None
+    if not plan or not plan.is_active:
         await update.message.reply_text("خطا در یافتن طرح. لطفا از ابتدا شروع کنید: /start")
         return ConversationHandler.END
 
     tracking_code = str(uuid.uuid4()).split('-')[0].upper()
-    plan_data = plans[plan_id]
     
-    admin_message_ids = {}
-    plan_price = format_price_human_readable(plan_data.get('price', 0))
+    plan_price = format_price_human_readable(plan.price)
     caption = (f"✅ **سفارش جدید**\n\n"
                f"**کاربر:** {user.full_name} (`{user.id}`)\n"
-               f"**طرح:** {plan_data['name']}\n"
+               f"**طرح:** {plan.name}\n"
                f"**مبلغ:** {plan_price}\n"
                f"**کد پیگیری:** `{tracking_code}`")
     keyboard = [[InlineKeyboardButton("✅ تایید", callback_data=f"confirm_{tracking_code}"),
                  InlineKeyboardButton("❌ رد", callback_data=f"reject_{tracking_code}")]]
-    
-    for admin_id in admin_ids_set:
-        try:
-            msg = await context.bot.send_photo(chat_id=admin_id, photo=update.message.photo[-1].file_id, caption=caption, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
-            admin_message_ids[str(admin_id)] = msg.message_id
-        except Exception as e:
-            logger.error(f"Failed to send receipt to admin {admin_id}: {e}")
+    photo_file_id = update.message.photo[-1].file_id
 
     # --- DATABASE REFACTOR ---
-    with db_utils.get_db() as db:
-        db_utils.create_order(db,
-            tracking_code=tracking_code,
-            user_telegram_id=user.id,
-            plan_id=plan_id,
-            admin_message_ids=admin_message_ids
-        )
+    await db_utils.known_users.ensure_flushed(user.id)
+    await db_utils.run_write(lambda db: db_utils.create_order_async(db,
+        tracking_code=tracking_code,
+        user_telegram_id=user.id,
+        plan_id=plan_id,
+        admin_message_ids={},
+        price=plan.price
+    ))
     # --- END REFACTOR ---
 
+    # The customer gets their tracking code right away; admins are notified in the background
     await update.message.reply_text(f"رسید شما برای بررسی ارسال شد.\nکد پیگیری شما: `{tracking_code}`", parse_mode=ParseMode.MARKDOWN)
+
+    async def deliver_receipt():
+        async def send(admin_id):
+            msg = await context.bot.send_photo(chat_id=admin_id, photo=photo_file_id, caption=caption, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+            # Saved per admin, so an early decision does not have to wait for the slowest delivery
+            status = await db_utils.run_write(lambda db: db_utils.add_order_admin_message_async(db, tracking_code, admin_id, msg.message_id))
+            if status != "pending":
+                # Decided before this id was stored, so the decision could not update it
+                await context.bot.edit_message_reply_markup(chat_id=admin_id, message_id=msg.message_id, reply_markup=None)
+            return msg.message_id
+
+        await fan_out_to_admins(get_admin_ids(), send, f"Receipt delivery for order {tracking_code}")
+
+    context.application.create_task(deliver_receipt(), update=update)
+
     context.user_data.clear()
     return await start(update, context)
 
@@ -557,105 +717,113 @@ async def handle_admin_decision(update: Update, context: ContextTypes.DEFAULT_TY
     action, tracking_code = query.data.split("_")
     admin_name = query.from_user.full_name
     
-    with db_utils.get_db() as db:
-        order = db_utils.get_order_by_tracking_code(db, tracking_code)
-        
-        if not order or order.status != 'pending':
+    async with db_utils.get_async_db() as db:
+        order = await db_utils.get_order_view_async(db, tracking_code)
+
+    if not order or order.status != 'pending':
+        await query.answer("این سفارش قبلا بررسی شده است.", show_alert=True)
+        return
+
+    plan = order.plan
+    plan_name = plan.name if plan else "نامشخص"
+
+    async def decided_message_ids() -> dict:
+        # Read after the decision is written: ids stored later are cleared by the sender instead.
+        # The message that was pressed is always updated, even if its id was not stored yet.
+        async with db_utils.get_async_db() as db:
+            admin_message_ids = await db_utils.get_order_admin_messages_async(db, tracking_code)
+        return {**admin_message_ids, str(query.message.chat_id): query.message.message_id}
+
+    if action == "confirm":
+        # Only the decision is recorded here; the provisioning workers create the service
+        panel_username = f"user_{order.user_telegram_id}_{uuid.uuid4().hex[:4]}"
+        try:
+            ranked = await rank_plan_panels(plan, get_settings()["placement_weights"]) if plan else []
+        except Exception as e:
+            # Still queue the order; the plan's own panel is a safe default
+            logger.error(f"Could not rank panels for order {tracking_code}: {e}")
+            ranked = [plan.panel_id] if plan and plan.panel_id else []
+        queued = await db_utils.run_write(lambda db: db_utils.enqueue_provisioning_async(db,
+            tracking_code=tracking_code,
+            panel_username=panel_username,
+            admin_telegram_id=query.from_user.id,
+            admin_name=admin_name,
+            admin_caption=query.message.caption,
+            panel_id=ranked[0] if ranked else None,
+        ))
+        if not queued:
             await query.answer("این سفارش قبلا بررسی شده است.", show_alert=True)
             return
+        context.bot_data["provisioning_engine"].wake()
+        await update_admin_captions(context.bot, await decided_message_ids(), query.message.caption + f"\n\n---\n*⏳ در حال ساخت سرویس (تایید توسط: {admin_name})*", tracking_code)
+        return
+
+    # --- Rejected: update order status in DB ---
+    rejected = await db_utils.run_write(lambda db: db_utils.update_order_status_async(db, tracking_code, "rejected", admin_name, expected_status="pending"))
+    if not rejected:
+        # Another admin decided between our read and this write
+        await query.answer("این سفارش قبلا بررسی شده است.", show_alert=True)
+        return
+
+    try: 
+        await context.bot.send_message(chat_id=order.user_telegram_id, text=f"❌ سفارش شما برای طرح **{plan_name}** رد شد.", parse_mode=ParseMode.MARKDOWN)
+    except Exception as e: 
+        logger.error(f"Failed to notify user {order.user_telegram_id}: {e}")
 
-        new_status = "confirmed" if action == "confirm" else "rejected"
-        plan_data = plans.get(order.plan_id, {"name": "نامشخص", "panel_id": None})
-        user_message = ""
+    await update_admin_captions(context.bot, await decided_message_ids(), query.message.caption + f"\n\n---\n*❌ رد شد توسط: {admin_name}*", tracking_code)
 
-        if new_status == "confirmed":
+async def update_admin_captions(bot: Bot, admin_message_ids: dict, caption: str, tracking_code: str) -> None:
+    """Replaces the receipt caption (and removes its buttons) in every admin's chat."""
+    async def update_caption(admin_id):
+        try:
+            await bot.edit_message_caption(chat_id=int(admin_id), message_id=admin_message_ids[admin_id], caption=caption, parse_mode=ParseMode.MARKDOWN, reply_markup=None)
+        except BadRequest as e:
+            # The deciding admin's own message may already show the final caption
+            if "not modified" not in str(e).lower():
+                raise
+
+    await fan_out_to_admins(admin_message_ids.keys(), update_caption, f"Caption update for order {tracking_code}")
+
+async def notify_provisioning_result(bot: Bot, result: ProvisioningResult) -> None:
+    """Tells the customer and the admins how a provisioning job ended."""
+    job, order = result.job, result.order
+    plan_name = order.plan.name if order and order.plan else "نامشخص"
+
+    if result.success:
+        subscription_url = result.user_info.get("subscription_url")
+        all_links = result.user_info.get("links", [])
+        user_message = f"✅ سفارش شما برای طرح **{plan_name}** تایید و سرویس شما ساخته شد.\n\n"
+        if subscription_url:
+            user_message += f"لینک کلی (Subscription):\n`{subscription_url}`\n\n"
+        if all_links:
+            user_message += "لینک‌های اتصال جداگانه:\n"
+            user_message += "\n\n".join([f"`{link}`" for link in all_links])
+        status_text = "✅ تایید شد"
+    else:
+        user_message = f"✅ سفارش شما تایید شد، اما در ساخت خودکار سرویس مشکلی پیش آمد. لطفا فورا با پشتیبانی تماس بگیرید و کد پیگیری `{job.tracking_code}` را ارائه دهید."
+        status_text = "🚨 خطا در ساخت"
+        if job.admin_telegram_id:
             try:
-                panel_id = plan_data.get('panel_id')
-                if not panel_id:
-                    raise ValueError(f"Plan {order.plan_id} is not linked to any panel!")
-                
-                panel = db_utils.get_panel_by_id(db, panel_id)
-                if not panel:
-                    raise ValueError(f"Panel with ID {panel_id} not found in database!")
-
-                panel_handler = get_panel_handler(panel)
-                
-                # --- Create a unique username ---
-                # Example: user_12345_abcd
-                panel_username = f"user_{order.user.telegram_id}_{uuid.uuid4().hex[:4]}"
-                
-                # --- Create user on the panel ---
-                created_user_info = await panel_handler.create_user(
-                    username=panel_username,
-                    plan=plan_data
-                )
-                if not created_user_info:
-                    raise ValueError("Failed to create user on the panel, API returned None.")
-
-                # --- Save the new account to our database ---
-                friendly_name = f"{plan_data.get('data_limit_gb', '')}GB"
-                db_utils.create_vpn_account(db,
-                    user_telegram_id=order.user.telegram_id,
-                    panel_id=panel.id,
-                    panel_username=created_user_info['username'],
-                    friendly_name=friendly_name
-                )
-                
-                # --- Prepare message for the user ---
-                subscription_url = created_user_info.get("subscription_url")
-                all_links = created_user_info.get("links", [])
-                
-                user_message = f"✅ سفارش شما برای طرح **{plan_data['name']}** تایید و سرویس شما ساخته شد.\n\n"
-
-                if subscription_url:
-                    user_message += f"لینک کلی (Subscription):\n`{subscription_url}`\n\n"
-                
-                if all_links:
-                    user_message += "لینک‌های اتصال جداگانه:\n"
-                    links_text = "\n\n".join([f"`{link}`" for link in all_links])
-                    user_message += links_text
-
-                if not subscription_url and not all_links:
-                    raise ValueError("Neither subscription_url nor links were found in panel response.")
-            
+                await bot.send_message(chat_id=job.admin_telegram_id, text=f"🚨 خطا در ساخت سرویس برای سفارش {job.tracking_code}. لطفا به صورت دستی بسازید. خطا: {result.error}")
             except Exception as e:
-                logger.error(f"CRITICAL: Failed to create panel user for order {tracking_code}: {e}")
-                user_message = f"✅ سفارش شما تایید شد، اما در ساخت خودکار سرویس مشکلی پیش آمد. لطفا فورا با پشتیبانی تماس بگیرید و کد پیگیری `{tracking_code}` را ارائه دهید."
-                await context.bot.send_message(chat_id=query.from_user.id, text=f"🚨 خطا در ساخت سرویس برای سفارش {tracking_code}. لطفا به صورت دستی بسازید. خطا: {e}")
-                new_status = "failed" # Set a different status to indicate error
-                
-        else: # rejected
-            user_message = f"❌ سفارش شما برای طرح **{plan_data['name']}** رد شد."
-        
-        # --- Update order status in DB ---
-        db_utils.update_order_status(db, tracking_code, new_status, admin_name)
-
-    try: 
-        await context.bot.send_message(chat_id=order.user.telegram_id, text=user_message, parse_mode=ParseMode.MARKDOWN)
+                logger.error(f"Failed to notify admin {job.admin_telegram_id}: {e}")
 
-        if new_status == "confirmed":
+    if not order:
+        return
+    try:
+        await bot.send_message(chat_id=order.user_telegram_id, text=user_message, parse_mode=ParseMode.MARKDOWN)
+        if result.success:
             await send_start_menu(
-                user_id=order.user.telegram_id,
-                context=context,
+                user_id=order.user_telegram_id,
+                bot=bot,
                 custom_text="سرویس شما فعال شد. می‌توانید از منوی «سرویس‌های من» وضعیت آن را بررسی کنید:"
             )
+    except Exception as e:
+        logger.error(f"Failed to notify user {order.user_telegram_id}: {e}")
 
-    except Exception as e: 
-        logger.error(f"Failed to notify user {order.user.telegram_id}: {e}")
-        
-    status_text = "✅ تایید شد" if new_status == "confirmed" else "❌ رد شد"
-    if new_status == "failed": status_text = "🚨 خطا در ساخت"
-    
-    final_caption = query.message.caption + f"\n\n---\n*{status_text} توسط: {admin_name}*"
-    
-    admin_message_ids = order.admin_message_ids
-    if isinstance(admin_message_ids, str): # Handle JSON string from DB
-        admin_message_ids = json.loads(admin_message_ids)
-
-    for admin_id, message_id in admin_message_ids.items():
-        try: 
-            await context.bot.edit_message_caption(chat_id=int(admin_id), message_id=message_id, caption=final_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=None)
-        except Exception: pass
+    if job.admin_caption:
+        final_caption = job.admin_caption + f"\n\n---\n*{status_text} توسط: {job.admin_name}*"
+        await update_admin_captions(bot, order.admin_message_ids, final_caption, job.tracking_code)
 
 # ===============================================================
 # Admin Panel & All Sub-menus
@@ -678,7 +846,7 @@ async def admin_panel_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         [InlineKeyboardButton("🖥️ مدیریت پنل‌ها (سرورها)", callback_data="manage_panels")], # NEW BUTTON
         [InlineKeyboardButton("🔙 بازگشت به منوی اصلی", callback_data="back_to_start")]
     ]
-    text = f"🤖 *پنل مدیریت ربات {settings.get('bot_name', '')}*\n\nبه پنل مدیریت خوش آمدید. لطفاً یک گزینه را انتخاب کنید:"
+    text = f"🤖 *پنل مدیریت ربات {get_settings().get('bot_name', '')}*\n\nبه پنل مدیریت خوش آمدید. لطفاً یک گزینه را انتخاب کنید:"
     
     if query:
         await query.answer()
@@ -688,21 +856,138 @@ async def admin_panel_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     return ADMIN_PANEL
 
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+
+    # Counters are maintained on every write, so this is cheap regardless of table size
+    async with db_utils.get_async_db() as db:
+        stats = await db_utils.get_stats_async(db)
+        panels = await db_utils.get_all_panels_async(db)
+        open_jobs = await db_utils.count_open_provisioning_jobs_async(db)
+    plan_names = {plan.id: plan.name for plan in await db_utils.plan_cache.get_all()}
+    orders_per_minute = context.bot_data["provisioning_engine"].orders_per_minute()
+    update_processor = context.application.update_processor
+
+    status_labels = {"pending": "در انتظار", "provisioning": "در حال ساخت", "confirmed": "تایید شده", "rejected": "رد شده", "failed": "خطا"}
+    orders_line = " | ".join(f"{label}: {stats.get(f'orders:{status}', 0)}" for status, label in status_labels.items())
+
+    revenue_by_plan = [
+        f"- {escape_markdown(plan_names.get(key.split(':', 2)[2], 'طرح حذف شده'))}: {format_price_human_readable(value)}"
+        for key, value in stats.items() if key.startswith("revenue:plan:") and value
+    ]
+    revenue_by_day = [
+        f"- {key.split(':', 2)[2]}: {format_price_human_readable(value)}"
+        for key, value in sorted(stats.items(), reverse=True) if key.startswith("revenue:day:") and value
+    ]
+    accounts_by_panel = [f"- {escape_markdown(p.name)}: {stats.get(f'accounts:panel:{p.id}', 0)}" for p in panels]
+
+    text = (
+        "📊 *آمار ربات*\n\n"
+        f"👥 تعداد کاربران: *{stats.get('users', 0)}*\n\n"
+        f"🧾 سفارش‌ها:\n{orders_line}\n\n"
+        f"⚙️ ساخت سرویس: {orders_per_minute} سفارش در دقیقه | در صف: {open_jobs}\n"
+        f"⏱️ پاسخ به آپدیت‌ها: p50 {update_processor.latency_percentile(50):.2f}s | p99 {update_processor.latency_percentile(99):.2f}s\n\n"
+        "💰 درآمد به تفکیک طرح:\n" + ("\n".join(revenue_by_plan) or "-") + "\n\n"
+        "📅 درآمد ۷ روز اخیر:\n" + ("\n".join(revenue_by_day) or "-") + "\n\n"
+        "🖥️ سرویس‌ها به تفکیک پنل:\n" + ("\n".join(accounts_by_panel) or "-")
+    )
+    keyboard = [[InlineKeyboardButton("🔙 بازگشت به پنل اصلی", callback_data="admin_panel_show")]]
+    await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+    return ADMIN_PANEL
+
+async def rebuild_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Recomputes all statistics counters from scratch (/rebuild_stats)."""
+    if not is_admin(update.effective_user.id):
+        return
+    await db_utils.run_write(db_utils.rebuild_stats_async)
+    await update.message.reply_text("✅ آمار ربات از نو محاسبه شد.")
+
+async def placement_weights_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Shows or sets the panel placement weights (/placement_weights <users> <latency> <errors>)."""
+    if not is_admin(update.effective_user.id):
+        return
+    settings = get_settings()
+    if context.args:
+        try:
+            values = [float(arg) for arg in context.args]
+            if len(values) != 3 or any(value < 0 for value in values):
+                raise ValueError
+        except ValueError:
+            await update.message.reply_text("استفاده: /placement_weights <کاربران> <تاخیر> <خطا>\nمثال: /placement_weights 1 1 2")
+            return
+        settings["placement_weights"] = dict(zip(("users", "latency", "errors"), values))
+        save_settings(settings)
+    weights = {**DEFAULT_PLACEMENT_WEIGHTS, **settings["placement_weights"]}
+    await update.message.reply_text(
+        f"⚖️ وزن‌های انتخاب سرور:\n"
+        f"تعداد کاربران: {weights['users']}\n"
+        f"تاخیر پاسخ: {weights['latency']}\n"
+        f"نرخ خطا: {weights['errors']}"
+    )
+
+# ===============================================================
+# ---> Broadcast Flow
+# ===============================================================
+async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    await query.message.edit_text("📢 پیامی که می‌خواهید برای همه کاربران ارسال شود را بفرستید (متن، عکس، ویدیو و ...).\n(/cancel برای لغو)")
+    return GETTING_BROADCAST_MESSAGE
+
+async def get_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data['broadcast_message'] = (update.message.chat_id, update.message.message_id)
+    keyboard = [[InlineKeyboardButton("✅ ارسال", callback_data="broadcast_confirm"),
+                 InlineKeyboardButton("❌ لغو", callback_data="broadcast_cancel")]]
+    await update.message.reply_text("آیا از ارسال این پیام برای همه کاربران اطمینان دارید؟", reply_markup=InlineKeyboardMarkup(keyboard))
+    return CONFIRM_BROADCAST
+
+async def confirm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    message_ref = context.user_data.pop('broadcast_message', None)
+
+    if query.data != "broadcast_confirm" or not message_ref:
+        await query.message.edit_text("ارسال همگانی لغو شد.")
+        return await admin_panel_command(update, context)
+
+    from_chat_id, message_id = message_ref
+    progress_message = await query.message.edit_text("⏳ *در حال ارسال همگانی...*", parse_mode=ParseMode.MARKDOWN)
+    broadcast = await db_utils.run_write(lambda db: db_utils.create_broadcast_async(db,
+        from_chat_id=from_chat_id,
+        message_id=message_id,
+        progress_chat_id=progress_message.chat_id,
+        progress_message_id=progress_message.message_id
+    ))
+    # Runs in the background; progress is shown by editing the message above
+    context.bot_data["broadcast_engine"].launch(broadcast)
+    return ADMIN_PANEL
+
 # ===============================================================
 # ---> Panel Management Flow (NEW)
 # ===============================================================
+def format_panel_health(panel_id: int) -> str:
+    """One status line per panel for the admin: circuit state, latency and error rate of recent requests."""
+    health = get_panel_health(panel_id)
+    labels = {"healthy": "🟢 سالم", "degraded": "🟡 ناپایدار", "down": "🔴 قطع"}
+    latency = health.latency_percentile(50)
+    if latency is None and not health.stats["requests"]:
+        return "⚪️ بدون درخواست اخیر"
+    latency_text = f"{latency:.2f}s" if latency is not None else "-"
+    return f"{labels[health.status]} | تاخیر: {latency_text} | خطا: {health.error_rate:.0%}"
+
 async def manage_panels_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     
-    with db_utils.get_db() as db:
-        panels = db_utils.get_all_panels(db)
+    async with db_utils.get_async_db() as db:
+        panels = await db_utils.get_all_panels_async(db)
         
     keyboard = [
         [InlineKeyboardButton("➕ افزودن پنل جدید", callback_data="add_panel_start")]
     ]
     
-    panel_list_items = [f"- {p.name} ({p.panel_type})" for p in panels]
+    panel_list_items = [f"- {p.name} ({p.panel_type})\n  {format_panel_health(p.id)}" for p in panels]
     panel_list = "\n".join(panel_list_items)
     if not panel_list: panel_list = "هیچ پنلی تعریف نشده است."
     
@@ -722,14 +1007,16 @@ async def delete_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     query = update.callback_query
     panel_id = int(query.data.split("_")[-1])
 
-    with db_utils.get_db() as db:
-        # First, check if any plan uses this panel
-        is_used = any(plan.get('panel_id') == panel_id for plan in plans.values())
-        if is_used:
-            await query.answer("❌ خطا: این پنل به یک یا چند طرح متصل است. ابتدا طرح‌ها را حذف یا ویرایش کنید.", show_alert=True)
-            return MANAGE_PANELS_MENU
-            
-        db_utils.delete_panel_by_id(db, panel_id)
+    # First, check if any plan uses this panel
+    async with db_utils.get_async_db() as db:
+        is_used = await db_utils.is_panel_in_use_async(db, panel_id)
+    if is_used:
+        await query.answer("❌ خطا: این پنل به یک یا چند طرح یا سرویس متصل است. ابتدا طرح‌ها را ویرایش کنید.", show_alert=True)
+        return MANAGE_PANELS_MENU
+        
+    await db_utils.run_write(lambda db: db_utils.delete_panel_by_id_async(db, panel_id))
+    await invalidate_panel_handler(panel_id)
+    forget_panel_refreshes(panel_id)
     
     await query.answer("✅ پنل با موفقیت حذف شد.", show_alert=True)
     return await manage_panels_menu(update, context)
@@ -767,16 +1054,20 @@ async def get_panel_api_url(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return GETTING_PANEL_API_TOKEN
 
 async def get_panel_api_token_and_save(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data['new_panel']['api_token'] = update.message.text
+    # The token goes straight to the DB; user_data is persisted and must not hold it
+    api_token = update.message.text
     new_panel_data = context.user_data.pop('new_panel')
 
-    with db_utils.get_db() as db:
-        db_utils.create_panel(db,
-            name=new_panel_data['name'],
-            panel_type=new_panel_data['type'],
-            api_url=new_panel_data['api_url'],
-            api_token=new_panel_data['api_token']
-        )
+    new_panel = await db_utils.run_write(lambda db: db_utils.create_panel_async(db,
+        name=new_panel_data['name'],
+        panel_type=new_panel_data['type'],
+        api_url=new_panel_data['api_url'],
+        api_token=api_token
+    ))
+    new_panel_id = new_panel.id
+    # SQLite may reuse the id of a deleted panel, so drop any stale handler.
+    await invalidate_panel_handler(new_panel_id)
+    forget_panel_refreshes(new_panel_id)
     
     await update.message.reply_text(f"✅ پنل **{new_panel_data['name']}** با موفقیت اضافه شد!")
     
@@ -790,8 +1081,8 @@ async def add_plan_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await query.answer()
     
     # Check if any panel exists before adding a plan
-    with db_utils.get_db() as db:
-        if not db_utils.get_all_panels(db):
+    async with db_utils.get_async_db() as db:
+        if not await db_utils.get_all_panels_async(db):
             await query.answer("❌ ابتدا باید حداقل یک پنل (سرور) در بخش «مدیریت پنل‌ها» اضافه کنید.", show_alert=True)
             return MANAGE_PLANS_MENU
 
@@ -830,8 +1121,8 @@ async def get_user_limit(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return GETTING_USER_LIMIT
 
 async def ask_for_plan_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    with db_utils.get_db() as db:
-        panels = db_utils.get_all_panels(db)
+    async with db_utils.get_async_db() as db:
+        panels = await db_utils.get_all_panels_async(db)
         
     keyboard = []
     for panel in panels:
@@ -860,9 +1151,15 @@ async def save_complete_plan(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_str = f"{users_limit} کاربره" if users_limit else "نامحدود کاربر"
     new_plan['name'] = f"سرویس {gb} گیگ - {days} روزه ({user_str})"
 
-    plan_id = str(uuid.uuid4())
-    plans[plan_id] = new_plan
-    save_plans(plans)
+    await db_utils.run_write(lambda db: db_utils.create_plan_async(db,
+        name=new_plan['name'],
+        panel_id=panel_id,
+        price=new_plan.get('price', 0),
+        data_limit_gb=new_plan.get('data_limit_gb', 0),
+        duration_days=new_plan.get('duration_days', 0),
+        user_limit=new_plan.get('user_limit', 0)
+    ))
+    plans_changed()
     
     message_text = f"✅ طرح **{new_plan['name']}** با موفقیت اضافه شد!"
     
@@ -870,6 +1167,92 @@ async def save_complete_plan(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
     return await manage_plans_menu(update, context)
 
+async def manage_plans_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    if query: await query.answer()
+
+    async def build():
+        plans = await db_utils.plan_cache.get_all()
+        keyboard = [
+            [InlineKeyboardButton(f"{'✅' if plan.is_active else '⏸️'} {plan.name}", callback_data=f"toggle_plan_{plan.id}"),
+             InlineKeyboardButton(f"🖥️ سرورها ({len(plan.pool)})", callback_data=f"plan_pool_{plan.id}")]
+            for plan in plans
+        ]
+        keyboard += [
+            [InlineKeyboardButton("➕ افزودن طرح جدید", callback_data="add_plan_start")],
+            [InlineKeyboardButton("🔙 بازگشت به پنل اصلی", callback_data="admin_panel_show")]
+        ]
+        plan_list_items = [f"- {plan.name}" + ("" if plan.is_active else " (غیرفعال)") for plan in plans]
+        plan_list = "\n".join(plan_list_items) or "هیچ طرحی تعریف نشده است."
+        text = f"🛒 *مدیریت طرح‌ها*\n\n**طرح‌های فعلی:**\n{plan_list}"
+        return text, InlineKeyboardMarkup(keyboard)
+
+    text, reply_markup = await render_cache.get("manage_plans", build)
+    if query:
+        await query.message.edit_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+    else:
+        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+    return MANAGE_PLANS_MENU
+
+async def toggle_plan(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    # Inactive plans are hidden from the shop but kept for existing orders
+    query = update.callback_query
+    plan = await db_utils.plan_cache.get(query.data[len("toggle_plan_"):])
+    if plan:
+        await db_utils.run_write(lambda db: db_utils.set_plan_active_async(db, plan.id, not plan.is_active))
+        plans_changed()
+    return await manage_plans_menu(update, context)
+
+async def show_plan_pool(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Lets the admin choose the panels a plan's orders are spread over."""
+    query = update.callback_query
+    await query.answer()
+    plan_id = query.data[len("plan_pool_"):] if query.data.startswith("plan_pool_") else query.data[len("pool_toggle_"):].rsplit("_", 1)[0]
+    plan = await db_utils.plan_cache.get(plan_id)
+    if not plan:
+        return await manage_plans_menu(update, context)
+
+    async with db_utils.get_async_db() as db:
+        panels = await db_utils.get_all_panels_async(db)
+        stats = await db_utils.get_stats_async(db)
+
+    keyboard = [
+        [InlineKeyboardButton(f"{'✅' if panel.id in plan.pool else '➖'} {panel.name}", callback_data=f"pool_toggle_{plan.id}_{panel.id}")]
+        for panel in panels
+    ]
+    keyboard.append([InlineKeyboardButton("🔙 بازگشت به مدیریت طرح‌ها", callback_data="manage_plans")])
+    panel_lines = [
+        f"{'✅' if panel.id in plan.pool else '➖'} {panel.name}: {stats.get(f'accounts:panel:{panel.id}', 0)} سرویس\n  {format_panel_health(panel.id)}"
+        for panel in panels
+    ]
+    text = (
+        f"🖥️ *سرورهای طرح {plan.name}*\n\n"
+        f"هر سفارش روی مناسب‌ترین سرور انتخاب‌شده ساخته می‌شود و در صورت خطا، سرور بعدی امتحان می‌شود.\n\n"
+        + ("\n".join(panel_lines) or "هیچ پنلی تعریف نشده است.")
+        + "\n\nوزن‌ها: /placement_weights"
+    )
+    await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+    return MANAGE_PLANS_MENU
+
+async def toggle_plan_pool_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    plan_id, panel_id = query.data[len("pool_toggle_"):].rsplit("_", 1)
+    plan = await db_utils.plan_cache.get(plan_id)
+    if plan:
+        panel_id = int(panel_id)
+        member = panel_id not in plan.pool
+        if not member and plan.pool == (panel_id,):
+            await query.answer("حداقل یک سرور باید انتخاب شده باشد.", show_alert=True)
+            return MANAGE_PLANS_MENU
+        async def write(db):
+            if plan.pool == (plan.panel_id,):
+                # The plan had no pool yet; its own panel becomes the first member
+                await db_utils.set_plan_pool_member_async(db, plan.id, plan.panel_id, True)
+            await db_utils.set_plan_pool_member_async(db, plan.id, panel_id, member)
+        await db_utils.run_write(write)
+        plans_changed()
+    return await show_plan_pool(update, context)
+
 # ... (Other admin functions like manage_admins, broadcast, etc. go here)
 # ... (They are mostly unchanged from the original code)
 
@@ -909,11 +1292,84 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return await start(update, context)
 
 
+async def on_startup(application: Application) -> None:
+    """Starts background workers once the event loop is running."""
+    config.start()
+    db_utils.db_writer.start()
+    await db_utils.known_users.warm()
+    db_utils.known_users.start()
+
+    broadcast_engine = BroadcastEngine(application.bot)
+    application.bot_data["broadcast_engine"] = broadcast_engine
+    await broadcast_engine.resume_all()
+
+    provisioning_engine = ProvisioningEngine(
+        notify=lambda result: notify_provisioning_result(application.bot, result),
+        placement_weights=lambda: get_settings()["placement_weights"],
+    )
+    application.bot_data["provisioning_engine"] = provisioning_engine
+    await provisioning_engine.start()
+
+    if application.job_queue:
+        expiry_reminder = ExpiryReminder(application.bot)
+        application.job_queue.run_repeating(expiry_reminder.job, interval=EXPIRY_CHECK_INTERVAL, first=60, name="expiry_reminders")
+        usage_sync = UsageSync()
+        application.job_queue.run_repeating(usage_sync.job, interval=USAGE_SYNC_INTERVAL, first=10, name="usage_sync")
+    else:
+        logger.warning('JobQueue is not available (install "python-telegram-bot[job-queue]"); expiry reminders and usage sync are disabled.')
+    logger.info(f"Ready {time.monotonic() - PROCESS_STARTED_AT:.2f}s after process start.")
+
+
+async def on_shutdown(application: Application) -> None:
+    """Releases long-lived resources (panel connection pools, DB connections) on shutdown."""
+    # Running broadcasts are paused here and resume from their saved cursor on the next start
+    await application.bot_data["broadcast_engine"].stop()
+    # Unfinished provisioning jobs are re-queued on the next start
+    await application.bot_data["provisioning_engine"].stop()
+    # Commit any queued writes before the connections are closed
+    await db_utils.known_users.stop()
+    # Only now: a running worker would re-open a closed panel client
+    await close_panel_clients()
+    await db_utils.db_writer.stop()
+    await db_utils.dispose_async_engine()
+    await config.stop()
+
+
+def update_lock_key(update: object):
+    """
+    Updates with the same key are handled one at a time. Order decisions are
+    keyed by order so two admins can't decide the same order concurrently;
+    everything else by user, which keeps each user's conversation in order.
+    """
+    if not isinstance(update, Update):
+        return None
+    query = update.callback_query
+    if query and query.data and query.data.startswith(("confirm_", "reject_")):
+        return ("order", query.data.split("_", 1)[1])
+    if update.effective_user:
+        return ("user", update.effective_user.id)
+    return None
+
+
 def main() -> None:
     # Initialize the database on startup
     db_utils.init_db()
+    db_utils.import_plans_from_json(PLANS_FILE)
     
-    application = Application.builder().token(BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        # In-flight conversations and user_data survive restarts
+        .persistence(SqlitePersistence())
+        # Different users are served in parallel; one user's updates stay in order
+        .concurrent_updates(KeyedUpdateProcessor(update_lock_key))
+    )
+    if BOT_MODE == "webhook":
+        # Updates arrive through our own listener; a bounded queue gives backpressure
+        builder = builder.updater(None).update_queue(make_update_queue())
+    application = builder.build()
     
     # You will need to rebuild the ConversationHandler with all the new states
     # and entry points. This is a complex task and requires careful mapping.
@@ -941,7 +1397,7 @@ def main() -> None:
                 CallbackQueryHandler(start, pattern="^back_to_start$")
             ],
             MANAGING_ACCOUNTS: [
-                CallbackQueryHandler(manage_single_account, pattern=r"^manage_account_"),
+                CallbackQueryHandler(manage_single_account, pattern=r"^(manage|refresh)_account_"),
                 CallbackQueryHandler(get_account_links, pattern=r"^get_links_"),
                 CallbackQueryHandler(my_accounts, pattern="^my_accounts$"), # To refresh
                 CallbackQueryHandler(start, pattern="^back_to_start$"),
@@ -949,9 +1405,14 @@ def main() -> None:
             ADMIN_PANEL: [
                 CallbackQueryHandler(manage_plans_menu, pattern="^manage_plans$"),
                 CallbackQueryHandler(manage_panels_menu, pattern="^manage_panels$"),
+                CallbackQueryHandler(admin_stats, pattern="^admin_stats$"),
+                CallbackQueryHandler(broadcast_start, pattern="^broadcast_start$"),
                 CallbackQueryHandler(admin_panel_command, pattern="^admin_panel_show$"), # To refresh
                 # ... other admin panel handlers
             ],
+            # --- Broadcast States ---
+            GETTING_BROADCAST_MESSAGE: [MessageHandler(~filters.COMMAND, get_broadcast_message)],
+            CONFIRM_BROADCAST: [CallbackQueryHandler(confirm_broadcast, pattern=r"^broadcast_(confirm|cancel)$")],
             # --- Panel Management States ---
             MANAGE_PANELS_MENU: [
                 CallbackQueryHandler(add_panel_start, pattern="^add_panel_start$"),
@@ -966,6 +1427,10 @@ def main() -> None:
             # --- Plan Management States ---
             MANAGE_PLANS_MENU: [
                 CallbackQueryHandler(add_plan_start, pattern="^add_plan_start$"),
+                CallbackQueryHandler(toggle_plan, pattern=r"^toggle_plan_"),
+                CallbackQueryHandler(show_plan_pool, pattern=r"^plan_pool_"),
+                CallbackQueryHandler(toggle_plan_pool_panel, pattern=r"^pool_toggle_"),
+                CallbackQueryHandler(manage_plans_menu, pattern="^manage_plans$"),
                 CallbackQueryHandler(admin_panel_command, pattern="^admin_panel_show$"),
                 # ... other plan management handlers
             ],
@@ -979,6 +1444,8 @@ def main() -> None:
         },
         fallbacks=[CommandHandler("cancel", cancel)],
         per_message=False,
+        name="main_conversation",
+        persistent=True,
     )
     
     # --- Dummy handlers for functions not fully re-implemented ---
@@ -993,33 +1460,22 @@ def main() -> None:
         await update.message.reply_text("حجم دریافت شد. در آخر، **مدت زمان** را به روز وارد کنید (فقط عدد).")
         return GETTING_PLAN_DAYS
         
-    async def manage_plans_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-        # A simplified version of manage_plans_menu
-        query = update.callback_query
-        if query: await query.answer()
-        keyboard = [
-            [InlineKeyboardButton("➕ افزودن طرح جدید", callback_data="add_plan_start")],
-            [InlineKeyboardButton("🔙 بازگشت به پنل اصلی", callback_data="admin_panel_show")]
-        ]
-        plan_list_items = [f"- {p['name']}" for p in plans.values()]
-        plan_list = "\n".join(plan_list_items) or "هیچ طرحی تعریف نشده است."
-        text = f"🛒 *مدیریت طرح‌ها*\n\n**طرح‌های فعلی:**\n{plan_list}"
-        
-        if query:
-            await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
-        else:
-            await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
-        return MANAGE_PLANS_MENU
-
     # --- Add handlers to application ---
     application.add_handler(main_conv_handler)
     
     # Standalone Handlers
     application.add_handler(CallbackQueryHandler(handle_admin_decision, pattern=r"^(confirm|reject)_"))
     application.add_handler(CallbackQueryHandler(show_price_list, pattern="^price_list$"))
+    application.add_handler(CommandHandler("rebuild_stats", rebuild_stats_command))
+    application.add_handler(CommandHandler("placement_weights", placement_weights_command))
+    application.add_handler(ChatMemberHandler(handle_chat_member_update, ChatMemberHandler.CHAT_MEMBER))
 
     logger.info("Bot is starting...")
-    application.run_polling()
+    # chat_member updates are not sent by default; they keep the membership cache fresh
+    if BOT_MODE == "webhook":
+        run_webhook_server(application, allowed_updates=Update.ALL_TYPES)
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
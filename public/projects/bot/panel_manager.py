@@ -1,13 +1,254 @@
-import requests
+import os
 import json
+import time
+import base64
+import asyncio
+import logging
 from datetime import datetime
 from abc import ABC, abstractmethod
-from typing import Dict, Optional, Any
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Any, Tuple, Union
+
+import httpx
 
 # Assuming database_models.py exists and has VpnPanel defined
 # This is just for type hinting, no circular dependency is created.
 from database_models import VpnPanel
 
+logger = logging.getLogger(__name__)
+
+# --- HTTP Transport Configuration ---
+# httpx ships with python-telegram-bot, so no extra dependency is needed.
+PANEL_POOL_SIZE = int(os.getenv("PANEL_POOL_SIZE", "10"))
+PANEL_KEEPALIVE = int(os.getenv("PANEL_KEEPALIVE", "5"))
+PANEL_CONNECT_TIMEOUT = float(os.getenv("PANEL_CONNECT_TIMEOUT", "5"))
+PANEL_READ_TIMEOUT = float(os.getenv("PANEL_READ_TIMEOUT", "15"))
+# Max in-flight requests per panel when a batch lookup has to fan out.
+PANEL_BATCH_CONCURRENCY = int(os.getenv("PANEL_BATCH_CONCURRENCY", "5"))
+# Page size for panels that support listing users.
+PANEL_BATCH_PAGE_SIZE = int(os.getenv("PANEL_BATCH_PAGE_SIZE", "100"))
+
+# --- Marzban Token Cache ---
+# Refresh tokens this many seconds before they actually expire.
+TOKEN_REFRESH_MARGIN = int(os.getenv("PANEL_TOKEN_REFRESH_MARGIN", "60"))
+# Used when the JWT carries no readable "exp" claim.
+TOKEN_DEFAULT_TTL = int(os.getenv("PANEL_TOKEN_DEFAULT_TTL", "600"))
+
+# VpnPanel.id -> (access_token, refresh_at unix timestamp)
+_token_cache: Dict[int, Tuple[str, float]] = {}
+# VpnPanel.id -> lock, so concurrent callers share a single login
+_token_locks: Dict[int, asyncio.Lock] = {}
+# Counters to monitor the login-to-call ratio
+token_stats = {"logins": 0, "calls": 0, "cache_hits": 0, "unauthorized_retries": 0}
+
+# get_user() responses are not cached here. Account screens read the
+# account_usage table that usage_sync.py fills in bulk, and explicit
+# refreshes of one account share a single panel call there.
+
+# --- Panel Health / Circuit Breaker ---
+# Latency and error rate are computed over this many recent requests.
+PANEL_HEALTH_WINDOW = int(os.getenv("PANEL_HEALTH_WINDOW", "50"))
+# The circuit opens after this many failed requests in a row...
+PANEL_CIRCUIT_FAILURES = int(os.getenv("PANEL_CIRCUIT_FAILURES", "5"))
+# ...and lets a single probe request through after this many seconds.
+PANEL_CIRCUIT_COOLDOWN = float(os.getenv("PANEL_CIRCUIT_COOLDOWN", "30"))
+
+
+def _build_client(verify: bool, health: "PanelHealth") -> httpx.AsyncClient:
+    """Creates a pooled AsyncClient using the configured limits and timeouts."""
+    transport = httpx.AsyncHTTPTransport(
+        verify=verify,
+        limits=httpx.Limits(
+            max_connections=PANEL_POOL_SIZE,
+            max_keepalive_connections=PANEL_KEEPALIVE,
+        ),
+    )
+    return httpx.AsyncClient(
+        transport=_HealthTransport(transport, health),
+        timeout=httpx.Timeout(PANEL_READ_TIMEOUT, connect=PANEL_CONNECT_TIMEOUT),
+    )
+
+
+def _jwt_expiry(token: str) -> Optional[float]:
+    """Reads the "exp" claim of a JWT without verifying its signature."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def invalidate_token(panel_id: int) -> None:
+    """Drops the cached access token of a panel."""
+    _token_cache.pop(panel_id, None)
+
+
+def get_token_stats() -> Dict[str, Any]:
+    """Returns the token counters plus the login-to-call ratio."""
+    stats = dict(token_stats)
+    stats["login_ratio"] = stats["logins"] / stats["calls"] if stats["calls"] else 0.0
+    return stats
+
+
+class PanelUnavailableError(httpx.TransportError):
+    """Raised instead of sending a request while a panel's circuit is open."""
+
+
+class PanelHealth:
+    """
+    Rolling latency/error statistics and a circuit breaker for one panel.
+
+    closed     requests flow; PANEL_CIRCUIT_FAILURES failures in a row open it
+    open       requests fail immediately with PanelUnavailableError
+    half_open  after PANEL_CIRCUIT_COOLDOWN one probe request is let through;
+               success closes the circuit, failure opens it again
+    """
+    def __init__(self, panel_id: int):
+        self.panel_id = panel_id
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.last_error: Optional[str] = None
+        self._probe_in_flight = False
+        # (ok, latency seconds) of the last PANEL_HEALTH_WINDOW requests
+        self._samples: deque = deque(maxlen=PANEL_HEALTH_WINDOW)
+        self.stats = {"requests": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    def allow_request(self) -> bool:
+        """Whether a request may be sent now. A True in half-open state claims the probe."""
+        if self.state == "closed":
+            return True
+        self.state = self.effective_state
+        if self.state == "half_open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        self.stats["rejected"] += 1
+        return False
+
+    @property
+    def effective_state(self) -> str:
+        """The state a request would see now: an open circuit whose cooldown is over counts as half_open."""
+        if self.state == "open" and time.monotonic() - self.opened_at >= PANEL_CIRCUIT_COOLDOWN:
+            return "half_open"
+        return self.state
+
+    def record_success(self, latency: float) -> None:
+        self.stats["requests"] += 1
+        self._samples.append((True, latency))
+        self.consecutive_failures = 0
+        if self.state != "closed":
+            logger.info(f"Panel {self.panel_id} is responding again; circuit closed.")
+        self.state = "closed"
+        self._probe_in_flight = False
+
+    def record_failure(self, latency: float, error: str) -> None:
+        self.stats["requests"] += 1
+        self.stats["failures"] += 1
+        self._samples.append((False, latency))
+        self.consecutive_failures += 1
+        self.last_error = error
+        if self.state == "half_open" or (self.state == "closed" and self.consecutive_failures >= PANEL_CIRCUIT_FAILURES):
+            if self.state == "closed":
+                logger.warning(f"Panel {self.panel_id} failed {self.consecutive_failures} times in a row; circuit opened. Last error: {error}")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.stats["opened"] += 1
+        self._probe_in_flight = False
+
+    def release_probe(self) -> None:
+        """A probe ended without a result (e.g. cancelled); let the next request probe."""
+        self._probe_in_flight = False
+
+    @property
+    def error_rate(self) -> float:
+        if not self._samples:
+            return 0.0
+        return sum(1 for ok, _ in self._samples if not ok) / len(self._samples)
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        """Latency of successful requests in the window, in seconds (None without data)."""
+        latencies = sorted(latency for ok, latency in self._samples if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+    @property
+    def status(self) -> str:
+        """One of healthy, degraded (recent errors or half-open) or down (circuit open)."""
+        state = self.effective_state
+        if state == "open":
+            return "down"
+        if state == "half_open" or self.error_rate >= 0.2:
+            return "degraded"
+        return "healthy"
+
+
+class _HealthTransport(httpx.AsyncBaseTransport):
+    """
+    Wraps the real transport so every panel request, whatever handler method
+    sends it, is measured and passes the panel's circuit breaker. Transport
+    errors and 5xx responses count as failures.
+    """
+    def __init__(self, transport: httpx.AsyncBaseTransport, health: PanelHealth):
+        self._transport = transport
+        self.health = health
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if not self.health.allow_request():
+            raise PanelUnavailableError(f"Panel {self.health.panel_id} is unavailable (circuit open)", request=request)
+        started = time.monotonic()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except httpx.TransportError as e:
+            self.health.record_failure(time.monotonic() - started, f"{type(e).__name__}: {e}")
+            raise
+        except BaseException:
+            self.health.release_probe()
+            raise
+        if response.status_code >= 500:
+            self.health.record_failure(time.monotonic() - started, f"HTTP {response.status_code}")
+        else:
+            self.health.record_success(time.monotonic() - started)
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+# VpnPanel.id -> health, kept across handler re-creation so a dead panel stays known
+_panel_health: Dict[int, PanelHealth] = {}
+
+def get_panel_health(panel_id: int) -> PanelHealth:
+    health = _panel_health.get(panel_id)
+    if health is None:
+        health = _panel_health[panel_id] = PanelHealth(panel_id)
+    return health
+
+
+@dataclass(frozen=True)
+class PanelConfig:
+    """
+    A plain, immutable snapshot of a VpnPanel row. Handlers keep this instead
+    of the ORM object, so they stay valid after the DB session is closed.
+    """
+    id: int
+    name: str
+    panel_type: str
+    api_url: str
+    api_token: str
+
+    @classmethod
+    def from_model(cls, panel: VpnPanel) -> "PanelConfig":
+        return cls(
+            id=panel.id,
+            name=panel.name,
+            panel_type=panel.panel_type,
+            api_url=panel.api_url,
+            api_token=panel.api_token,
+        )
+
 
 class VpnPanelInterface(ABC):
     """
@@ -15,8 +256,29 @@ class VpnPanelInterface(ABC):
     for any VPN panel integration. This ensures that all panel handlers
     have a consistent structure.
     """
-    def __init__(self, panel_details: VpnPanel):
+    # Whether TLS certificates of the panel should be verified.
+    verify_ssl = True
+
+    def __init__(self, panel_details: PanelConfig):
         self.panel = panel_details
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """The connection pool owned by this handler, created on first use."""
+        if self._client is None or self._client.is_closed:
+            self._client = _build_client(self.verify_ssl, self.health)
+        return self._client
+
+    @property
+    def health(self) -> PanelHealth:
+        return get_panel_health(self.panel.id)
+
+    async def close(self) -> None:
+        """Closes the connection pool of this handler."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
     @abstractmethod
     async def create_user(self, username: str, plan: Dict) -> Optional[Dict[str, Any]]:
@@ -60,30 +322,93 @@ class VpnPanelInterface(ABC):
         """
         pass
 
+    async def get_users(self, usernames: List[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        Retrieves details for several users at once.
+
+        The default implementation fans out to get_user() with bounded
+        concurrency. Panels with a listing API should override this.
+
+        :param usernames: The usernames to look up.
+        :return: A dictionary mapping each username to its details (or None if not found).
+        """
+        semaphore = asyncio.Semaphore(PANEL_BATCH_CONCURRENCY)
+
+        async def fetch(username: str) -> Optional[Dict[str, Any]]:
+            async with semaphore:
+                return await self.get_user(username)
+
+        unique_usernames = list(dict.fromkeys(usernames))
+        results = await asyncio.gather(*(fetch(u) for u in unique_usernames))
+        return dict(zip(unique_usernames, results))
+
 
 class MarzbanPanel(VpnPanelInterface):
     """Handles all API interactions with a Marzban panel."""
 
-    def _get_auth_token(self) -> str:
-        """Logs in to the panel and returns an access token."""
+    # Using verify=False for self-signed certificates, consider adding a cert path in production.
+    verify_ssl = False
+
+    async def _login(self) -> str:
+        """Logs in to the panel, caches and returns a fresh access token."""
         login_url = f"{self.panel.api_url}/api/admin/token"
         # In Marzban, the "token" is the password for the admin user.
         login_data = {"username": "admin", "password": self.panel.api_token}
         try:
-            # Using verify=False for self-signed certificates, consider adding a cert path in production.
-            response = requests.post(login_url, data=login_data, verify=False, timeout=10)
+            token_stats["logins"] += 1
+            response = await self.client.post(login_url, data=login_data, timeout=10)
             response.raise_for_status()
-            return response.json()["access_token"]
-        except requests.exceptions.RequestException as e:
+            access_token = response.json()["access_token"]
+        except (httpx.HTTPError, KeyError, ValueError) as e:
             print(f"Marzban login failed: {e}")
             raise ConnectionError("Could not connect to Marzban panel to get token.")
 
+        expires_at = _jwt_expiry(access_token) or (time.time() + TOKEN_DEFAULT_TTL)
+        _token_cache[self.panel.id] = (access_token, expires_at - TOKEN_REFRESH_MARGIN)
+        return access_token
+
+    async def _get_auth_token(self, force_refresh: bool = False, stale_token: Optional[str] = None) -> str:
+        """
+        Returns a cached access token, logging in only when it is missing or
+        about to expire. Concurrent callers wait on the same login.
+        """
+        cached = _token_cache.get(self.panel.id)
+        if not force_refresh and cached and cached[1] > time.time():
+            token_stats["cache_hits"] += 1
+            return cached[0]
+
+        lock = _token_locks.setdefault(self.panel.id, asyncio.Lock())
+        async with lock:
+            # Another caller may have refreshed the token while we waited.
+            cached = _token_cache.get(self.panel.id)
+            if cached and cached[1] > time.time() and cached[0] != stale_token:
+                return cached[0]
+            return await self._login()
+
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """
+        Sends an authenticated request. On a 401 the token is refreshed once
+        and the request is retried.
+        """
+        token_stats["calls"] += 1
+        url = f"{self.panel.api_url}{path}"
+        headers = kwargs.pop("headers", {})
+
+        access_token = await self._get_auth_token()
+        headers["Authorization"] = f"Bearer {access_token}"
+        response = await self.client.request(method, url, headers=headers, **kwargs)
+
+        if response.status_code == 401:
+            token_stats["unauthorized_retries"] += 1
+            access_token = await self._get_auth_token(force_refresh=True, stale_token=access_token)
+            headers["Authorization"] = f"Bearer {access_token}"
+            response = await self.client.request(method, url, headers=headers, **kwargs)
+
+        response.raise_for_status()
+        return response
+
     async def create_user(self, username: str, plan: Dict) -> Optional[Dict[str, Any]]:
         try:
-            access_token = self._get_auth_token()
-            headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-            create_user_url = f"{self.panel.api_url}/api/user"
-
             duration_days = plan.get('duration_days', 0)
             expire_timestamp = 0
             if duration_days > 0:
@@ -104,8 +429,7 @@ class MarzbanPanel(VpnPanelInterface):
             if plan.get('user_limit', 0) > 0:
                 user_payload['on_hold_user_limit'] = plan['user_limit']
 
-            response = requests.post(create_user_url, headers=headers, json=user_payload, verify=False, timeout=15)
-            response.raise_for_status()
+            response = await self._request("POST", "/api/user", json=user_payload)
             user_info = response.json()
             
             # Ensure the subscription URL is absolute
@@ -118,33 +442,47 @@ class MarzbanPanel(VpnPanelInterface):
                 "subscription_url": sub_url,
                 "links": user_info.get("links", [])
             }
-        except (requests.exceptions.RequestException, ConnectionError) as e:
+        except (httpx.HTTPError, ConnectionError) as e:
             print(f"Error creating Marzban user {username}: {e}")
             return None
 
     async def get_user(self, username: str) -> Optional[Dict[str, Any]]:
         try:
-            access_token = self._get_auth_token()
-            headers = {"Authorization": f"Bearer {access_token}"}
-            user_url = f"{self.panel.api_url}/api/user/{username}"
-
-            response = requests.get(user_url, headers=headers, verify=False, timeout=10)
-            response.raise_for_status()
+            response = await self._request("GET", f"/api/user/{username}", timeout=10)
             return response.json() # Returns the full user object from Marzban
-        except (requests.exceptions.RequestException, ConnectionError) as e:
+        except (httpx.HTTPError, ConnectionError) as e:
             print(f"Error getting Marzban user {username}: {e}")
             return None
 
-    async def delete_user(self, username: str) -> bool:
+    async def get_users(self, usernames: List[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+        # Marzban's /api/users listing accepts repeated "username" filters and
+        # paginates with offset/limit, so a whole batch costs a few requests.
+        results: Dict[str, Optional[Dict[str, Any]]] = {u: None for u in usernames}
+        wanted = list(results)
         try:
-            access_token = self._get_auth_token()
-            headers = {"Authorization": f"Bearer {access_token}"}
-            user_url = f"{self.panel.api_url}/api/user/{username}"
+            for i in range(0, len(wanted), PANEL_BATCH_PAGE_SIZE):
+                chunk = wanted[i:i + PANEL_BATCH_PAGE_SIZE]
+                offset = 0
+                while True:
+                    params = [("username", u) for u in chunk]
+                    params += [("offset", offset), ("limit", PANEL_BATCH_PAGE_SIZE)]
+                    response = await self._request("GET", "/api/users", params=params)
+                    users = response.json().get("users", [])
+                    for user_info in users:
+                        if user_info.get("username") in results:
+                            results[user_info["username"]] = user_info
+                    if len(users) < PANEL_BATCH_PAGE_SIZE:
+                        break
+                    offset += PANEL_BATCH_PAGE_SIZE
+        except (httpx.HTTPError, ConnectionError, ValueError) as e:
+            print(f"Error listing Marzban users: {e}")
+        return results
 
-            response = requests.delete(user_url, headers=headers, verify=False, timeout=10)
-            response.raise_for_status()
+    async def delete_user(self, username: str) -> bool:
+        try:
+            response = await self._request("DELETE", f"/api/user/{username}", timeout=10)
             return response.status_code == 200
-        except (requests.exceptions.RequestException, ConnectionError) as e:
+        except (httpx.HTTPError, ConnectionError) as e:
             print(f"Error deleting Marzban user {username}: {e}")
             return False
 
@@ -157,15 +495,15 @@ class MarzbanPanel(VpnPanelInterface):
 class SanaeiPanel(VpnPanelInterface):
     """Handles all API interactions with a Sanaei panel."""
 
-    def _make_request(self, endpoint: str, params: Optional[Dict] = None) -> Optional[Dict]:
+    async def _make_request(self, endpoint: str, params: Optional[Dict] = None) -> Optional[Dict]:
         """Helper function to make requests to the Sanaei API."""
         # In Sanaei, the token is passed as a URL parameter.
         base_url = f"{self.panel.api_url}/{self.panel.api_token}/{endpoint}"
         try:
-            response = requests.get(base_url, params=params, timeout=15)
+            response = await self.client.get(base_url, params=params)
             response.raise_for_status()
             return response.json()
-        except requests.exceptions.RequestException as e:
+        except (httpx.HTTPError, ValueError) as e:
             print(f"Sanaei API request failed for endpoint {endpoint}: {e}")
             return None
 
@@ -177,7 +515,7 @@ class SanaeiPanel(VpnPanelInterface):
         # Example: /token/add/format/json/name/test/traffic/10/day/30
         endpoint = f"add/format/json/name/{username}/traffic/{gb}/day/{days}"
         
-        response = self._make_request(endpoint)
+        response = await self._make_request(endpoint)
         
         if response and response.get('ok', False) and response.get('result'):
             result = response['result']
@@ -193,7 +531,7 @@ class SanaeiPanel(VpnPanelInterface):
         # Sanaei API uses 'user' endpoint to get user info by name
         # Example: /token/user/format/json/name/test
         endpoint = f"user/format/json/name/{username}"
-        response = self._make_request(endpoint)
+        response = await self._make_request(endpoint)
 
         if response and response.get('ok', False) and response.get('result'):
             user_info = response['result']
@@ -212,7 +550,7 @@ class SanaeiPanel(VpnPanelInterface):
         # Sanaei API uses 'delete' endpoint
         # Example: /token/delete/format/json/name/test
         endpoint = f"delete/format/json/name/{username}"
-        response = self._make_request(endpoint)
+        response = await self._make_request(endpoint)
         return response and response.get('ok', False)
 
     async def modify_user(self, username: str, modifications: Dict) -> bool:
@@ -228,15 +566,67 @@ PANEL_CLASSES = {
     # "pasargard": PasargardPanel, # Add this when implemented
 }
 
-def get_panel_handler(panel_details: VpnPanel) -> Optional[VpnPanelInterface]:
+# Process-wide registry of long-lived handlers, keyed by VpnPanel.id.
+_handler_registry: Dict[int, VpnPanelInterface] = {}
+# Closes of replaced handlers still running (kept so they aren't garbage collected)
+_closing_tasks: set = set()
+
+def get_panel_handler(panel_details: Union[VpnPanel, PanelConfig]) -> Optional[VpnPanelInterface]:
     """
-    Factory function that returns an instance of the correct panel handler
-    based on the panel's type.
+    Returns the registered handler for a panel, creating the correct handler
+    class based on the panel's type on first use. The handler (and with it
+    its connection pool and token state) is reused across requests.
     """
+    if not isinstance(panel_details, PanelConfig):
+        panel_details = PanelConfig.from_model(panel_details)
+
+    handler = _handler_registry.get(panel_details.id)
+    if handler is not None:
+        if handler.panel == panel_details:
+            return handler
+        # The panel was edited: the old token and health belong to the old connection details
+        _handler_registry.pop(panel_details.id, None)
+        invalidate_token(panel_details.id)
+        _panel_health.pop(panel_details.id, None)
+        _close_in_background(handler)
+
     handler_class = PANEL_CLASSES.get(panel_details.panel_type.lower())
     if handler_class:
-        return handler_class(panel_details)
+        handler = handler_class(panel_details)
+        _handler_registry[panel_details.id] = handler
+        return handler
     else:
         print(f"Error: No panel handler found for type '{panel_details.panel_type}'")
         return None
 
+def _close_in_background(handler: VpnPanelInterface) -> None:
+    """Closes a replaced handler's connection pool without blocking the caller."""
+    try:
+        task = asyncio.get_running_loop().create_task(handler.close())
+    except RuntimeError:
+        # No running loop (e.g. a script); the pool is dropped with the handler
+        return
+    _closing_tasks.add(task)
+    task.add_done_callback(_closing_tasks.discard)
+
+def get_cached_panel_handler(panel_id: int) -> Optional[VpnPanelInterface]:
+    """Returns an already registered handler without touching the database."""
+    return _handler_registry.get(panel_id)
+
+async def invalidate_panel_handler(panel_id: int) -> None:
+    """
+    Removes a panel's handler from the registry and releases its connection
+    pool and cached token. Call this when a panel is added, edited or deleted.
+    """
+    handler = _handler_registry.pop(panel_id, None)
+    invalidate_token(panel_id)
+    # New connection details deserve a fresh start
+    _panel_health.pop(panel_id, None)
+    if handler is not None:
+        await handler.close()
+
+async def close_panel_clients() -> None:
+    """Closes every registered handler's connection pool. Call this on application shutdown."""
+    for panel_id in list(_handler_registry):
+        await invalidate_panel_handler(panel_id)
+
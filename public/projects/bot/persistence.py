@@ -0,0 +1,233 @@
+import io
+import os
+import json
+import time
+import pickle
+import asyncio
+import logging
+from typing import Any, Dict, Optional, Set, Tuple
+
+from sqlalchemy import select, delete, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from telegram.ext import BasePersistence, PersistenceInput
+
+import db_utils
+from database_models import ConversationState, PersistedData
+from panel_manager import PanelConfig, VpnPanelInterface
+
+logger = logging.getLogger(__name__)
+
+# --- Persistence Configuration ---
+# How often (seconds) the application hands changed data to the persistence
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "5"))
+# Changes arriving within this window (seconds) are written in one transaction
+PERSISTENCE_FLUSH_DELAY = float(os.getenv("PERSISTENCE_FLUSH_DELAY", "0.5"))
+
+
+class _DataPickler(pickle.Pickler):
+    """Refuses panel objects: they carry the panel's API token, which must not end up in the DB."""
+    def reducer_override(self, obj):
+        if isinstance(obj, (PanelConfig, VpnPanelInterface)):
+            raise TypeError(f"{type(obj).__name__} holds panel credentials; keep only the panel id in user_data")
+        return NotImplemented
+
+
+def _dumps(data: Any) -> bytes:
+    buffer = io.BytesIO()
+    _DataPickler(buffer, protocol=pickle.HIGHEST_PROTOCOL).dump(data)
+    return buffer.getvalue()
+
+
+class SqlitePersistence(BasePersistence):
+    """
+    Stores conversation states, user_data and chat_data in vpn_bot.db.
+    bot_data is not persisted: it only holds runtime objects (e.g. the
+    broadcast engine).
+
+    - user_data/chat_data are loaded lazily, the first time a user or chat
+      sends an update (refresh_*), so startup doesn't unpickle everyone.
+    - Changes are only staged by update_*; unchanged data is skipped and
+      everything staged is written in one batch shortly afterwards.
+    - Conversation states are small and are all loaded when the
+      ConversationHandler starts, as python-telegram-bot requires.
+    """
+
+    def __init__(self, update_interval: float = PERSISTENCE_UPDATE_INTERVAL, flush_delay: float = PERSISTENCE_FLUSH_DELAY):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.flush_delay = flush_delay
+        self._loaded: Set[Tuple[str, int]] = set()
+        # (kind, key) -> hash of the last stored pickle, to skip unchanged data
+        self._stored: Dict[Tuple[str, int], int] = {}
+        # Staged writes; None means delete
+        self._pending_data: Dict[Tuple[str, int], Optional[bytes]] = {}
+        self._pending_states: Dict[Tuple[str, str], Optional[str]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self.stats = {"loads": 0, "load_seconds": 0.0, "flushes": 0, "rows_written": 0, "flush_seconds": 0.0, "skipped_unchanged": 0}
+
+    # --- Loading ---
+    async def _load(self, kind: str, key: int) -> Optional[Any]:
+        started = time.perf_counter()
+        async with db_utils.get_async_db() as db:
+            blob = await db.scalar(select(PersistedData.data).where(PersistedData.kind == kind, PersistedData.key == key))
+        self.stats["loads"] += 1
+        self.stats["load_seconds"] += time.perf_counter() - started
+        self._loaded.add((kind, key))
+        if blob is None:
+            return None
+        self._stored[(kind, key)] = hash(blob)
+        try:
+            return pickle.loads(blob)
+        except Exception as e:
+            logger.error(f"Discarding unreadable persisted {kind} data for {key}: {e}")
+            return None
+
+    async def get_user_data(self) -> Dict[int, Dict]:
+        return {} # loaded per user in refresh_user_data
+
+    async def get_chat_data(self) -> Dict[int, Dict]:
+        return {} # loaded per chat in refresh_chat_data
+
+    async def get_bot_data(self) -> Dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict:
+        async with db_utils.get_async_db() as db:
+            result = await db.execute(select(ConversationState.key, ConversationState.state).where(ConversationState.name == name))
+            return {tuple(json.loads(key)): json.loads(state) for key, state in result.all()}
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
+        if ("user", user_id) in self._loaded:
+            return
+        stored = await self._load("user", user_id)
+        if stored:
+            # Anything set before the load (same update) takes precedence
+            user_data.update({k: v for k, v in stored.items() if k not in user_data})
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict) -> None:
+        if ("chat", chat_id) in self._loaded:
+            return
+        stored = await self._load("chat", chat_id)
+        if stored:
+            chat_data.update({k: v for k, v in stored.items() if k not in chat_data})
+
+    async def refresh_bot_data(self, bot_data: Dict) -> None:
+        pass
+
+    # --- Staging changes ---
+    def _stage_data(self, kind: str, key: int, data: Any) -> None:
+        try:
+            blob = _dumps(data)
+        except Exception as e:
+            logger.error(f"Cannot persist {kind} data for {key}: {e}")
+            return
+        fingerprint = hash(blob)
+        if self._stored.get((kind, key)) == fingerprint and (kind, key) not in self._pending_data:
+            self.stats["skipped_unchanged"] += 1
+            return
+        self._stored[(kind, key)] = fingerprint
+        self._pending_data[(kind, key)] = blob
+        self._schedule_flush()
+
+    def _drop_data(self, kind: str, key: int) -> None:
+        self._stored.pop((kind, key), None)
+        self._loaded.discard((kind, key))
+        self._pending_data[(kind, key)] = None
+        self._schedule_flush()
+
+    async def update_user_data(self, user_id: int, data: Dict) -> None:
+        # Never loaded means never touched by an update, so there is nothing new to store
+        if ("user", user_id) in self._loaded:
+            self._stage_data("user", user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: Dict) -> None:
+        if ("chat", chat_id) in self._loaded:
+            self._stage_data("chat", chat_id, data)
+
+    async def update_bot_data(self, data: Dict) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._drop_data("user", user_id)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._drop_data("chat", chat_id)
+
+    async def update_conversation(self, name: str, key: Tuple, new_state: Optional[object]) -> None:
+        state = None if new_state is None else json.dumps(new_state)
+        self._pending_states[(name, json.dumps(list(key)))] = state
+        self._schedule_flush()
+
+    # --- Writing ---
+    def _schedule_flush(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        try:
+            await self._write_pending()
+        except Exception as e:
+            logger.error(f"Failed to write persisted bot data: {e}")
+
+    async def _write_pending(self) -> None:
+        async with self._flush_lock:
+            if not self._pending_data and not self._pending_states:
+                return
+            data, states = self._pending_data, self._pending_states
+            self._pending_data, self._pending_states = {}, {}
+
+            async def write(db: AsyncSession) -> None:
+                upserts = [{"kind": kind, "key": key, "data": blob} for (kind, key), blob in data.items() if blob is not None]
+                if upserts:
+                    stmt = sqlite_insert(PersistedData).values(upserts)
+                    await db.execute(stmt.on_conflict_do_update(
+                        index_elements=[PersistedData.kind, PersistedData.key],
+                        set_={"data": stmt.excluded.data, "updated_at": func.now()},
+                    ))
+                for (kind, key), blob in data.items():
+                    if blob is None:
+                        await db.execute(delete(PersistedData).where(PersistedData.kind == kind, PersistedData.key == key))
+
+                state_upserts = [{"name": name, "key": key, "state": state} for (name, key), state in states.items() if state is not None]
+                if state_upserts:
+                    stmt = sqlite_insert(ConversationState).values(state_upserts)
+                    await db.execute(stmt.on_conflict_do_update(
+                        index_elements=[ConversationState.name, ConversationState.key],
+                        set_={"state": stmt.excluded.state, "updated_at": func.now()},
+                    ))
+                for (name, key), state in states.items():
+                    if state is None:
+                        await db.execute(delete(ConversationState).where(ConversationState.name == name, ConversationState.key == key))
+
+            started = time.perf_counter()
+            try:
+                await db_utils.run_write(write)
+            except BaseException:
+                # Put the batch back unless newer changes for the same keys arrived meanwhile
+                for k, v in data.items():
+                    self._pending_data.setdefault(k, v)
+                for k, v in states.items():
+                    self._pending_states.setdefault(k, v)
+                raise
+            self.stats["flushes"] += 1
+            self.stats["rows_written"] += len(data) + len(states)
+            self.stats["flush_seconds"] += time.perf_counter() - started
+
+    async def flush(self) -> None:
+        """Called on shutdown: writes everything that is still staged."""
+        # Let a running flush finish; cancelling it mid-write could lose its batch
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._write_pending()
+        logger.info(f"Persistence stats: {self.stats}")
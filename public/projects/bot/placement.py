@@ -0,0 +1,63 @@
+import logging
+from typing import Dict, Iterable, List, Mapping, Optional
+
+import db_utils
+from db_utils import PlanView
+from panel_manager import get_panel_health
+
+logger = logging.getLogger(__name__)
+
+# ===============================================================
+#   Panel Placement
+#   Picks the panel of a plan's pool that a new service is created on.
+#   Every candidate gets a penalty score from live signals, each scaled
+#   to 0..1 and multiplied by an admin-set weight (settings.json,
+#   "placement_weights"); the lowest score wins:
+#     users    accounts on the panel, relative to the fullest candidate
+#     latency  median API latency, relative to the slowest candidate
+#     errors   error rate of the panel's recent requests
+#   Panels whose circuit is open are only used when nothing else is left.
+# ===============================================================
+
+DEFAULT_PLACEMENT_WEIGHTS = {"users": 1.0, "latency": 1.0, "errors": 2.0}
+# Added to a half-open panel's score: usable, but only when clearly better
+HALF_OPEN_PENALTY = 1.0
+
+
+def rank_panels(account_counts: Mapping[int, int], weights: Optional[Mapping[str, float]] = None) -> List[int]:
+    """Orders candidate panel ids (keys of account_counts) from best to worst."""
+    weights = {**DEFAULT_PLACEMENT_WEIGHTS, **(weights or {})}
+    if not account_counts:
+        return []
+    health = {panel_id: get_panel_health(panel_id) for panel_id in account_counts}
+    latencies = {panel_id: h.latency_percentile(50) for panel_id, h in health.items()}
+    max_count = max(account_counts.values()) or 1
+    max_latency = max((latency for latency in latencies.values() if latency is not None), default=None) or 1.0
+
+    def score(panel_id: int):
+        h = health[panel_id]
+        # An open circuit whose cooldown is over takes a probe, like _HealthTransport would let through
+        state = h.effective_state
+        value = (
+            weights["users"] * account_counts[panel_id] / max_count
+            + weights["latency"] * (latencies[panel_id] or 0.0) / max_latency
+            + weights["errors"] * h.error_rate
+        )
+        if state == "half_open":
+            value += HALF_OPEN_PENALTY
+        # Open circuits sort last; ties go to the emptier panel
+        return (state == "open", value, account_counts[panel_id], panel_id)
+
+    return sorted(account_counts, key=score)
+
+
+async def rank_plan_panels(plan: PlanView, weights: Optional[Mapping[str, float]] = None,
+                           exclude: Iterable[int] = ()) -> List[int]:
+    """The active panels of a plan's pool, best first, without the excluded ones."""
+    excluded = set(exclude)
+    candidates = [panel_id for panel_id in plan.pool if panel_id not in excluded]
+    if not candidates:
+        return []
+    async with db_utils.get_async_db() as db:
+        account_counts: Dict[int, int] = await db_utils.get_placement_candidates_async(db, candidates)
+    return rank_panels(account_counts, weights)
@@ -0,0 +1,279 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional
+
+import db_utils
+from db_utils import OrderView, PlanView, ProvisioningJobView
+from panel_manager import VpnPanelInterface, get_cached_panel_handler, get_panel_handler
+from placement import rank_plan_panels
+from usage_sync import forget_refresh
+
+logger = logging.getLogger(__name__)
+
+# --- Provisioning Configuration ---
+PROVISIONING_WORKERS = int(os.getenv("PROVISIONING_WORKERS", "3"))
+# Rounds over a plan's whole pool before giving up; falling back to another panel stays in the round
+PROVISIONING_MAX_ATTEMPTS = int(os.getenv("PROVISIONING_MAX_ATTEMPTS", "5"))
+# Delays between rounds grow as base * 2^(attempt-1) seconds, up to the max
+PROVISIONING_RETRY_BASE = float(os.getenv("PROVISIONING_RETRY_BASE", "5"))
+PROVISIONING_RETRY_MAX = float(os.getenv("PROVISIONING_RETRY_MAX", "600"))
+# Idle workers look for due retries this often (new jobs wake them immediately)
+PROVISIONING_POLL_INTERVAL = float(os.getenv("PROVISIONING_POLL_INTERVAL", "5"))
+
+
+class PermanentProvisioningError(Exception):
+    """A failure that retrying cannot fix (missing plan, panel, ...)."""
+
+
+@dataclass(frozen=True)
+class ProvisioningResult:
+    job: ProvisioningJobView
+    order: Optional[OrderView]
+    success: bool
+    user_info: Optional[Dict[str, Any]] = None # username, subscription_url, links
+    error: Optional[str] = None
+
+
+NotifyFn = Callable[[ProvisioningResult], Awaitable[None]]
+WeightsFn = Callable[[], Mapping[str, float]]
+
+
+class ProvisioningEngine:
+    """
+    A pool of workers that create panel users for confirmed orders. Jobs
+    live in the provisioning_jobs table, so a restart continues where it
+    stopped. Provisioning is idempotent: the panel username is fixed per
+    job and an existing panel user is reused instead of created again.
+    When a panel fails, the job moves on to the next panel of the plan's
+    pool at once; only when every panel has failed does it back off.
+    """
+    def __init__(self, notify: NotifyFn, placement_weights: Optional[WeightsFn] = None, workers: int = PROVISIONING_WORKERS):
+        self.notify = notify
+        self.placement_weights = placement_weights or (lambda: {})
+        self.workers = workers
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        # Completion times (monotonic) of the last minute, for the throughput figure
+        self._completed = deque()
+        self.stats = {"done": 0, "failed": 0, "retried": 0, "fallbacks": 0}
+
+    async def start(self) -> None:
+        requeued = await db_utils.run_write(db_utils.requeue_interrupted_jobs_async)
+        if requeued:
+            logger.info(f"Re-queued {requeued} provisioning jobs interrupted by the last shutdown.")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        # Jobs cut off here stay "running" and are re-queued on the next start
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def wake(self) -> None:
+        """Call after queueing a job so an idle worker picks it up right away."""
+        self._wakeup.set()
+
+    def orders_per_minute(self) -> int:
+        cutoff = time.monotonic() - 60
+        while self._completed and self._completed[0] < cutoff:
+            self._completed.popleft()
+        return len(self._completed)
+
+    async def _worker(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                job = await db_utils.run_write(db_utils.claim_provisioning_job_async)
+            except Exception as e:
+                logger.error(f"Failed to claim a provisioning job: {e}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), PROVISIONING_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._process(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Never let one job end the worker; the job is re-queued on the next start
+                logger.error(f"Unexpected error while provisioning order {job.tracking_code}: {e}")
+
+    async def _process(self, job: ProvisioningJobView) -> None:
+        order = None
+        panel_id = job.panel_id
+        try:
+            async with db_utils.get_async_db() as db:
+                order = await db_utils.get_order_view_async(db, job.tracking_code)
+            if not order:
+                raise PermanentProvisioningError(f"Order {job.tracking_code} not found")
+            if not order.plan or not order.plan.panel_id:
+                raise PermanentProvisioningError(f"Plan {order.plan_id} is not linked to any panel!")
+
+            # Jobs queued before panel pools existed have no panel of their own
+            panel_id = panel_id or order.plan.panel_id
+            panel_handler = await self._get_handler(panel_id)
+            user_info = await self._provision(panel_handler, job.panel_username, order.plan)
+
+            await db_utils.run_write(lambda db: db_utils.complete_provisioning_async(db,
+                job_id=job.id,
+                tracking_code=job.tracking_code,
+                user_telegram_id=order.user_telegram_id,
+                panel_id=panel_id,
+                panel_username=user_info["username"],
+                friendly_name=f"{order.plan.data_limit_gb}GB",
+                expires_at=self._expires_at(user_info, order.plan),
+                data_limit_gb=order.plan.data_limit_gb,
+            ))
+        except asyncio.CancelledError:
+            raise
+        except PermanentProvisioningError as e:
+            await self._give_up(job, order, str(e))
+            return
+        except Exception as e:
+            error = str(e)
+            # After a timeout the user may exist anyway; then this panel must be retried, not left behind
+            created = bool(panel_id) and await self._has_user(panel_id, job.panel_username)
+            tried = job.tried_panel_ids + ((panel_id,) if panel_id else ())
+            # Kept across rounds so every panel a create may have reached is cleaned up
+            failed = job.failed_panel_ids + ((panel_id,) if panel_id and panel_id not in job.failed_panel_ids else ())
+            fallback = [] if created else await self._rank_panels(order, exclude=tried)
+            if fallback:
+                logger.warning(f"Provisioning for order {job.tracking_code} failed on panel {panel_id}, falling back to panel {fallback[0]}: {error}")
+                self.stats["fallbacks"] += 1
+                await self._retry(job, error, datetime.now(timezone.utc), panel_id=fallback[0], tried_panel_ids=tried, failed_panel_ids=failed)
+                return
+
+            if job.attempts >= PROVISIONING_MAX_ATTEMPTS:
+                await self._give_up(job, order, error)
+                return
+            # Every panel of the pool failed: back off, then start over with the best one
+            delay = min(PROVISIONING_RETRY_BASE * 2 ** (job.attempts - 1), PROVISIONING_RETRY_MAX)
+            delay *= random.uniform(1.0, 1.2) # spread retries of jobs that failed together
+            logger.warning(f"Provisioning for order {job.tracking_code} failed (attempt {job.attempts}), retrying in {delay:.0f}s: {error}")
+            self.stats["retried"] += 1
+            next_attempt_at = datetime.now(timezone.utc) + timedelta(seconds=delay)
+            ranked = [panel_id] if created else await self._rank_panels(order)
+            next_panel_id = ranked[0] if ranked else None
+            await self._retry(job, error, next_attempt_at, panel_id=next_panel_id, failed_panel_ids=failed, next_round=True)
+            return
+
+        forget_refresh(panel_id, user_info["username"])
+        self.stats["done"] += 1
+        self._completed.append(time.monotonic())
+        await self._notify(ProvisioningResult(job=job, order=order, success=True, user_info=user_info))
+        await self._remove_leftovers(job, panel_id)
+
+    async def _rank_panels(self, order: Optional[OrderView], exclude=()) -> List[int]:
+        """The order's plan pool, best panel first; empty if unknown or on error."""
+        if not order or not order.plan:
+            return []
+        try:
+            return await rank_plan_panels(order.plan, self.placement_weights(), exclude)
+        except Exception as e:
+            logger.error(f"Could not rank panels for order {order.tracking_code}: {e}")
+            return []
+
+    async def _has_user(self, panel_id: int, username: str) -> bool:
+        """Whether the panel has the user; False if it can't be asked."""
+        try:
+            panel_handler = await self._get_handler(panel_id)
+            return bool(await panel_handler.get_user(username))
+        except Exception as e:
+            logger.warning(f"Could not look up {username} on panel {panel_id}: {e}")
+            return False
+
+    async def _remove_leftovers(self, job: ProvisioningJobView, panel_id: int) -> None:
+        """
+        Deletes the job's user from the panels it failed on. A create that
+        timed out on an unreachable panel may still have gone through there.
+        """
+        for tried_id in job.failed_panel_ids:
+            if tried_id == panel_id:
+                continue
+            try:
+                panel_handler = await self._get_handler(tried_id)
+                removed = await panel_handler.delete_user(job.panel_username)
+                forget_refresh(tried_id, job.panel_username)
+            except Exception as e:
+                logger.error(f"Could not remove leftover user {job.panel_username} from panel {tried_id}: {e}")
+                continue
+            if removed:
+                logger.info(f"Removed leftover user {job.panel_username} from panel {tried_id}.")
+            else:
+                # Either it never existed or the panel is still unreachable
+                logger.warning(f"User {job.panel_username} was not deleted from panel {tried_id}; check it if the panel was only slow.")
+
+    async def _get_handler(self, panel_id: int) -> VpnPanelInterface:
+        panel_handler = get_cached_panel_handler(panel_id)
+        if panel_handler:
+            return panel_handler
+        async with db_utils.get_async_db() as db:
+            panel = await db_utils.get_panel_by_id_async(db, panel_id)
+        if not panel:
+            raise PermanentProvisioningError(f"Panel with ID {panel_id} not found in database!")
+        panel_handler = get_panel_handler(panel)
+        if not panel_handler:
+            raise PermanentProvisioningError(f"Panel {panel_id} has an unsupported type")
+        return panel_handler
+
+    @staticmethod
+    async def _provision(panel_handler: VpnPanelInterface, username: str, plan: PlanView) -> Dict[str, Any]:
+        # A previous attempt may have created the user before failing; reuse it
+        user_info = await panel_handler.get_user(username)
+        if not user_info:
+            user_info = await panel_handler.create_user(username=username, plan=plan.to_dict())
+        if not user_info:
+            raise ValueError("Failed to create user on the panel, API returned None.")
+
+        subscription_url = user_info.get("subscription_url")
+        if subscription_url and not subscription_url.startswith("http"):
+            subscription_url = f"{panel_handler.panel.api_url}{subscription_url}"
+        links = user_info.get("links") or []
+        if not subscription_url and not links:
+            raise ValueError("Neither subscription_url nor links were found in panel response.")
+        return {"username": user_info.get("username") or username, "subscription_url": subscription_url, "links": links,
+                "expire": user_info.get("expire")}
+
+    @staticmethod
+    def _expires_at(user_info: Dict[str, Any], plan: PlanView) -> Optional[datetime]:
+        """The panel's expiry if it reported one (e.g. a reused user), else computed from the plan."""
+        expire = user_info.get("expire")
+        if expire and expire > 0:
+            return datetime.fromtimestamp(expire, tz=timezone.utc)
+        if plan.duration_days > 0:
+            return datetime.now(timezone.utc) + timedelta(days=plan.duration_days)
+        return None
+
+    async def _retry(self, job: ProvisioningJobView, error: str, next_attempt_at: datetime, **kwargs) -> None:
+        try:
+            await db_utils.run_write(lambda db: db_utils.retry_provisioning_async(db, job.id, error, next_attempt_at, **kwargs))
+        except Exception as e:
+            # The job stays "running" and is re-queued on the next start
+            logger.error(f"Could not schedule a retry of provisioning job {job.id}: {e}")
+
+    async def _give_up(self, job: ProvisioningJobView, order: Optional[OrderView], error: str) -> None:
+        logger.error(f"CRITICAL: Failed to create panel user for order {job.tracking_code}: {error}")
+        try:
+            await db_utils.run_write(lambda db: db_utils.fail_provisioning_async(db, job.id, job.tracking_code, error))
+        except Exception as e:
+            logger.error(f"Could not mark provisioning job {job.id} as failed: {e}")
+            return
+        self.stats["failed"] += 1
+        self._completed.append(time.monotonic())
+        await self._notify(ProvisioningResult(job=job, order=order, success=False, error=error))
+
+    async def _notify(self, result: ProvisioningResult) -> None:
+        try:
+            await self.notify(result)
+        except Exception as e:
+            logger.error(f"Failed to send provisioning notifications for order {result.job.tracking_code}: {e}")
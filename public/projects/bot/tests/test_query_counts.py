@@ -0,0 +1,92 @@
+"""
+Statement counts of the single-query views the account and order screens
+use. Each view must cost a fixed number of statements, however many
+accounts a user has or panels a plan's pool holds.
+"""
+import sys
+import asyncio
+from pathlib import Path
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import db_utils  # noqa: E402
+from database_models import Base, Order, Plan, PlanPanel, User, VpnAccount, VpnPanel  # noqa: E402
+
+ACCOUNTS = 20
+POOL_SIZE = 5
+
+
+async def _seed(session) -> None:
+    panels = [VpnPanel(name=f"panel-{i}", panel_type="marzban", api_url=f"http://panel-{i}", api_token="t")
+              for i in range(POOL_SIZE)]
+    user = User(telegram_id=1, first_name="user")
+    session.add_all([*panels, user])
+    await session.flush()
+    session.add(Plan(id="plan", name="plan", panel_id=panels[0].id))
+    await session.flush()
+    session.add_all([PlanPanel(plan_id="plan", panel_id=panel.id) for panel in panels])
+    session.add_all([
+        VpnAccount(user_id=user.id, panel_id=panels[i % POOL_SIZE].id, panel_username=f"user_{i}", friendly_name=f"{i}")
+        for i in range(ACCOUNTS)
+    ])
+    session.add(Order(tracking_code="T1", user_id=user.id, plan_id="plan", status="pending"))
+    await session.commit()
+
+
+def _count_statements(query):
+    """Runs query(session) on a seeded in-memory database; returns (result, statements executed)."""
+    async def run():
+        engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+            sessions = async_sessionmaker(engine, expire_on_commit=False)
+            async with sessions() as session:
+                await _seed(session)
+
+            statements = []
+            event.listen(engine.sync_engine, "before_cursor_execute",
+                         lambda conn, cursor, statement, *args: statements.append(statement))
+            async with sessions() as session:
+                result = await query(session)
+            return result, len(statements)
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(run())
+
+
+def test_account_overviews_use_one_statement():
+    accounts, statements = _count_statements(lambda db: db_utils.get_account_overviews_async(db, 1))
+    assert len(accounts) == ACCOUNTS
+    assert all(account.panel.name.startswith("panel-") for account in accounts)
+    assert statements == 1
+
+
+def test_owned_account_uses_one_statement():
+    account, statements = _count_statements(lambda db: db_utils.get_owned_account_async(db, 1, 1))
+    assert account is not None and account.panel_username == "user_0"
+    assert statements == 1
+
+
+def test_owned_account_of_another_user_is_not_returned():
+    account, statements = _count_statements(lambda db: db_utils.get_owned_account_async(db, 1, 2))
+    assert account is None
+    assert statements == 1
+
+
+@pytest.mark.parametrize("tracking_code, expected", [("T1", 2), ("missing", 1)])
+def test_order_view_statements(tracking_code, expected):
+    order, statements = _count_statements(lambda db: db_utils.get_order_view_async(db, tracking_code))
+    if tracking_code == "T1":
+        assert order.user_telegram_id == 1
+        assert len(order.plan.pool) == POOL_SIZE
+    else:
+        assert order is None
+    # The order row, plus the plan's pool
+    assert statements == expected
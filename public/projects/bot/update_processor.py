@@ -0,0 +1,102 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# --- Update Processing Configuration ---
+# Updates whose handlers may run at the same time
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+# Updates admitted at once, including those waiting for an earlier update of
+# the same user. Beyond this, the application has already taken the update off
+# its update_queue and started a task for it; that task waits on the
+# processor's semaphore in process_update(). The effective limit is
+# max(MAX_ADMITTED_UPDATES, MAX_CONCURRENT_UPDATES).
+MAX_ADMITTED_UPDATES = int(os.getenv("MAX_ADMITTED_UPDATES", str(MAX_CONCURRENT_UPDATES * 8)))
+
+# Durations (including lock wait) of this many recent updates are kept for stats
+LATENCY_SAMPLES = 1000
+
+KeyFn = Callable[[object], Optional[Hashable]]
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Handles updates concurrently, except that updates with the same key
+    (e.g. the same user) run one after another in arrival order, so a
+    ConversationHandler never sees two steps of one user at once.
+
+    python-telegram-bot holds its semaphore while an update waits for its
+    key lock, so that semaphore only bounds admitted updates
+    (max(max_admitted_updates, max_concurrent_updates), so admission is
+    never tighter than execution); a second semaphore, taken after the key
+    lock, bounds the handlers actually running (MAX_CONCURRENT_UPDATES). A
+    user spamming the bot therefore ties up admission slots but not workers.
+    Updates beyond the admission limit are not left in update_queue: the
+    application has already created a task per update, and those tasks
+    wait on the semaphore inside process_update().
+    """
+
+    def __init__(self, key_func: KeyFn, max_concurrent_updates: int = MAX_CONCURRENT_UPDATES,
+                 max_admitted_updates: int = MAX_ADMITTED_UPDATES):
+        super().__init__(max_concurrent_updates=max(max_admitted_updates, max_concurrent_updates))
+        self.key_func = key_func
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        # key -> [lock, number of updates holding or waiting for it]
+        self._locks: Dict[Hashable, List[Any]] = {}
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.stats = {"processed": 0, "waited_for_key": 0}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self._locks:
+            logger.warning(f"Update processor shut down with {len(self._locks)} keys still busy.")
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        started = time.monotonic()
+        try:
+            key = self.key_func(update)
+        except Exception as e:
+            logger.error(f"Could not determine the lock key of an update: {e}")
+            key = None
+
+        try:
+            if key is None:
+                async with self._running:
+                    await coroutine
+            else:
+                await self._run_locked(key, coroutine)
+        finally:
+            self.stats["processed"] += 1
+            self._latencies.append(time.monotonic() - started)
+
+    async def _run_locked(self, key: Hashable, coroutine: Awaitable[Any]) -> None:
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        elif entry[0].locked():
+            self.stats["waited_for_key"] += 1
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            # The last update for a key removes its lock, so the dict stays small
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def latency_percentile(self, percentile: float) -> float:
+        """Seconds from admission to completion, over the last LATENCY_SAMPLES updates."""
+        if not self._latencies:
+            return 0.0
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
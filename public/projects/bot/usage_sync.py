@@ -0,0 +1,165 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
+
+from telegram.ext import ContextTypes
+
+import db_utils
+from db_utils import AccountUsageView, AccountView
+from panel_manager import PanelConfig, VpnPanelInterface, get_panel_handler
+
+logger = logging.getLogger(__name__)
+
+# --- Usage Sync Configuration ---
+# How often (seconds) every panel's account statuses are copied into account_usage
+USAGE_SYNC_INTERVAL = float(os.getenv("USAGE_SYNC_INTERVAL", "300"))
+# Accounts fetched from a panel (and written) per batch
+USAGE_SYNC_BATCH = int(os.getenv("USAGE_SYNC_BATCH", "500"))
+# Panels synced at the same time
+USAGE_SYNC_PANEL_CONCURRENCY = int(os.getenv("USAGE_SYNC_PANEL_CONCURRENCY", "3"))
+# Repeated refreshes of one account within this many seconds share one panel call
+USAGE_REFRESH_TTL = float(os.getenv("USAGE_REFRESH_TTL", "30"))
+# Accounts whose last refresh is remembered; the oldest are dropped beyond this
+USAGE_REFRESH_CACHE_SIZE = int(os.getenv("USAGE_REFRESH_CACHE_SIZE", "1000"))
+
+# (panel_id, panel_username) -> (start time, live refresh task)
+_recent_refreshes: Dict[Tuple[int, str], Tuple[float, asyncio.Task]] = {}
+
+
+def usage_row(account_id: int, user_info: Dict[str, Any], panel: PanelConfig) -> Dict[str, Any]:
+    """Turns a panel's user details into an account_usage row."""
+    subscription_url = user_info.get("subscription_url")
+    if subscription_url and not subscription_url.startswith("http"):
+        subscription_url = f"{panel.api_url}{subscription_url}"
+    return {
+        "account_id": account_id,
+        "used_traffic": int(user_info.get("used_traffic") or 0),
+        "data_limit": int(user_info.get("data_limit") or 0),
+        "expire": user_info.get("expire") or None,
+        "subscription_url": subscription_url,
+        "links": [link for link in user_info.get("links") or [] if link],
+        "synced_at": datetime.now(timezone.utc),
+    }
+
+
+def _usage_view(row: Dict[str, Any]) -> AccountUsageView:
+    return AccountUsageView(
+        used_traffic=row["used_traffic"],
+        data_limit=row["data_limit"],
+        expire=row["expire"],
+        subscription_url=row["subscription_url"],
+        links=tuple(row["links"]),
+        synced_at=row["synced_at"],
+    )
+
+
+class UsageSync:
+    """
+    Copies account statuses from every active panel into the account_usage
+    table. Runs as a repeating JobQueue job; each panel is read with its
+    batch API (get_users) and every batch is upserted in one write.
+    Accounts a panel didn't return (not found, or the panel failed) keep
+    their previous row, so a panel outage shows old data rather than none.
+    """
+    def __init__(self):
+        self.last_run: Optional[datetime] = None
+        self.stats = {"runs": 0, "accounts": 0, "missing": 0, "panel_errors": 0, "last_seconds": 0.0}
+
+    async def job(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        try:
+            await self.sync_all()
+        except Exception as e:
+            logger.error(f"Usage sync failed: {e}")
+
+    async def sync_all(self) -> None:
+        started = time.perf_counter()
+        async with db_utils.get_async_db() as db:
+            panels = [PanelConfig.from_model(panel) for panel in await db_utils.get_all_panels_async(db)]
+        semaphore = asyncio.Semaphore(USAGE_SYNC_PANEL_CONCURRENCY)
+
+        async def sync(panel: PanelConfig) -> None:
+            async with semaphore:
+                try:
+                    await self.sync_panel(panel)
+                except Exception as e:
+                    self.stats["panel_errors"] += 1
+                    logger.error(f"Usage sync for panel {panel.name} failed: {e}")
+
+        await asyncio.gather(*(sync(panel) for panel in panels))
+        self.stats["runs"] += 1
+        self.stats["last_seconds"] = time.perf_counter() - started
+        self.last_run = datetime.now(timezone.utc)
+        logger.info(f"Usage sync finished in {self.stats['last_seconds']:.1f}s: {self.stats}")
+
+    async def sync_panel(self, panel: PanelConfig) -> None:
+        panel_handler = get_panel_handler(panel)
+        if not panel_handler:
+            return
+        cursor = 0
+        while True:
+            async with db_utils.get_async_db() as db:
+                chunk = await db_utils.get_panel_account_chunk_async(db, panel.id, cursor, USAGE_SYNC_BATCH)
+            if not chunk:
+                break
+            cursor = chunk[-1][0]
+            infos = await panel_handler.get_users([username for _, username in chunk])
+            rows = [usage_row(account_id, infos[username], panel) for account_id, username in chunk if infos.get(username)]
+            self.stats["missing"] += len(chunk) - len(rows)
+            await db_utils.run_write(lambda db: db_utils.upsert_account_usage_async(db, rows))
+            self.stats["accounts"] += len(rows)
+
+    @staticmethod
+    async def refresh_account(account: AccountView) -> Optional[AccountUsageView]:
+        """
+        Reads one account live from its panel (an explicit refresh) and stores
+        the result. Returns None if the panel didn't return the account.
+        Presses within USAGE_REFRESH_TTL of a refresh that is running or has
+        succeeded get its result instead of another panel call.
+        """
+        key = (account.panel.id, account.panel_username)
+        now = time.monotonic()
+        entry = _recent_refreshes.get(key)
+        if entry is not None and now - entry[0] < USAGE_REFRESH_TTL and not _failed(entry[1]):
+            return await asyncio.shield(entry[1])
+
+        for stale_key in [k for k, (started, task) in _recent_refreshes.items() if task.done() and now - started >= USAGE_REFRESH_TTL]:
+            del _recent_refreshes[stale_key]
+        _recent_refreshes.pop(key, None)
+        while len(_recent_refreshes) >= USAGE_REFRESH_CACHE_SIZE:
+            # Dicts keep insertion order, so the first key is the oldest refresh
+            del _recent_refreshes[next(iter(_recent_refreshes))]
+        task = asyncio.ensure_future(_refresh_live(account))
+        _recent_refreshes[key] = (now, task)
+        # shield() lets the shared refresh finish even if this caller is cancelled
+        return await asyncio.shield(task)
+
+
+def forget_refresh(panel_id: int, username: str) -> None:
+    """Call after a panel user was created, deleted or changed, so the next refresh reads it live."""
+    _recent_refreshes.pop((panel_id, username), None)
+
+
+def forget_panel_refreshes(panel_id: int) -> None:
+    """Call after a panel was edited or deleted."""
+    for key in [k for k in _recent_refreshes if k[0] == panel_id]:
+        del _recent_refreshes[key]
+
+
+def _failed(task: asyncio.Task) -> bool:
+    """A refresh that raised, was cancelled or didn't get the account is not shared."""
+    return task.done() and (task.cancelled() or task.exception() is not None or task.result() is None)
+
+
+async def _refresh_live(account: AccountView) -> Optional[AccountUsageView]:
+    panel_handler: Optional[VpnPanelInterface] = get_panel_handler(account.panel)
+    if not panel_handler:
+        return None
+    user_info = await panel_handler.get_user(account.panel_username)
+    if not user_info:
+        return None
+    row = usage_row(account.id, user_info, account.panel)
+    await db_utils.run_write(lambda db: db_utils.upsert_account_usage_async(db, [row]))
+    return _usage_view(row)
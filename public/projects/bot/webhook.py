@@ -0,0 +1,263 @@
+import os
+import hmac
+import json
+import signal
+import asyncio
+import logging
+import secrets
+from typing import Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+# --- Webhook Configuration ---
+# Public HTTPS URL Telegram posts updates to (a reverse proxy forwards it to the listener)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Must be identical on every instance behind the same load balancer
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Updates accepted but not yet handled; when full, Telegram is told to retry later
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+# How long (seconds) a request waits for room in the queue before it is refused
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", "5"))
+# Parallel connections Telegram may open to this bot (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Set to 0 when the webhook is registered elsewhere (e.g. by a single deploy step)
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "1") == "1"
+
+MAX_BODY_SIZE = 1024 * 1024
+MAX_HEADERS = 100
+# Idle keep-alive connections are closed after this many seconds
+KEEPALIVE_TIMEOUT = 75
+# A request (line, headers and body) must arrive completely within this many seconds
+REQUEST_TIMEOUT = 30
+# Readiness is reported as failing once the queue is this full
+READY_QUEUE_RATIO = 0.9
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+
+def make_update_queue() -> asyncio.Queue:
+    """The bounded queue to pass to Application.builder().update_queue() in webhook mode."""
+    return asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+
+
+class WebhookServer:
+    """
+    Minimal HTTP/1.1 listener for Telegram webhooks.
+
+    POST <path>   an update; checked against the secret token and put on the
+                  application's (bounded) update queue
+    GET /healthz  200 while the process is serving
+    GET /readyz   200 while the application is running and the queue has room
+    """
+
+    def __init__(self, application: Application, path: str, secret: str,
+                 host: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                 enqueue_timeout: float = WEBHOOK_ENQUEUE_TIMEOUT):
+        self.application = application
+        self.path = path
+        self.secret = secret.encode()
+        self.host = host
+        self.port = port
+        self.enqueue_timeout = enqueue_timeout
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections = set()
+        self.stats = {"accepted": 0, "rejected_secret": 0, "rejected_busy": 0, "bad_requests": 0}
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        logger.info(f"Webhook listener on http://{self.host}:{self.port}{self.path}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            # Idle keep-alive connections would otherwise hold wait_closed() open
+            for writer in list(self._connections):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    @property
+    def ready(self) -> bool:
+        queue = self.application.update_queue
+        full = queue.maxsize > 0 and queue.qsize() >= queue.maxsize * READY_QUEUE_RATIO
+        return self.application.running and not full
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # Telegram keeps connections open, so serve requests until the peer closes
+        self._connections.add(writer)
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, payload = await self._dispatch(method, path, headers, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                self._write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except _BadRequest as e:
+            self.stats["bad_requests"] += 1
+            self._write_response(writer, e.status, e.reason, keep_alive=False)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, dict, bytes]]:
+        # The idle wait for the next request is bounded separately from reading it,
+        # so a slow client can't hold a connection by trickling bytes
+        first = await asyncio.wait_for(reader.read(1), KEEPALIVE_TIMEOUT)
+        if not first:
+            return None
+        try:
+            return await asyncio.wait_for(self._read_rest(first, reader), REQUEST_TIMEOUT)
+        except ValueError:
+            # A line longer than the stream's buffer limit
+            raise _BadRequest(431, "Request Header Fields Too Large")
+
+    async def _read_rest(self, first: bytes, reader: asyncio.StreamReader) -> Tuple[str, str, dict, bytes]:
+        request_line = first + await reader.readline()
+        try:
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            raise _BadRequest(400, "Bad Request")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if len(headers) >= MAX_HEADERS:
+                raise _BadRequest(431, "Request Header Fields Too Large")
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get("content-length", "0"))
+        except ValueError:
+            raise _BadRequest(400, "Bad Request")
+        if length > MAX_BODY_SIZE:
+            raise _BadRequest(413, "Payload Too Large")
+        body = await reader.readexactly(length) if length else b""
+        return method, urlsplit(target).path, headers, body
+
+    async def _dispatch(self, method: str, path: str, headers: dict, body: bytes) -> Tuple[int, str]:
+        if method == "GET" and path == "/healthz":
+            return 200, "ok"
+        if method == "GET" and path == "/readyz":
+            return (200, "ready") if self.ready else (503, "not ready")
+        if path != self.path:
+            return 404, "Not Found"
+        if method != "POST":
+            return 405, "Method Not Allowed"
+
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, "").encode(), self.secret):
+            self.stats["rejected_secret"] += 1
+            return 403, "Forbidden"
+
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            self.stats["bad_requests"] += 1
+            logger.warning(f"Ignoring malformed webhook update: {e}")
+            # Answer 200 anyway, otherwise Telegram keeps re-sending the same broken update
+            return 200, "ignored"
+
+        try:
+            # Blocks while the queue is full, which slows Telegram down instead of piling up memory
+            await asyncio.wait_for(self.application.update_queue.put(update), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            self.stats["rejected_busy"] += 1
+            logger.warning("Update queue is full; asking Telegram to retry later.")
+            return 503, "busy"
+        self.stats["accepted"] += 1
+        return 200, "ok"
+
+    @staticmethod
+    def _write_response(writer: asyncio.StreamWriter, status: int, payload: str, keep_alive: bool) -> None:
+        body = payload.encode()
+        head = (
+            f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+            f"Content-Type: text/plain; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode() + body)
+
+
+class _BadRequest(Exception):
+    def __init__(self, status: int, reason: str):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+
+_REASONS = {
+    200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+    413: "Payload Too Large", 431: "Request Header Fields Too Large", 503: "Service Unavailable",
+}
+
+
+def run_webhook_server(application: Application, allowed_updates: Optional[Sequence[str]] = None) -> None:
+    """
+    Webhook counterpart of application.run_polling(): runs the same
+    post_init/post_shutdown hooks and blocks until SIGINT/SIGTERM.
+    The application must be built with .updater(None) and make_update_queue().
+    """
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL must be set to use webhook mode.")
+    secret = WEBHOOK_SECRET
+    if not secret and not WEBHOOK_REGISTER:
+        # A random secret would never reach Telegram, so every update would be refused
+        raise RuntimeError("WEBHOOK_SECRET must be set when WEBHOOK_REGISTER=0.")
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET is not set; using a random one. Set it when running several instances.")
+    path = urlsplit(WEBHOOK_URL).path or "/"
+    asyncio.run(_serve(application, WebhookServer(application, path, secret), allowed_updates))
+
+
+async def _serve(application: Application, server: WebhookServer, allowed_updates: Optional[Sequence[str]]) -> None:
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await server.start()
+        if WEBHOOK_REGISTER:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL,
+                secret_token=server.secret.decode(),
+                allowed_updates=allowed_updates,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+        logger.info("Bot is running in webhook mode.")
+        await stop_event.wait()
+    finally:
+        # Stop taking new updates first, then let the application drain what it has
+        await server.stop()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)